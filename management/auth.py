@@ -1,13 +1,21 @@
-import base64, os, os.path, hmac
+import base64, os, os.path, hmac, hashlib, threading, time
+from collections import OrderedDict
 
 from flask import make_response
 
-import utils
-from mailconfig import get_mail_password, get_mail_user_privileges
+from mailconfig import get_mail_password, get_mail_user_privileges, get_database_version
+from passwords import verify_password
 
 DEFAULT_KEY_PATH   = '/var/lib/mailinabox/api.key'
 DEFAULT_AUTH_REALM = 'Mail-in-a-Box Management Server'
 
+# Successful logins are remembered for this many seconds, for at most this
+# many email address and password pairs, so that a control panel that polls
+# the API doesn't check the same credentials against the database again and
+# again.
+CREDENTIALS_CACHE_TTL  = 60
+CREDENTIALS_CACHE_SIZE = 256
+
 class KeyAuthService:
 	"""Generate an API key for authenticating clients
 
@@ -19,6 +27,8 @@ class KeyAuthService:
 		self.auth_realm = DEFAULT_AUTH_REALM
 		self.key = self._generate_key()
 		self.key_path = DEFAULT_KEY_PATH
+		self.credentials_cache = OrderedDict()
+		self.credentials_cache_lock = threading.Lock()
 
 	def write_key(self):
 		"""Write key to file so authorized clients can get the key
@@ -88,6 +98,37 @@ class KeyAuthService:
 		if email == "" or pw == "":
 			raise ValueError("Enter an email address and password.")
 
+		# Use the privileges found the last time these credentials were
+		# checked, unless that was too long ago or the users database has
+		# been written to since, which may have changed the user's password
+		# or privileges. The password itself isn't kept, only an HMAC of it
+		# keyed with the API key.
+		cache_key = hmac.new(self.key.encode('ascii'),
+			email.encode("utf8") + b"\0" + pw.encode("utf8"), digestmod=hashlib.sha256).digest()
+		version = get_database_version(env)
+		now = time.monotonic()
+		with self.credentials_cache_lock:
+			cached = self.credentials_cache.get(cache_key)
+			if cached is not None:
+				expires, cached_version, privs = cached
+				if expires > now and cached_version == version:
+					self.credentials_cache.move_to_end(cache_key)
+					return list(privs)
+				del self.credentials_cache[cache_key]
+
+		privs = self.check_user_credentials(email, pw, env)
+
+		with self.credentials_cache_lock:
+			self.credentials_cache[cache_key] = (now + CREDENTIALS_CACHE_TTL, version, tuple(privs))
+			self.credentials_cache.move_to_end(cache_key)
+			while len(self.credentials_cache) > CREDENTIALS_CACHE_SIZE:
+				self.credentials_cache.popitem(last=False)
+
+		return privs
+
+	def check_user_credentials(self, email, pw, env):
+		# Check the credentials against the users database, without the cache.
+
 		# The password might be a user-specific API key. create_user_key raises
 		# a ValueError if the user does not exist.
 		if hmac.compare_digest(self.create_user_key(email, env), pw):
@@ -98,17 +139,9 @@ class KeyAuthService:
 			# email address does not correspond to a user.
 			pw_hash = get_mail_password(email, env)
 
-			# Authenticate.
-			try:
-				# Use 'doveadm pw' to check credentials. doveadm will return
-				# a non-zero exit status if the credentials are no good,
-				# and check_call will raise an exception in that case.
-				utils.shell('check_call', [
-					"/usr/bin/doveadm", "pw",
-					"-p", pw,
-					"-t", pw_hash,
-					])
-			except:
+			# Authenticate. The hash is checked in-process for the schemes
+			# we know, and by 'doveadm pw' otherwise.
+			if not verify_password(pw, pw_hash):
 				# Login failed.
 				raise ValueError("Invalid password.")
 
@@ -1,14 +1,16 @@
-import os, os.path, re, json, time
-import subprocess
+import os, os.path, re, json, time, uuid
+import subprocess, threading
+from collections import OrderedDict
 
 from functools import wraps
 
 from flask import Flask, request, render_template, abort, Response, send_from_directory, make_response
 
 import auth, utils, multiprocessing.pool
-from mailconfig import get_mail_users, get_mail_users_ex, get_admins, add_mail_user, set_mail_password, remove_mail_user
+from mailconfig import get_mail_users, get_mail_users_ex, get_admins, add_mail_user, add_mail_users, set_mail_password, remove_mail_user
 from mailconfig import get_mail_user_privileges, add_remove_mail_user_privilege
-from mailconfig import get_mail_aliases, get_mail_aliases_ex, get_mail_domains, add_mail_alias, remove_mail_alias
+from mailconfig import get_mail_aliases, get_mail_aliases_ex, get_mail_domains, add_mail_alias, add_mail_aliases, remove_mail_alias
+from mailconfig import close_database, kick
 
 env = utils.load_environment()
 
@@ -83,9 +85,32 @@ def authorized_personnel_only(viewfunc):
 def unauthorized(error):
 	return auth_service.make_unauthorized_response()
 
+@app.teardown_request
+def close_database_connections(exception):
+	# The connections to users.sqlite that the request opened are kept open
+	# for its duration and closed here.
+	close_database()
+
 def json_response(data):
 	return Response(json.dumps(data, indent=2, sort_keys=True)+'\n', status=200, mimetype='application/json')
 
+def read_records(fields):
+	# Reads the records of a bulk request from the request body, which is
+	# either a JSON list of objects or CSV with the fields in this order, one
+	# record per line. Blank lines and lines starting with # are skipped.
+	if request.is_json:
+		records = request.get_json(silent=True)
+		if not isinstance(records, list) or not all(isinstance(r, dict) for r in records):
+			raise ValueError("Expected a JSON list of objects.")
+		return records
+
+	import csv, io
+	return [
+		dict(zip(fields, (value.strip() for value in row)))
+		for row in csv.reader(io.StringIO(request.get_data(as_text=True)))
+		if row and not row[0].strip().startswith("#")
+		]
+
 ###################################
 
 # Control Panel (unauthenticated views)
@@ -140,6 +165,129 @@ def me():
 	# Return.
 	return json_response(resp)
 
+# MAIL CONFIGURATION UPDATES
+
+# After a change to the users or aliases, the DNS zones and the nginx
+# configuration are regenerated by kick(), which takes a while. So the change
+# is saved and the request returns, and a background thread runs kick() once
+# no change has come in for KICK_QUIET_PERIOD seconds, or once the oldest
+# change has waited KICK_MAX_DELAY seconds. A burst of changes then leads to
+# a single update. Each change gets a job whose status can be followed at
+# /mail/jobs. Until the update has been made, a file on disk records that
+# one is needed, so that the daemon makes it when it restarts.
+KICK_QUIET_PERIOD = 5 # seconds
+KICK_MAX_DELAY = 60 # seconds
+KICK_JOBS_KEPT = 100 # most recent jobs, for /mail/jobs
+KICK_PENDING_FILE = '/var/lib/mailinabox/mail_config_pending'
+kick_jobs = OrderedDict() # job id => job
+kick_pending = [] # jobs waiting for the next kick()
+kick_last_change = 0
+kick_condition = threading.Condition()
+kick_thread = None
+
+def queue_kick(change):
+	# Queues a kick() for a change described by the string and returns its job.
+	global kick_last_change, kick_thread
+	with kick_condition:
+		job = {
+			"id": uuid.uuid4().hex,
+			"change": change,
+			"status": "pending",
+			"submitted": time.time(),
+			"started": None,
+			"finished": None,
+			"result": None,
+			"coalesced": None, # number of changes the kick() covered
+		}
+		kick_jobs[job["id"]] = job
+		while len(kick_jobs) > KICK_JOBS_KEPT:
+			oldest = next(iter(kick_jobs.values()))
+			if oldest["status"] in ("pending", "running"): break
+			kick_jobs.popitem(last=False)
+		if not kick_pending:
+			set_kick_pending_file(True)
+		kick_pending.append(job)
+		kick_last_change = time.time()
+		if kick_thread is None:
+			kick_thread = threading.Thread(target=kick_worker, daemon=True)
+			kick_thread.start()
+		kick_condition.notify()
+	return job
+
+def kick_worker():
+	while True:
+		with kick_condition:
+			# Wait for a change, and then for the changes to stop.
+			while not kick_pending:
+				kick_condition.wait()
+			deadline = kick_pending[0]["submitted"] + KICK_MAX_DELAY
+			while time.time() < min(kick_last_change + KICK_QUIET_PERIOD, deadline):
+				kick_condition.wait(min(kick_last_change + KICK_QUIET_PERIOD, deadline) - time.time())
+			jobs = kick_pending[:]
+			del kick_pending[:]
+			started = time.time()
+			for job in jobs:
+				job["status"] = "running"
+				job["started"] = started
+
+		try:
+			result, status = kick(env), "done"
+		except Exception as e:
+			app.logger.exception("Updating the mail configuration failed.")
+			result, status = str(e), "failed"
+		finally:
+			close_database()
+
+		with kick_condition:
+			finished = time.time()
+			for job in jobs:
+				job["status"] = status
+				job["finished"] = finished
+				job["result"] = result
+				job["coalesced"] = len(jobs)
+			# A failed update is tried again when the daemon restarts.
+			if status == "done" and not kick_pending:
+				set_kick_pending_file(False)
+
+def set_kick_pending_file(pending):
+	try:
+		if pending:
+			with open(KICK_PENDING_FILE, "w"):
+				pass
+		elif os.path.exists(KICK_PENDING_FILE):
+			os.unlink(KICK_PENDING_FILE)
+	except OSError:
+		app.logger.exception("Could not record whether the mail configuration needs updating.")
+
+def kick_in_background(result):
+	# Takes what a mailconfig function returned when called with
+	# do_kick=False. An error is returned as it is. Otherwise the update is
+	# queued and the response says which job to follow.
+	if isinstance(result, tuple): return result
+	job = queue_kick(result)
+	return "%s\nThe DNS and web configuration will be updated in the background (job %s).\n" % (result, job["id"])
+
+def job_status(job):
+	# The job with how long it waited and ran, in seconds.
+	status = dict(job)
+	status["waited"] = (job["started"] or time.time()) - job["submitted"]
+	status["duration"] = (job["finished"] or time.time()) - job["started"] if job["started"] else None
+	return status
+
+@app.route('/mail/jobs')
+@authorized_personnel_only
+def mail_jobs():
+	with kick_condition:
+		return json_response([job_status(job) for job in reversed(kick_jobs.values())])
+
+@app.route('/mail/jobs/<job_id>')
+@authorized_personnel_only
+def mail_job(job_id):
+	with kick_condition:
+		if job_id not in kick_jobs:
+			return ("No such job.", 404)
+		return json_response(job_status(kick_jobs[job_id]))
+
 # MAIL
 
 @app.route('/mail/users')
@@ -154,9 +302,23 @@ def mail_users():
 @authorized_personnel_only
 def mail_users_add():
 	try:
-		return add_mail_user(request.form.get('email', ''), request.form.get('password', ''), request.form.get('privileges', ''), env)
+		return kick_in_background(add_mail_user(request.form.get('email', ''), request.form.get('password', ''), request.form.get('privileges', ''), env, do_kick=False))
+	except ValueError as e:
+		return (str(e), 400)
+
+@app.route('/mail/users/import', methods=['POST'])
+@authorized_personnel_only
+def mail_users_import():
+	# CSV lines are: email,password,privileges with the privileges separated
+	# by spaces.
+	try:
+		users = read_records(("email", "password", "privileges"))
 	except ValueError as e:
 		return (str(e), 400)
+	if not request.is_json:
+		for user in users:
+			user["privileges"] = "\n".join(user.get("privileges", "").split())
+	return kick_in_background(add_mail_users(users, env, do_kick=False))
 
 @app.route('/mail/users/password', methods=['POST'])
 @authorized_personnel_only
@@ -169,7 +331,7 @@ def mail_users_password():
 @app.route('/mail/users/remove', methods=['POST'])
 @authorized_personnel_only
 def mail_users_remove():
-	return remove_mail_user(request.form.get('email', ''), env)
+	return kick_in_background(remove_mail_user(request.form.get('email', ''), env, do_kick=False))
 
 
 @app.route('/mail/users/privileges')
@@ -201,18 +363,31 @@ def mail_aliases():
 @app.route('/mail/aliases/add', methods=['POST'])
 @authorized_personnel_only
 def mail_aliases_add():
-	return add_mail_alias(
+	return kick_in_background(add_mail_alias(
 		request.form.get('address', ''),
 		request.form.get('forwards_to', ''),
 		request.form.get('permitted_senders', ''),
 		env,
-		update_if_exists=(request.form.get('update_if_exists', '') == '1')
-		)
+		update_if_exists=(request.form.get('update_if_exists', '') == '1'),
+		do_kick=False
+		))
+
+@app.route('/mail/aliases/import', methods=['POST'])
+@authorized_personnel_only
+def mail_aliases_import():
+	# CSV lines are: address,forwards_to,permitted_senders with several
+	# addresses in a field separated by commas within quotes.
+	try:
+		aliases = read_records(("address", "forwards_to", "permitted_senders"))
+	except ValueError as e:
+		return (str(e), 400)
+	return kick_in_background(add_mail_aliases(aliases, env,
+		update_if_exists=(request.args.get('update_if_exists', '') == '1'), do_kick=False))
 
 @app.route('/mail/aliases/remove', methods=['POST'])
 @authorized_personnel_only
 def mail_aliases_remove():
-	return remove_mail_alias(request.form.get('address', ''), env)
+	return kick_in_background(remove_mail_alias(request.form.get('address', ''), env, do_kick=False))
 
 @app.route('/mail/domains')
 @authorized_personnel_only
@@ -520,6 +695,67 @@ def privacy_status_set():
 	utils.write_settings(config, env)
 	return "OK"
 
+# MAIL STATISTICS
+
+# Scanning the mail logs can take minutes on a busy box, so requests are served
+# from a cache and a background thread rescans the logs when it gets stale.
+MAIL_STATS_MAX_AGE = 10 * 60 # seconds
+mail_stats_cache = { } # timespan => (time scanned, stats)
+mail_stats_refreshing = set()
+mail_stats_lock = threading.Lock()
+mail_stats_scan_lock = threading.Lock() # mail_log keeps its settings in globals, so one scan at a time
+
+def refresh_mail_stats(timespan):
+	import mail_log
+	try:
+		with mail_stats_scan_lock:
+			stats = mail_log.get_mail_stats(env, timespan)
+		with mail_stats_lock:
+			mail_stats_cache[timespan] = (time.time(), stats)
+	except Exception:
+		app.logger.exception("Scanning the mail logs failed.")
+	finally:
+		# mail_log looks up the users and aliases in this thread.
+		close_database()
+		with mail_stats_lock:
+			mail_stats_refreshing.discard(timespan)
+
+def get_cached_mail_stats(timespan):
+	# Returns the cached (time scanned, stats) or None, and starts a rescan
+	# in the background if there's nothing cached or it is stale.
+	with mail_stats_lock:
+		cached = mail_stats_cache.get(timespan)
+		if (cached is None or time.time() - cached[0] > MAIL_STATS_MAX_AGE) \
+			and timespan not in mail_stats_refreshing:
+			mail_stats_refreshing.add(timespan)
+			threading.Thread(target=refresh_mail_stats, args=(timespan,), daemon=True).start()
+	return cached
+
+@app.route('/system/mail-stats')
+@authorized_personnel_only
+def mail_stats():
+	from mail_log import TIME_DELTAS, format_mail_stats_csv
+	timespan = request.args.get('timespan', 'week')
+	output_format = request.args.get('format', 'json')
+	if timespan not in TIME_DELTAS:
+		return ("Invalid timespan. Use one of: " + ", ".join(TIME_DELTAS), 400)
+	if output_format not in ("json", "csv"):
+		return ("Invalid format. Use json or csv.", 400)
+
+	cached = get_cached_mail_stats(timespan)
+	if cached is None:
+		# Not scanned yet, the client should try again later.
+		return ("The mail logs are being scanned, try again in a minute.", 202)
+
+	scanned, stats = cached
+	if output_format == "csv":
+		return Response(format_mail_stats_csv(stats), status=200, mimetype='text/csv')
+	return json_response({
+		"scanned": int(scanned),
+		"stale": time.time() - scanned > MAIL_STATS_MAX_AGE,
+		"stats": stats,
+	})
+
 # MUNIN
 
 @app.route('/munin/')
@@ -619,5 +855,9 @@ if __name__ == '__main__':
 	# debug console and enter that as the username
 	app.logger.info('API key: ' + auth_service.key)
 
+	# Make the update that was still pending when the daemon last stopped.
+	if os.path.exists(KICK_PENDING_FILE):
+		queue_kick("Mail users or aliases were changed before the management daemon restarted.")
+
 	# Start the application server. Listens on 127.0.0.1 (IPv4 only).
 	app.run(port=10222)
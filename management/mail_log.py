@@ -1,12 +1,30 @@
 #!/usr/local/lib/mailinabox/env/bin/python
 import argparse
+import array
+import base64
+import calendar
+import contextlib
+import csv
+import ctypes
+import ctypes.util
 import datetime
 import gzip
+import hashlib
+import heapq
+import io
+import json
+import multiprocessing.pool
+import operator
 import os.path
 import re
-import shutil
-import tempfile
+import select
+import sqlite3
+import subprocess
+import sys
 import textwrap
+import urllib.parse
+import urllib.request
+import zlib
 from collections import defaultdict, OrderedDict
 
 import dateutil.parser
@@ -14,7 +32,9 @@ import time
 
 from dateutil.relativedelta import relativedelta
 
+import sketches
 import utils
+from sketches import HyperLogLog, SpaceSaving
 
 
 LOG_FILES = (
@@ -50,536 +70,3302 @@ END_DATE = None
 
 VERBOSE = False
 
+# Output format of the report: "text" for tables, or "json" or "csv" for the collected data
+OUTPUT_FORMAT = "text"
+
+# Find the time span in uncompressed log files by binary search on the timestamps
+SEEK = False
+
+# Number of worker processes to scan the log files with in parallel
+JOBS = 1
+
 # List of strings to filter users with
 FILTERS = None
 
+# The rows of the report tables are sorted by "user", or by "count" with the highest counts first,
+# and only LIMIT rows (all when None) from OFFSET on are shown
+SORT = "user"
+LIMIT = None
+OFFSET = 0
+
+# Summarize the sending hosts, greylisted and blocked email in a fixed amount of memory per user,
+# see sketches.py for the error bounds
+APPROXIMATE = False
+
+# Set to a dict by enable_profiling, to count and time the lines by service, scanner and file
+PROFILE = None
+
+# Incremental scans keep the position in each log file and the data found so far per hour in a
+# checkpoint database, so that a next scan only has to parse the lines added since then.
+DEFAULT_CHECKPOINT_FILE = '/var/lib/mailinabox/mail_log_checkpoint.sqlite'
+CHECKPOINT_FILE = None  # Set to the checkpoint file to scan incrementally
+CHECKPOINT_RETENTION = datetime.timedelta(weeks=52)  # Keep data for the longest time span
+DELAY_DIGITS = 2  # Significant digits of the delivery delays kept in the checkpoint
+
+# The first and last timestamps of the compressed log files are kept in an index, so that files
+# outside of the time span can be skipped without decompressing them.
+ARCHIVE_INDEX_FILE = '/var/lib/mailinabox/mail_log_archives.json'
+
+# Ingesting rolls the counts per user and hour into a database under STORAGE_ROOT, which outlives
+# the rotated log files. Reports over any time span can then be made from the database.
+STATS_DATABASE = 'mail/mail_log.sqlite'
+FROM_DATABASE = False  # Set to report from the database instead of the log files
+
+# Where to read the log from: "files" for LOG_FILES, or "journal" for the systemd journal
+LOG_SOURCE = "files"
+
+# Reads the mail log entries in the systemd journal (syslog facility 2 is mail) as JSON
+JOURNALCTL = ("journalctl", "--output=json", "--no-pager", "SYSLOG_FACILITY=2")
+
+# Seconds to wait for a box to send its collector snapshot
+SNAPSHOT_TIMEOUT = 120
+
+# Following the log file refreshes the report at this interval, in seconds
+FOLLOW_INTERVAL = 10
+FOLLOW_POLL_INTERVAL = 1  # Check the log file for new lines this often when inotify isn't available
+# The inode and byte offset of the log file where following it starts. The scan of the time span
+# stops reading the file there, so that no line is scanned twice.
+FOLLOW_POSITION = None
+INOTIFY_EVENTS = 0x2 | 0x40 | 0x80 | 0x100 | 0x200  # IN_MODIFY, IN_MOVED_FROM/TO, IN_CREATE/DELETE
+
+# The anomaly detector alerts the administrator about users that send more email or log in from
+# more distinct IP addresses than this within the window, in seconds. The window is kept in
+# DETECT_BUCKETS buckets, and a user is alerted about at most once per window for each limit.
+DETECT_MAX_SENT = 200
+DETECT_MAX_LOGIN_IPS = 10
+DETECT_WINDOW = 60 * 60
+DETECT_BUCKETS = 60
+
 # What to show (with defaults)
 SCAN_OUT = True  # Outgoing email
 SCAN_IN = True  # Incoming email
 SCAN_DOVECOT_LOGIN = True  # Dovecot Logins
 SCAN_GREY = False  # Greylisted email
 SCAN_BLOCKED = False  # Rejected email
+SCAN_DELAYS = False  # Delivery delays
+SCAN_OUTBOUND = False  # Outbound deliveries
+SCAN_AUTH_FAILURES = False  # Failed logins
+
+# The settings above, which all_scanners_enabled turns on
+SCANNER_SETTINGS = ("SCAN_OUT", "SCAN_IN", "SCAN_DOVECOT_LOGIN", "SCAN_GREY", "SCAN_BLOCKED",
+                    "SCAN_DELAYS", "SCAN_OUTBOUND", "SCAN_AUTH_FAILURES")
+
+# Failed logins are counted per IP address in windows of the findtime of the dovecot and
+# miab-postfix587 fail2ban jails, to tell which addresses the jails ban at which maxretry
+AUTH_FAILURE_WINDOW = 30
+AUTH_FAILURE_MAXRETRY = (5, 10, 20, 50, 100)
+AUTH_FAILURE_TOP = 25  # Number of IP addresses and accounts to report
+
+# The lines of a message are joined by queue ID, for which the messages still being delivered are
+# kept. The least recently seen messages are forgotten when there are more than this.
+MESSAGE_TRACKING_SIZE = 10000
+
+# Log lines look like "<date> <host> <service>[<pid>]: <log message>", where the date is either in
+# the traditional syslog format ("Feb 15 12:34:56") or in RFC 3339 format with high precision
+# ("2020-02-15T12:34:56.123456+01:00")
+LOG_LINE = re.compile(r"(\w+[\s]+\d+ \d+:\d+:\d+|\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.\d+)?"
+                      r"(?:Z|[+-]\d\d:\d\d)?) ([\w]+ )?([\w\-/]+)[^:]*: (.*)")
+
+# The "<service>: <log message>" part of a log line, as made up from a journal entry
+LOG_MESSAGE = re.compile(r"([\w\-/]+)[^:]*: (.*)")
+
+MONTHS = {month: number for number, month in enumerate(
+    ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"), 1)}
+
+# Parsed dates by their text up to the second, since consecutive log lines mostly share them
+DATE_CACHE = {}
+DATE_CACHE_SIZE = 10000
+
+# Services that log nothing of interest. The dates of their lines are still checked against the
+# time span, which mostly takes a lookup in DATE_CACHE, so that a backward scan stops in time.
+IGNORED_SERVICES = frozenset((
+    "postfix/qmgr", "postfix/pickup", "postfix/cleanup", "postfix/scache", "spampd",
+    "postfix/anvil", "postfix/master", "opendkim", "postfix/tlsmgr", "anvil",
+))
+
+# Log messages of interest
+POSTGREY_LINE = re.compile(r"action=(greylist|pass), reason=(.*?), (?:delay=\d+, )?"
+                           r"client_name=(.*), client_address=(.*), sender=(.*), recipient=(.*)")
+SMTPD_REJECT_LINE = re.compile(r"NOQUEUE: reject: RCPT from .*?: (.*?); from=<(.*?)> to=<(.*?)>")
+SMTPD_REJECT_IP_BLOCKED = re.compile(r"Client host \[(.*?)\] blocked using zen.spamhaus.org; (.*)")
+SMTPD_REJECT_DOMAIN_BLOCKED = re.compile(r"Sender address \[.*@(.*)\] blocked using "
+                                         r"dbl.spamhaus.org; (.*)")
+DOVECOT_LOGIN_LINE = re.compile(r"Info: Login: user=<(.*?)>, method=PLAIN, rip=(.*?),")
+LMTP_LINE = re.compile(r"([A-Z0-9]+): to=<(\S+)>, .* Saved")
+SUBMISSION_LINE = re.compile(r"([A-Z0-9]+): client=(\S+), sasl_method=(PLAIN|LOGIN), "
+                             r"sasl_username=(\S+)")
+DELIVERY_LINE = re.compile(r"([A-Z0-9]+): to=<(\S*)>, .*?delay=([\d.]+), "
+                           r"delays=([\d.]+)/([\d.]+)/([\d.]+)/([\d.]+), dsn=(\S+), status=(\w+)")
+DOVECOT_AUTH_FAILED_LINE = re.compile(r"(?:Info: )?(?:Aborted login|Disconnected)[^(]*\(auth failed, "
+                                      r"(\d+) attempts(?: in \d+ secs)?\):(?: user=<(.*?)>,)?"
+                                      r"(?: method=\S+,)? rip=([^,]+),")
+SASL_FAILED_LINE = re.compile(r"warning: [^\[]*\[([^\]]+)\]: SASL \S+ authentication "
+                              r"(?:failed|aborted)(?:.*?sasl_username=(\S+))?")
+SMTP_RELAY = re.compile(r"relay=([^,\[]+)")
+SMTP_CONN_USE = re.compile(r", conn_use=\d+,")
+
+# Activity by hour of the day is counted in arrays of unsigned integers, one for every hour
+HISTOGRAM_TYPE = 'I'
+DELAY_TYPE = 'f'  # Delays in seconds, kept per email for the percentiles
+EMPTY_HISTOGRAM = array.array(HISTOGRAM_TYPE, [0]) * 24
+
+# The percentiles of the delivery delays to report, by label
+DELAY_PERCENTILES = OrderedDict([("p50", 50), ("p95", 95), ("p99", 99)])
+
+# The settings that worker processes scan the log files with
+WORKER_SETTINGS = ("START_DATE", "END_DATE", "VERBOSE", "SEEK", "FILTERS",
+                   "APPROXIMATE", "FOLLOW_POSITION") + SCANNER_SETTINGS
 
 
 def scan_files(collector):
     """ Scan files until they run out or the earliest date is reached """
 
-    stop_scan = False
+    index = load_archive_index()
 
-    for fn in LOG_FILES:
+    if JOBS > 1:
+        scan_files_parallel(collector, index)
+    else:
+        for fn in LOG_FILES:
+            if not os.path.exists(fn):
+                continue
+
+            first, last = get_archive_dates(fn, index)
+            if first is not None and first > START_DATE:
+                # The whole file is newer than the time span
+                continue
+            elif last is not None and last < END_DATE:
+                # The whole file, and so every older file, is older than the time span
+                break
+
+            archive_dates = {}
+            in_range = scan_file(fn, collector, archive_dates)
+            set_archive_dates(fn, index, archive_dates)
+
+            # Stop when the time span starts in this file, older files are out of range
+            if not in_range:
+                break
+
+    prune_archive_index(index)
+    save_archive_index(index)
+
+
+def scan_files_parallel(collector, index):
+    """ Scan every file in its own worker process and merge the collectors of the workers
+
+    Like the serial scan, the files older than the time span are left out: those whose timestamps
+    in the index, or whose modification time, are before it, and those older than a file the time
+    span starts in. The workers that are still scanning such files when that is found are stopped.
+
+    Collectors are passed back from the workers serialized, since not all of their contents can
+    be pickled.
+
+    """
 
-        tmp_file = None
+    settings = {name: globals()[name] for name in WORKER_SETTINGS}
+    files = []
 
+    for fn in LOG_FILES:
         if not os.path.exists(fn):
             continue
-        elif fn[-3:] == '.gz':
-            tmp_file = tempfile.NamedTemporaryFile()
-            shutil.copyfileobj(gzip.open(fn), tmp_file)
 
-        if VERBOSE:
-            print("Processing file", fn, "...")
-        fn = tmp_file.name if tmp_file else fn
-
-        for line in reverse_readline(fn):
-            if scan_mail_log_line(line.strip(), collector) is False:
-                if stop_scan:
-                    return
-                stop_scan = True
-            else:
-                stop_scan = False
+        first, last = get_archive_dates(fn, index)
+        if first is not None and first > START_DATE:
+            # The whole file is newer than the time span
+            continue
+        elif (last is not None and last < END_DATE) or \
+                datetime.datetime.fromtimestamp(os.stat(fn).st_mtime) < END_DATE:
+            # The whole file, and so every older file, is older than the time span
+            break
 
+        files.append(fn)
 
+        if first is not None and first < END_DATE:
+            # The time span starts in this file
+            break
 
-def scan_mail_log(env):
-    """ Scan the system's mail log files and collect interesting data
+    pool = multiprocessing.pool.Pool(processes=min(JOBS, len(files)) or 1,
+                                     initializer=init_worker, initargs=(settings,))
+    try:
+        results = [pool.apply_async(scan_file_in_worker, ((fn, collector["known_addresses"]),))
+                   for fn in files]
 
-    This function scans the 2 most recent mail log files in /var/log/.
+        # The results are taken newest file first, so that the files older than the one the time
+        # span starts in don't have to be waited for
+        for result in results:
+            fn, data, archive_dates, in_range = result.get()
+            merge_collectors(collector, deserialize_collector(data))
+            set_archive_dates(fn, index, archive_dates)
+            if not in_range:
+                break
+    finally:
+        pool.terminate()
+
+
+def init_worker(settings):
+    """ Set the settings of a worker process, which doesn't inherit them when it isn't forked """
+    globals().update(settings)
+
+
+def scan_file_in_worker(args):
+    """ Scan a single file into a new collector, and return the collector serialized """
+
+    fn, known_addresses = args
+    collector = new_collector()
+    collector["known_addresses"] = known_addresses
+    archive_dates = {}
+    in_range = scan_file(fn, collector, archive_dates)
+    return fn, serialize_collector(collector), archive_dates, in_range
+
+
+def scan_file(fn, collector, archive_dates=None):
+    """ Scan a file until it runs out or the earliest date is reached
+
+    Uncompressed files are read backwards, compressed files are read forwards while they are
+    decompressed.
 
     Args:
-        env (dict): Dictionary containing MiaB settings
+        fn (str): Path of the log file
+        collector (dict): Collector to add the data found to
+        archive_dates (dict): Set to the first and last timestamps found in compressed files
+
+    Returns:
+        bool: Whether the file starts after the beginning of the time span, so that older files
+        have to be scanned as well
 
     """
 
-    collector = {
-        "scan_count": 0,  # Number of lines scanned
-        "parse_count": 0,  # Number of lines parsed (i.e. that had their contents examined)
-        "scan_time": time.time(),  # The time in seconds the scan took
-        "sent_mail": OrderedDict(),  # Data about email sent by users
-        "received_mail": OrderedDict(),  # Data about email received by users
-        "logins": OrderedDict(),  # Data about login activity
-        "postgrey": {},  # Data about greylisting of email addresses
-        "rejected": OrderedDict(),  # Emails that were blocked
-        "known_addresses": None,  # Addresses handled by the Miab installation
-        "other-services": set(),
-    }
+    if fn[-3:] == '.gz':
+        return scan_archive(fn, collector, archive_dates)
+    elif SEEK:
+        return scan_file_range(fn, collector)
 
-    try:
-        import mailconfig
-        collector["known_addresses"] = (set(mailconfig.get_mail_users(env)) |
-                                        set(alias[0] for alias in mailconfig.get_mail_aliases(env)))
-    except ImportError:
-        pass
+    if VERBOSE:
+        print("Processing file", fn, "...")
 
-    print("Scanning logs from {:%Y-%m-%d %H:%M:%S} to {:%Y-%m-%d %H:%M:%S}".format(
-        END_DATE, START_DATE)
-    )
+    stop_scan = False
 
-    # Scan the lines in the log files until the date goes out of range
-    scan_files(collector)
+    for line in reverse_readline(fn, follow_offset(fn)):
+        if scan_mail_log_line(line.strip(), collector) is False:
+            if stop_scan:
+                return False
+            stop_scan = True
+        else:
+            stop_scan = False
 
-    if not collector["scan_count"]:
-        print("No log lines scanned...")
-        return
+    return True
 
-    collector["scan_time"] = time.time() - collector["scan_time"]
 
-    print("{scan_count} Log lines scanned, {parse_count} lines parsed in {scan_time:.2f} "
-          "seconds\n".format(**collector))
+def scan_archive(fn, collector, archive_dates=None):
+    """ Scan a compressed file forwards, decompressing it on the fly, until the latest date
 
-    # Print Sent Mail report
+    Args:
+        fn (str): Path of the compressed log file
+        collector (dict): Collector to add the data found to
+        archive_dates (dict): Set to the first and last timestamps found in the file, the last
+            one only if the whole file was read
 
-    if collector["sent_mail"]:
-        msg = "Sent email"
-        print_header(msg)
+    Returns:
+        bool: Whether the file starts after the beginning of the time span, so that older files
+        have to be scanned as well
 
-        data = OrderedDict(sorted(collector["sent_mail"].items(), key=email_sort))
+    """
 
-        print_user_table(
-            data.keys(),
-            data=[
-                ("sent", [u["sent_count"] for u in data.values()]),
-                ("hosts", [len(u["hosts"]) for u in data.values()]),
-            ],
-            sub_data=[
-                ("sending hosts", [u["hosts"] for u in data.values()]),
-            ],
-            activity=[
-                ("sent", [u["activity-by-hour"] for u in data.values()]),
-            ],
-            earliest=[u["earliest"] for u in data.values()],
-            latest=[u["latest"] for u in data.values()],
-        )
+    if VERBOSE:
+        print("Processing file", fn, "...")
 
-        accum = defaultdict(int)
-        data = collector["sent_mail"].values()
+    first = last = None
+    complete = True
 
-        for h in range(24):
-            accum[h] = sum(d["activity-by-hour"][h] for d in data)
+    for line, _ in forward_readline(fn):
+        entry = parse_mail_log_line(line.strip())
 
-        print_time_table(
-            ["sent"],
-            [accum]
-        )
+        if entry is None:
+            continue
 
-    # Print Received Mail report
+        date, service, log = entry
+        collector["scan_count"] += 1
 
-    if collector["received_mail"]:
-        msg = "Received email"
-        print_header(msg)
+        if first is None:
+            first = date
+        last = date
 
-        data = OrderedDict(sorted(collector["received_mail"].items(), key=email_sort))
+        # Check if the found date is within the time span we are scanning
+        if date < END_DATE:
+            continue
+        elif date > START_DATE:
+            complete = False
+            break
 
-        print_user_table(
-            data.keys(),
-            data=[
-                ("received", [u["received_count"] for u in data.values()]),
-            ],
-            activity=[
-                ("sent", [u["activity-by-hour"] for u in data.values()]),
-            ],
-            earliest=[u["earliest"] for u in data.values()],
-            latest=[u["latest"] for u in data.values()],
-        )
+        scan_mail_log_entry(date, service, log, collector)
 
-        accum = defaultdict(int)
-        for h in range(24):
-            accum[h] = sum(d["activity-by-hour"][h] for d in data.values())
+    if archive_dates is not None and first is not None:
+        archive_dates["first"] = str(first)
+        archive_dates["last"] = str(last) if complete else None
 
-        print_time_table(
-            ["received"],
-            [accum]
-        )
+    return first is None or first >= END_DATE
 
-    # Print login report
 
-    if collector["logins"]:
-        msg = "User logins per hour"
-        print_header(msg)
+def scan_file_range(fn, collector):
+    """ Scan the lines of an uncompressed log file that are within the time span
 
-        data = OrderedDict(sorted(collector["logins"].items(), key=email_sort))
+    The byte offsets of the start and end of the time span are found by binary search on the
+    timestamps, so only the lines in range are read.
 
-        # Get a list of all of the protocols seen in the logs in reverse count order.
-        all_protocols = defaultdict(int)
-        for u in data.values():
-            for protocol_name, count in u["totals_by_protocol"].items():
-                all_protocols[protocol_name] += count
-        all_protocols = [k for k, v in sorted(all_protocols.items(), key=lambda kv : -kv[1])]
+    Args:
+        fn (str): Path of the log file
+        collector (dict): Collector to add the data found to
 
-        print_user_table(
-            data.keys(),
-            data=[
-                (protocol_name, [
-                    round(u["totals_by_protocol"][protocol_name] / (u["latest"]-u["earliest"]).total_seconds() * 60*60, 1)
-                    if (u["latest"]-u["earliest"]).total_seconds() > 0
-                    else 0 # prevent division by zero
-                  for u in data.values()])
-                for protocol_name in all_protocols
-            ],
-            sub_data=[
-                ("Protocol and Source", [[
-                    "{} {}: {} times".format(protocol_name, host, count)
-                    for (protocol_name, host), count
-                    in sorted(u["totals_by_protocol_and_host"].items(), key=lambda kv:-kv[1])
-                  ] for u in data.values()])
-            ],
-            activity=[
-                (protocol_name, [u["activity-by-hour"][protocol_name] for u in data.values()])
-                for protocol_name in all_protocols
-            ],
-            earliest=[u["earliest"] for u in data.values()],
-            latest=[u["latest"] for u in data.values()],
-            numstr=lambda n : str(round(n, 1)),
-        )
+    Returns:
+        bool: Whether the file starts after the beginning of the time span, so that older files
+        have to be scanned as well
 
-        accum = { protocol_name: defaultdict(int) for protocol_name in all_protocols }
-        for h in range(24):
-            for protocol_name in all_protocols:
-              accum[protocol_name][h] = sum(d["activity-by-hour"][protocol_name][h] for d in data.values())
+    """
 
-        print_time_table(
-            all_protocols,
-            [accum[protocol_name] for protocol_name in all_protocols]
-        )
+    end = follow_offset(fn)
 
-    if collector["postgrey"]:
-        msg = "Greylisted Email {:%Y-%m-%d %H:%M:%S} and {:%Y-%m-%d %H:%M:%S}"
-        print_header(msg.format(END_DATE, START_DATE))
+    with open(fn, 'rb') as fh:
+        size = fh.seek(0, os.SEEK_END) if end is None else min(end, fh.seek(0, os.SEEK_END))
+        start = bisect_log_file(fh, size, lambda date: date >= END_DATE)
+        end = bisect_log_file(fh, size, lambda date: date > START_DATE)
 
-        print(textwrap.fill(
-            "The following mail was greylisted, meaning the emails were temporarily rejected. "
-            "Legitimate senders must try again after three minutes.",
-            width=80, initial_indent=" ", subsequent_indent=" "
-        ), end='\n\n')
+    if VERBOSE:
+        print("Processing file", fn, "from byte", start, "to", end, "...")
 
-        data = OrderedDict(sorted(collector["postgrey"].items(), key=email_sort))
-        users = []
-        received = []
-        senders = []
-        sender_clients = []
-        delivered_dates = []
+    for line in range_readline(fn, start, end):
+        scan_mail_log_line(line.strip(), collector)
 
-        for recipient in data:
-            sorted_recipients = sorted(data[recipient].items(), key=lambda kv: kv[1][0] or kv[1][1])
-            for (client_address, sender), (first_date, delivered_date) in sorted_recipients:
-                if first_date:
-                    users.append(recipient)
-                    received.append(first_date)
-                    senders.append(sender)
-                    delivered_dates.append(delivered_date)
-                    sender_clients.append(client_address)
+    return start == 0
 
-        print_user_table(
-            users,
-            data=[
-                ("received", received),
-                ("sender", senders),
-                ("delivered", [str(d) or "no retry yet" for d in delivered_dates]),
-                ("sending host", sender_clients)
-            ],
-            delimit=True,
-        )
 
-    if collector["rejected"]:
-        msg = "Blocked Email {:%Y-%m-%d %H:%M:%S} and {:%Y-%m-%d %H:%M:%S}"
-        print_header(msg.format(END_DATE, START_DATE))
+def range_readline(filename, start, end):
+    """ A generator that returns the lines of a file from byte offset start up to end """
 
-        data = OrderedDict(sorted(collector["rejected"].items(), key=email_sort))
+    with open(filename, 'rb') as fh:
+        fh.seek(start)
+        offset = start
+        for line in fh:
+            offset += len(line)
+            if offset > end:
+                break
+            yield line.decode('utf8', 'replace')
 
-        rejects = []
 
+def bisect_log_file(fh, size, predicate):
+    """ Find the byte offset of the first line in a log file with a date for which predicate holds
+
+    The dates in the log file are assumed to be in ascending order, so the lines for which the
+    predicate holds are found at the end of the file. Lines without a date are skipped.
+
+    """
+
+    lo, hi = 0, size
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+        date = first_date_at(fh, mid)[1]
+        if date is None or predicate(date):
+            hi = mid
+        else:
+            lo = mid + 1
+
+    return first_date_at(fh, lo)[0]
+
+
+def first_date_at(fh, offset):
+    """ Return the byte offset and date of the first line with a date starting at or after offset """
+
+    if offset == 0:
+        fh.seek(0)
+    else:
+        # Skip to the start of the next line, unless offset is at the start of a line already
+        fh.seek(offset - 1)
+        fh.readline()
+
+    while True:
+        offset = fh.tell()
+        line = fh.readline()
+        if not line:
+            return offset, None
+        entry = parse_mail_log_line(line.decode('utf8', 'replace').strip())
+        if entry is not None:
+            return offset, entry[0]
+
+
+def scan_incremental(collector):
+    """ Scan the lines added to the log files since the previous scan and fill the collector
+
+    The data found in the log files is kept in the checkpoint database per hour, together with the
+    inode, first line, byte offset and last timestamp of the files read. Only the hours that new
+    lines were found for are written, and only the hours within the time span are read. The data
+    of an hour is kept in the approximate mode, with the delivery delays rounded to DELAY_DIGITS
+    significant digits, so that it takes a bounded amount of space per user. The data in the
+    collector is accurate to the hour, i.e. the hours at the start and end of the time span are
+    included in full. The senders of the messages still being delivered are kept as well, so that
+    the delays of their deliveries in later hours or scans are added to them.
+
+    Args:
+        collector (dict): Collector to merge the data within the time span into, made in the
+            approximate mode
+
+    """
+
+    conn = open_checkpoint_database(CHECKPOINT_FILE)
+    try:
+        files = {
+            filename: {"inode": inode, "fingerprint": fingerprint, "offset": offset,
+                       "last_date": last_date}
+            for filename, inode, fingerprint, offset, last_date
+            in conn.execute("SELECT filename, inode, fingerprint, offset, last_date FROM files")
+        }
+        # Only the sender of a message is kept, the scans read forwards so that the deliveries of
+        # a message come after its sender is known
+        messages = OrderedDict(
+            (queue_id, {"sender": sender, "deliveries": []})
+            for queue_id, sender
+            in conn.execute("SELECT queue_id, sender FROM messages ORDER BY rowid"))
+
+        # Scan with all scanners enabled and without filters, so that the data in the checkpoint
+        # can be used for any report
+        hours = {}
+        with all_scanners_enabled():
+            files = scan_new_lines(files, hours, collector["known_addresses"], messages)
+
+        # Forget about the hours that no time span will ever go back to
+        oldest = (datetime.datetime.now() - CHECKPOINT_RETENTION).strftime("%Y-%m-%d %H")
+
+        with conn:
+            for hour, hour_collector in hours.items():
+                row = conn.execute("SELECT data FROM hours WHERE hour = ?", (hour,)).fetchone()
+                if row is not None:
+                    merge_collectors(hour_collector, deserialize_hour(hour, row[0]))
+                conn.execute("INSERT OR REPLACE INTO hours (hour, data) VALUES (?, ?)",
+                             (hour, serialize_hour(hour_collector)))
+
+            conn.execute("DELETE FROM hours WHERE hour < ?", (oldest,))
+
+            conn.execute("DELETE FROM files")
+            conn.executemany(
+                "INSERT INTO files (filename, inode, fingerprint, offset, last_date) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(filename, state["inode"], state["fingerprint"], state["offset"],
+                  state["last_date"]) for filename, state in files.items()])
+
+            conn.execute("DELETE FROM messages")
+            conn.executemany(
+                "INSERT INTO messages (queue_id, sender) VALUES (?, ?)",
+                [(queue_id, message["sender"]) for queue_id, message in messages.items()
+                 if message["sender"] is not None])
+
+        # Where to follow the journal from, see scan_new_journal_entries
+        if LOG_SOURCE == "journal" and "journal" in files:
+            collector["journal_cursor"] = files["journal"]["fingerprint"]
+
+        hours_in_range = (END_DATE.strftime("%Y-%m-%d %H"), START_DATE.strftime("%Y-%m-%d %H"))
+        for hour, data in conn.execute(
+                "SELECT hour, data FROM hours WHERE hour BETWEEN ? AND ? ORDER BY hour",
+                hours_in_range):
+            merge_collectors(collector, deserialize_hour(hour, data))
+    finally:
+        conn.close()
+
+    prune_collector(collector)
+
+
+def scan_new_lines(files, hours, known_addresses, messages):
+    """ Scan the log lines that were added since the previous scan into the collectors per hour
+
+    Args:
+        files (dict): Inode, byte offset and last timestamp of the files read by the previous scan
+        hours (dict): Collectors per hour to add the data found to
+        known_addresses (set): Addresses handled by the Miab installation
+        messages (OrderedDict): Messages being delivered by queue ID, shared by the hours
+
+    Returns:
+        dict: Inode, byte offset and last timestamp of the files read by this scan
+
+    """
+
+    if LOG_SOURCE == "journal":
+        return scan_new_journal_entries(files, hours, known_addresses, messages)
+
+    known_inodes = {state["inode"]: state for state in files.values()}
+    known_fingerprints = {state["fingerprint"]: state for state in files.values()
+                          if state["offset"]}
+    last_dates = [state["last_date"] for state in files.values() if state["last_date"]]
+    watermark = parse_timestamp(max(last_dates)) if last_dates else None
+
+    # Find the files to read, going back until the file the previous scan stopped in, which is
+    # continued from the byte offset where that scan stopped. Only when that file is not found
+    # (anymore), all lines newer than the last timestamp seen are scanned.
+    to_read = []
+    for fn in LOG_FILES:
+        if not os.path.exists(fn):
+            continue
+
+        stat = os.stat(fn)
+        fingerprint = file_fingerprint(fn)
+        state = known_inodes.get(stat.st_ino)
+
+        # Inodes get reused, so check that the file still starts with the same line and has not
+        # been truncated. A file that was compressed since has another inode, but starts with the
+        # same line, and its offsets count the decompressed bytes. Files that were empty can't be
+        # told apart that way.
+        if state is None or fn[-3:] == '.gz' or state["fingerprint"] != fingerprint or \
+                stat.st_size < state["offset"]:
+            state = known_fingerprints.get(fingerprint) if fn[-3:] == '.gz' else None
+
+        if state is not None:
+            to_read.append((fn, state["offset"], state["last_date"]))
+            watermark = None
+            break
+
+        to_read.append((fn, 0, None))
+
+    # Skip the compressed files that only have lines the previous scans have seen
+    if watermark is not None:
+        index = load_archive_index()
+        to_read = [(fn, offset, last_date) for fn, offset, last_date in to_read
+                   if (get_archive_dates(fn, index)[1] or datetime.datetime.max) > watermark]
+
+    new_files = {}
+    oldest = datetime.datetime.now() - CHECKPOINT_RETENTION
+
+    for fn, offset, last_date in reversed(to_read):
         if VERBOSE:
-            for user_data in data.values():
-                user_rejects = []
-                for date, sender, message in user_data["blocked"]:
-                    if len(sender) > 64:
-                        sender = sender[:32] + "…" + sender[-32:]
-                    user_rejects.append("%s - %s " % (date, sender))
-                    user_rejects.append("  %s" % message)
-                rejects.append(user_rejects)
+            print("Processing file", fn, "from byte", offset, "...")
 
-        print_user_table(
-            data.keys(),
-            data=[
-                ("blocked", [len(u["blocked"]) for u in data.values()]),
-            ],
-            sub_data=[
-                ("blocked emails", rejects),
-            ],
-            earliest=[u["earliest"] for u in data.values()],
-            latest=[u["latest"] for u in data.values()],
-        )
+        for entry, offset in file_entries(fn, offset, follow_offset(fn)):
+            date = entry[0]
 
-    if collector["other-services"] and VERBOSE and False:
-        print_header("Other services")
-        print("The following unkown services were found in the log file.")
-        print(" ", *sorted(list(collector["other-services"])), sep='\n│ ')
+            if (watermark is not None and date <= watermark) or date < oldest:
+                continue
 
+            add_to_hours(entry, hours, known_addresses, messages)
+            last_date = str(date)
 
-def scan_mail_log_line(line, collector):
-    """ Scan a log line and extract interesting data """
+        if fn[-3:] != '.gz':
+            new_files[fn] = {
+                "inode": os.stat(fn).st_ino,
+                "fingerprint": file_fingerprint(fn),
+                "offset": offset,
+                "last_date": last_date,
+            }
 
-    m = re.match(r"(\w+[\s]+\d+ \d+:\d+:\d+) ([\w]+ )?([\w\-/]+)[^:]*: (.*)", line)
+    # Keep the position in the files that were not read if they can still be continued
+    return new_files or files
 
-    if not m:
-        return True
 
-    date, system, service, log = m.groups()
-    collector["scan_count"] += 1
+def ingest_mail_log(env):
+    """ Roll the counts per user and hour of the log lines added since the previous ingest into
+    the database
+
+    The position in each log file is kept in the database, the same way the checkpoint file does
+    for incremental scans, and the counts are added to the counts already in the database within
+    a single transaction.
+
+    Args:
+        env (dict): Dictionary containing MiaB settings
+
+    Returns:
+        int: Number of log lines scanned
+
+    """
+
+    conn = open_stats_database(env)
+    try:
+        files = {
+            filename: {"inode": inode, "fingerprint": fingerprint, "offset": offset,
+                       "last_date": last_date}
+            for filename, inode, fingerprint, offset, last_date
+            in conn.execute("SELECT filename, inode, fingerprint, offset, last_date FROM files")
+        }
+
+        hours = {}
+        with all_scanners_enabled():
+            # The database holds no delays, so the messages being delivered aren't kept
+            files = scan_new_lines(files, hours, load_known_addresses(env), OrderedDict())
+
+        with conn:
+            for hour, collector in hours.items():
+                for user, kind, count in hourly_counts(collector):
+                    cursor = conn.execute(
+                        "UPDATE hourly SET count = count + ? WHERE hour = ? AND user = ? AND kind = ?",
+                        (count, hour, user, kind))
+                    if cursor.rowcount == 0:
+                        conn.execute("INSERT INTO hourly (hour, user, kind, count) VALUES (?, ?, ?, ?)",
+                                     (hour, user, kind, count))
+
+            conn.execute("DELETE FROM files")
+            conn.executemany(
+                "INSERT INTO files (filename, inode, fingerprint, offset, last_date) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(filename, state["inode"], state["fingerprint"], state["offset"],
+                  state["last_date"]) for filename, state in files.items()])
+    finally:
+        conn.close()
+
+    return sum(collector["scan_count"] for collector in hours.values())
+
+
+def open_stats_database(env):
+    """ Open the database with the counts per user and hour, creating it when needed """
+
+    conn = sqlite3.connect(os.path.join(env["STORAGE_ROOT"], STATS_DATABASE))
+    conn.execute("CREATE TABLE IF NOT EXISTS hourly (hour TEXT NOT NULL, user TEXT NOT NULL, "
+                 "kind TEXT NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (hour, user, kind))")
+    conn.execute("CREATE TABLE IF NOT EXISTS files (filename TEXT NOT NULL PRIMARY KEY, "
+                 "inode INTEGER, fingerprint TEXT, offset INTEGER, last_date TEXT)")
+    return conn
+
+
+def hourly_counts(collector):
+    """ Yield the counts in the collector of an hour as (user, kind, count)
+
+    The kinds are sent, received, login:<protocol>, greylisted and blocked.
+
+    """
+
+    for user, data in collector["sent_mail"].items():
+        yield user, "sent", data["sent_count"]
+
+    for user, data in collector["received_mail"].items():
+        yield user, "received", data["received_count"]
+
+    for user, data in collector["logins"].items():
+        for protocol_name, count in data["totals_by_protocol"].items():
+            yield user, "login:" + protocol_name, count
+
+    for user, data in collector["postgrey"].items():
+        count = sum(1 for first_date, _ in data.values() if first_date)
+        if count:
+            yield user, "greylisted", count
+
+    for user, data in collector["rejected"].items():
+        yield user, "blocked", len(data["blocked"])
+
+
+def query_stats_database(env):
+    """ Get the counts per user and kind within the time span from the database
+
+    Returns:
+        dict: For each user and kind, the count, first and last hour and the counts by time of day
+
+    """
+
+    users = defaultdict(dict)
+    hours = (END_DATE.strftime("%Y-%m-%d %H"), START_DATE.strftime("%Y-%m-%d %H"))
+
+    conn = open_stats_database(env)
+    try:
+        # The range is on the first column of the primary key, so this doesn't read the whole table
+        rows = conn.execute(
+            "SELECT user, kind, CAST(substr(hour, 12, 2) AS INTEGER), SUM(count), MIN(hour), "
+            "MAX(hour) FROM hourly WHERE hour BETWEEN ? AND ? GROUP BY user, kind, 3", hours)
+
+        for user, kind, hour_of_day, count, first_hour, last_hour in rows:
+            if not user_match(user):
+                continue
+
+            data = users[user].get(kind)
+            if data is None:
+                data = users[user][kind] = {
+                    "count": 0,
+                    "earliest": None,
+                    "latest": None,
+                    "activity-by-hour": new_histogram(),
+                }
+
+            data["count"] += count
+            data["activity-by-hour"][hour_of_day] += count
+            data["earliest"] = min(data["earliest"] or first_hour, first_hour)
+            data["latest"] = max(data["latest"] or last_hour, last_hour)
+    finally:
+        conn.close()
+
+    return users
+
+
+def report_from_database(env):
+    """ Print the counts per user within the time span from the database
+
+    Args:
+        env (dict): Dictionary containing MiaB settings
+
+    """
+
+    info = sys.stdout if OUTPUT_FORMAT == "text" else sys.stderr
+
+    print("Reporting from the database from {:%Y-%m-%d %H}:00 to {:%Y-%m-%d %H}:59".format(
+        END_DATE, START_DATE), file=info
+    )
+
+    users = query_stats_database(env)
+
+    # Only show what was asked for
+    kinds = sorted(set(kind for data in users.values() for kind in data if
+                       (kind == "sent" and SCAN_OUT) or (kind == "received" and SCAN_IN) or
+                       (kind.startswith("login:") and SCAN_DOVECOT_LOGIN) or
+                       (kind == "greylisted" and SCAN_GREY) or (kind == "blocked" and SCAN_BLOCKED)))
+
+    if OUTPUT_FORMAT == "json":
+        print(json.dumps({
+            "from": END_DATE.strftime("%Y-%m-%d %H"),
+            "to": START_DATE.strftime("%Y-%m-%d %H"),
+            "users": {user: {kind: dict(data[kind],
+                                        **{"activity-by-hour": list(data[kind]["activity-by-hour"])})
+                             for kind in kinds if kind in data}
+                      for user, data in users.items()},
+        }, indent=2, sort_keys=True))
+        return
+
+    if OUTPUT_FORMAT == "csv":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["section", "user", "detail", "count", "hosts", "earliest", "latest"] +
+                        ["hour %d" % h for h in range(24)])
+        for user, data in sorted(users.items(), key=email_sort):
+            for kind in kinds:
+                if kind in data:
+                    section, _, detail = kind.partition(":")
+                    writer.writerow([section + "s" if detail else section, user, detail,
+                                     data[kind]["count"], "", data[kind]["earliest"],
+                                     data[kind]["latest"]] + list(data[kind]["activity-by-hour"]))
+        return
+
+    if not users:
+        print("No data in the database for this time span...")
+        return
+
+    data = OrderedDict(select_rows(users.items(), lambda u: sum(d["count"] for d in u.values())))
+    no_data = {"count": 0, "activity-by-hour": EMPTY_HISTOGRAM}
+
+    first_hours = [min(d["earliest"] for d in u.values()) for u in data.values()]
+    last_hours = [max(d["latest"] for d in u.values()) for u in data.values()]
+
+    print_user_table(
+        data.keys(),
+        data=[(kind, [u.get(kind, no_data)["count"] for u in data.values()]) for kind in kinds],
+        activity=[(kind, [u.get(kind, no_data)["activity-by-hour"] for u in data.values()])
+                  for kind in kinds],
+        earliest=[parse_timestamp(h + ":00:00") for h in first_hours],
+        latest=[parse_timestamp(h + ":59:59") for h in last_hours],
+        selected_from=len(users),
+    )
+
+    print_time_table(
+        list(kinds),
+        [sum_histograms(u.get(kind, no_data)["activity-by-hour"] for u in users.values())
+         for kind in kinds]
+    )
+
+
+def follow_mail_log(env, report=True, detector=None):
+    """ Follow the mail log file like tail -F does, and print the report every FOLLOW_INTERVAL
+    seconds
+
+    The time span is scanned first, after which the lines appended to the log file are scanned as
+    they come in. The log directory is watched with inotify to wake up on new lines and log
+    rotation. Without inotify, the log file is polled.
+
+    Args:
+        env (dict): Dictionary containing MiaB settings
+        report (bool): Whether to print the report
+        detector (AnomalyDetector): Detector to pass the sent email and logins of the new lines to
+
+    """
+
+    global FOLLOW_POSITION
+
+    # Lines written while the time span is scanned are left to following the log file
+    fh = None
+    if LOG_SOURCE != "journal":
+        fh = open_log_file(LOG_FILES[0], seek_end=True)
+        if fh is not None:
+            FOLLOW_POSITION = (os.fstat(fh.fileno()).st_ino, fh.tell())
+
+    collector = collect_mail_log(env)
+
+    # Only the lines that come in are checked for anomalies, the time span was scanned backwards
+    collector["detector"] = detector
+
+    try:
+        if LOG_SOURCE == "journal":
+            follow_journal(collector, report)
+        else:
+            follow_log_file(LOG_FILES[0], fh, collector, report)
+    except KeyboardInterrupt:
+        pass
+
+
+def follow_journal(collector, report):
+    """ Follow the systemd journal for new entries, printing the report when it changed and the
+    interval has passed
+
+    The journal is continued after the last entry the scan of the time span read, so that the
+    entries logged in the same second as it stopped aren't scanned twice.
+
+    """
+
+    global START_DATE
+
+    next_report = time.time()
+
+    if collector["journal_cursor"] is not None:
+        entries = journal_entries(after_cursor=collector["journal_cursor"], follow=True)
+    else:
+        # The scan found no entries, none of those up to now are of interest
+        entries = journal_entries(since=START_DATE, follow=True)
+
+    for (date, service, log), _ in entries:
+        collector["scan_count"] += 1
+        scan_mail_log_entry(date, service, log, collector)
+
+        now = time.time()
+        if now >= next_report:
+            START_DATE = datetime.datetime.now()
+            if report:
+                print_follow_report(collector)
+            next_report = now + FOLLOW_INTERVAL
+
+
+def follow_log_file(fn, fh, collector, report):
+    """ Follow a log file from the position of the open file, or from the start of the file if it
+    wasn't there yet, printing the report every FOLLOW_INTERVAL seconds """
+
+    global START_DATE
+
+    partial = b''
+
+    watch = inotify_watch(os.path.dirname(fn))
+    if watch is None and VERBOSE:
+        print("inotify is not available, polling the log file", file=sys.stderr)
+
+    next_report = time.time()
+
+    try:
+        while True:
+            if fh is not None:
+                # Complete lines are scanned, the rest of the last line is kept for the next read
+                lines = (partial + fh.read()).split(b'\n')
+                partial = lines.pop()
+
+                for line in lines:
+                    entry = parse_mail_log_line(line.decode('utf8', 'replace').strip())
+                    if entry is not None:
+                        collector["scan_count"] += 1
+                        scan_mail_log_entry(*entry, collector)
+
+            # Reopen the log file when it was rotated or truncated. The lines still in the old
+            # file were read just now.
+            if fh is None or log_file_replaced(fn, fh):
+                if fh is not None:
+                    fh.close()
+                fh = open_log_file(fn)
+                partial = b''
+                if fh is not None:
+                    continue
+
+            now = time.time()
+            if now >= next_report:
+                START_DATE = datetime.datetime.now()
+                if report:
+                    print_follow_report(collector)
+                next_report = now + FOLLOW_INTERVAL
+
+            wait_for_log_change(watch, min(next_report - now, FOLLOW_INTERVAL))
+    finally:
+        if fh is not None:
+            fh.close()
+        if watch is not None:
+            os.close(watch)
+
+
+class AnomalyDetector:
+    """ Detects users that send a lot of email or log in from many IP addresses, which suggests
+    that their account was compromised
+
+    The email sent per user is counted in a ring of DETECT_BUCKETS buckets covering the window,
+    and the IP addresses a user logged in from are kept in the order they were last seen, so that
+    the ones that fell out of the window are dropped from the front. Both take constant time per
+    event. The administrator is alerted with email_administrator.py.
+
+    """
+
+    def __init__(self, max_sent=DETECT_MAX_SENT, max_login_ips=DETECT_MAX_LOGIN_IPS,
+                 window=DETECT_WINDOW, alert=None):
+        self.max_sent = max_sent
+        self.max_login_ips = max_login_ips
+        self.window = window
+        self.bucket_size = window / DETECT_BUCKETS
+        self.alert = alert or alert_administrator
+        self.sent = {}  # user => [counts per bucket, total, index of the current bucket]
+        self.login_ips = {}  # user => OrderedDict of IP address => time last seen
+        self.alerted = {}  # (user, limit) => time of the alert
+
+    def add_sent(self, user, date):
+        """ Count an email sent by the user """
+
+        now = date.timestamp()
+        bucket = int(now // self.bucket_size)
+
+        ring = self.sent.get(user)
+        if ring is None:
+            ring = self.sent[user] = [array.array('I', [0]) * DETECT_BUCKETS, 0, bucket]
+
+        counts, total, current = ring
+
+        # Empty the buckets that fell out of the window since the previous email
+        for expired in range(current + 1, min(bucket, current + DETECT_BUCKETS) + 1):
+            total -= counts[expired % DETECT_BUCKETS]
+            counts[expired % DETECT_BUCKETS] = 0
+
+        if bucket >= current:
+            counts[bucket % DETECT_BUCKETS] += 1
+            ring[1:] = total + 1, bucket
+
+        if ring[1] > self.max_sent:
+            self.check_alert(user, "sent", now, "{} sent {} emails in the last {} minutes, more "
+                             "than the limit of {}.".format(user, ring[1], self.window // 60,
+                                                            self.max_sent))
+
+    def add_login(self, user, date, host):
+        """ Note a login by the user from a host, given as the IP address or as name[address] """
+
+        now = date.timestamp()
+        ip = host.rpartition("[")[2].rstrip("]")
+
+        ips = self.login_ips.get(user)
+        if ips is None:
+            ips = self.login_ips[user] = OrderedDict()
+
+        ips[ip] = now
+        ips.move_to_end(ip)
+
+        # Forget the addresses that weren't seen within the window
+        while next(iter(ips.values())) < now - self.window:
+            ips.popitem(last=False)
+
+        if len(ips) > self.max_login_ips:
+            self.check_alert(user, "login_ips", now, "{} logged in from {} different IP addresses "
+                             "in the last {} minutes, more than the limit of {}:\n\n{}".format(
+                                 user, len(ips), self.window // 60, self.max_login_ips,
+                                 "\n".join(ips)))
+
+    def check_alert(self, user, limit, now, message):
+        """ Alert about a user going over a limit, unless that was done within the window """
+
+        if now - self.alerted.get((user, limit), -self.window) < self.window:
+            return
+
+        self.alerted[(user, limit)] = now
+        self.alert("Possibly compromised account " + user, message + "\n\nIf this isn't "
+                   "expected, the password of the account may have been stolen. Consider "
+                   "changing it.")
+
+
+def alert_administrator(subject, message):
+    """ Mail an alert to the administrator with email_administrator.py, and print it """
+
+    print("{:%Y-%m-%d %H:%M:%S} {}: {}".format(datetime.datetime.now(), subject, message),
+          file=sys.stderr)
+
+    try:
+        subprocess.run([os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     "email_administrator.py"), subject],
+                       input=message, universal_newlines=True, timeout=60, check=True)
+    except (OSError, subprocess.SubprocessError) as e:
+        print("Mailing the alert to the administrator failed:", e, file=sys.stderr)
+
+
+def open_log_file(fn, seek_end=False):
+    """ Open a log file for following, or return None when it doesn't exist (yet) """
+
+    try:
+        fh = open(fn, 'rb')
+    except FileNotFoundError:
+        return None
+
+    if seek_end:
+        fh.seek(0, os.SEEK_END)
+    return fh
+
+
+def log_file_replaced(fn, fh):
+    """ Whether the followed log file was rotated away or truncated """
+
+    try:
+        stat = os.stat(fn)
+    except FileNotFoundError:
+        return True
+
+    return stat.st_ino != os.fstat(fh.fileno()).st_ino or stat.st_size < fh.tell()
+
+
+def inotify_watch(path):
+    """ Watch a directory for changes with inotify
+
+    Returns:
+        int: The inotify file descriptor, or None when inotify isn't available
+
+    """
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+
+    if fd < 0:
+        return None
+
+    if libc.inotify_add_watch(fd, os.fsencode(path), INOTIFY_EVENTS) < 0:
+        os.close(fd)
+        return None
+
+    return fd
+
+
+def wait_for_log_change(watch, timeout):
+    """ Wait until the log directory changes or the timeout (in seconds) passes
+
+    The inotify events are only used to wake up, so they are read and discarded.
+
+    """
+
+    if watch is None:
+        time.sleep(min(timeout, FOLLOW_POLL_INTERVAL))
+    elif select.select([watch], [], [], max(timeout, 0))[0]:
+        os.read(watch, 65536)
+
+
+def load_known_addresses(env):
+    """ Get the addresses handled by the Miab installation, or None when mailconfig isn't available
+    """
+
+    try:
+        import mailconfig
+        return (set(mailconfig.get_mail_users(env)) |
+                set(alias[0] for alias in mailconfig.get_mail_aliases(env)))
+    except ImportError:
+        return None
+
+
+def scan_new_journal_entries(files, hours, known_addresses, messages):
+    """ Scan the journal entries that were added since the previous scan into the collectors per
+    hour
+
+    The journal is continued after the cursor of the last entry scanned, which is kept as the
+    fingerprint of a "journal" file, so the checkpoint file and the database need no changes.
+
+    Args:
+        files (dict): Position in the journal of the previous scan
+        hours (dict): Collectors per hour to add the data found to
+        known_addresses (set): Addresses handled by the Miab installation
+        messages (OrderedDict): Messages being delivered by queue ID, shared by the hours
+
+    Returns:
+        dict: Position in the journal of this scan
+
+    """
+
+    state = files.get("journal")
+    cursor = state["fingerprint"] if state else None
+    since = None
+
+    # Without a cursor, e.g. when switching over from the log files, continue from the last
+    # timestamp seen
+    if cursor is None:
+        last_dates = [state["last_date"] for state in files.values() if state["last_date"]]
+        since = (parse_timestamp(max(last_dates)) if last_dates
+                 else datetime.datetime.now() - CHECKPOINT_RETENTION)
+
+    last_date = None
+
+    for entry, cursor in journal_entries(since=since, after_cursor=cursor):
+        add_to_hours(entry, hours, known_addresses, messages)
+        last_date = entry[0]
+
+    if last_date is None:
+        return files
+
+    return {
+        "journal": {
+            "inode": None,
+            "fingerprint": cursor,
+            "offset": None,
+            "last_date": str(last_date),
+        }
+    }
+
+
+def add_to_hours(entry, hours, known_addresses, messages):
+    """ Scan a log entry into the collector of its hour
+
+    The lines of a message can be in different hours, so the hours share the messages being
+    delivered.
+
+    """
+
+    date, service, log = entry
+    hour = date.strftime("%Y-%m-%d %H")
+
+    if hour not in hours:
+        hours[hour] = new_collector()
+        hours[hour]["known_addresses"] = known_addresses
+
+    hours[hour]["messages"] = messages
+
+    hours[hour]["scan_count"] += 1
+    scan_mail_log_entry(date, service, log, hours[hour])
+
+
+def scan_journal(collector):
+    """ Scan the entries in the systemd journal within the time span
+
+    The journal is indexed by time, so journalctl finds the start of the time span without reading
+    the entries before it.
+
+    """
+
+    for (date, service, log), cursor in journal_entries(since=END_DATE, until=START_DATE):
+        collector["scan_count"] += 1
+        scan_mail_log_entry(date, service, log, collector)
+        collector["journal_cursor"] = cursor
+
+
+def collect_mail_log(env):
+    """ Scan the system's mail log files into a new collector
+
+    Args:
+        env (dict): Dictionary containing MiaB settings
+
+    Returns:
+        dict: The collector
+
+    """
+
+    collector = new_collector()
+    collector["known_addresses"] = load_known_addresses(env)
+
+    if CHECKPOINT_FILE:
+        # Only scan the new lines, and get the rest from the checkpoint
+        scan_incremental(collector)
+    elif LOG_SOURCE == "journal":
+        scan_journal(collector)
+    else:
+        # Scan the lines in the log files until the date goes out of range
+        scan_files(collector)
+
+    collector["scan_time"] = time.time() - collector["scan_time"]
+
+    return collector
+
+
+def get_mail_stats(env, timespan, start_date=None):
+    """ Scan the system's mail log files with all scanners enabled, for the management daemon
+
+    Args:
+        env (dict): Dictionary containing MiaB settings
+        timespan (str): Time span to scan, one of TIME_DELTAS
+        start_date (datetime): Date and time to start scanning from, defaults to now
+
+    Returns:
+        dict: The collected data in plain JSON types, see get_collector_stats
+
+    """
+
+    global START_DATE, END_DATE
+
+    START_DATE = start_date or datetime.datetime.now()
+    if timespan == 'today':
+        # TIME_DELTAS['today'] only holds on the day the module was imported
+        END_DATE = START_DATE.replace(hour=0, minute=0, second=0, microsecond=0)
+    else:
+        END_DATE = START_DATE - TIME_DELTAS[timespan]
+
+    with all_scanners_enabled():
+        return get_collector_stats(collect_mail_log(env))
+
+
+def get_collector_stats(collector):
+    """ Return the data in a collector, and the time span it was collected over, in plain JSON types
+    """
+
+    stats = serialize_collector(collector)
+    stats["from"] = str(END_DATE.replace(microsecond=0))
+    stats["to"] = str(START_DATE.replace(microsecond=0))
+    stats["scan_time"] = round(collector["scan_time"], 2)
+    stats["approximate"] = APPROXIMATE
+    return stats
+
+
+def load_snapshot(source):
+    """ Load the collected data of a box, as output with --format json or served by the management
+    daemon at /system/mail-stats
+
+    Args:
+        source (str): A file, which may be gzipped, "-" for standard input, or the URL of the
+            daemon, e.g. https://<api key>@box.example.com/admin/system/mail-stats?timespan=week
+
+    Returns:
+        dict: The collected data in plain JSON types, see get_collector_stats
+
+    """
+
+    if source == "-":
+        data = json.load(sys.stdin)
+    elif source.startswith(("http://", "https://")):
+        url = urllib.parse.urlsplit(source)
+        netloc = url.hostname + (":{}".format(url.port) if url.port else "")
+        request = urllib.request.Request(url._replace(netloc=netloc).geturl())
+
+        # The daemon takes an API key, or an email address and password, as basic authentication
+        if url.username is not None:
+            credentials = "{}:{}".format(urllib.parse.unquote(url.username),
+                                         urllib.parse.unquote(url.password or ""))
+            request.add_header("Authorization", "Basic " + base64.b64encode(
+                credentials.encode("utf8")).decode("ascii"))
+
+        with urllib.request.urlopen(request, timeout=SNAPSHOT_TIMEOUT) as response:
+            if response.status == 202:
+                raise ValueError("{} is still scanning its mail logs, try again in a "
+                                 "minute".format(netloc))
+            data = json.load(response)
+
+        # The daemon adds when the data was collected
+        data = data["stats"]
+    else:
+        with (gzip.open(source, "rt") if source.endswith(".gz") else open(source)) as f:
+            data = json.load(f)
+
+    if "scan_count" not in data or "from" not in data:
+        raise ValueError("{} doesn't hold collected data".format(source))
+
+    return data
+
+
+def merge_snapshots(sources):
+    """ Merge the collected data of several boxes into a single collector
+
+    The time span becomes the one covering all the snapshots. Snapshots of the approximate mode
+    can only be merged with each other, and set APPROXIMATE so that they are read as such.
+
+    Args:
+        sources (list): Files or URLs of the snapshots, see load_snapshot
+
+    Returns:
+        dict: The collector
+
+    """
+
+    global START_DATE, END_DATE, APPROXIMATE
+
+    collector = None
+    dates = []
+
+    for i, source in enumerate(sources):
+        data = load_snapshot(source)
+        approximate = data.get("approximate", False)
+
+        if i == 0:
+            # The collector is made once the mode is known, its structures depend on it
+            APPROXIMATE = approximate
+            collector = new_collector()
+            collector["scan_time"] = 0
+        elif approximate != APPROXIMATE:
+            raise ValueError("{} was collected in {} mode and can't be merged with {}".format(
+                source, "the approximate" if approximate else "the exact", sources[0]))
+
+        merge_collectors(collector, deserialize_collector(data))
+        collector["scan_time"] += data["scan_time"]
+        dates.append((parse_timestamp(data["from"]), parse_timestamp(data["to"])))
+
+    END_DATE = min(start for start, _ in dates)
+    START_DATE = max(end for _, end in dates)
+
+    return collector
+
+
+def report_snapshots(sources):
+    """ Print the report over the merged collected data of several boxes
+
+    Args:
+        sources (list): Files or URLs of the snapshots, see load_snapshot
+
+    """
+
+    info = sys.stdout if OUTPUT_FORMAT == "text" else sys.stderr
+
+    collector = merge_snapshots(sources)
+
+    # The snapshots have all data, only show what was asked for
+    prune_collector(collector)
+
+    print("Merged {} snapshots from {:%Y-%m-%d %H:%M:%S} to {:%Y-%m-%d %H:%M:%S}".format(
+        len(sources), END_DATE, START_DATE), file=info
+    )
+
+    if OUTPUT_FORMAT != "text":
+        # The merged data is a snapshot itself, that can be merged again
+        print_mail_stats(get_collector_stats(collector), OUTPUT_FORMAT)
+        return
+
+    print("{scan_count} Log lines scanned, {parse_count} lines parsed in {scan_time:.2f} "
+          "seconds\n".format(**collector))
+
+    print_mail_log_report(collector)
+
+
+def scan_mail_log(env):
+    """ Scan the system's mail log files and collect interesting data
+
+    This function scans the 2 most recent mail log files in /var/log/.
+
+    Args:
+        env (dict): Dictionary containing MiaB settings
+
+    """
+
+    if FROM_DATABASE:
+        report_from_database(env)
+        return
+
+    # Keep stdout clean for the collected data
+    info = sys.stdout if OUTPUT_FORMAT == "text" else sys.stderr
+
+    print("Scanning logs from {:%Y-%m-%d %H:%M:%S} to {:%Y-%m-%d %H:%M:%S}".format(
+        END_DATE, START_DATE), file=info
+    )
+
+    collector = collect_mail_log(env)
+
+    if OUTPUT_FORMAT != "text":
+        print_mail_stats(get_collector_stats(collector), OUTPUT_FORMAT)
+        return
+
+    if not collector["scan_count"]:
+        print("No log lines scanned...")
+        return
+
+    print("{scan_count} Log lines scanned, {parse_count} lines parsed in {scan_time:.2f} "
+          "seconds\n".format(**collector))
+
+    print_mail_log_report(collector)
+
+
+def print_mail_log_report(collector):
+    """ Print the report tables of the data in a collector """
+
+    # Print Sent Mail report
+
+    if collector["sent_mail"]:
+        msg = "Sent email"
+        print_header(msg)
+
+        data = OrderedDict(select_rows(collector["sent_mail"].items(), lambda u: u["sent_count"]))
+
+        print_user_table(
+            data.keys(),
+            data=[
+                ("sent", [u["sent_count"] for u in data.values()]),
+                ("hosts", [len(u["hosts"]) for u in data.values()]),
+            ],
+            sub_data=[
+                ("sending hosts", [u["hosts"] if not APPROXIMATE or u["hosts"].is_exact() else
+                                   ["about {} hosts".format(len(u["hosts"]))]
+                                   for u in data.values()]),
+            ],
+            activity=[
+                ("sent", [u["activity-by-hour"] for u in data.values()]),
+            ],
+            earliest=[u["earliest"] for u in data.values()],
+            latest=[u["latest"] for u in data.values()],
+            selected_from=len(collector["sent_mail"]),
+        )
+
+        print_time_table(
+            ["sent"],
+            [sum_histograms(u["activity-by-hour"] for u in collector["sent_mail"].values())]
+        )
+
+    # Print Received Mail report
+
+    if collector["received_mail"]:
+        msg = "Received email"
+        print_header(msg)
+
+        data = OrderedDict(select_rows(collector["received_mail"].items(),
+                                       lambda u: u["received_count"]))
+
+        print_user_table(
+            data.keys(),
+            data=[
+                ("received", [u["received_count"] for u in data.values()]),
+            ],
+            activity=[
+                ("sent", [u["activity-by-hour"] for u in data.values()]),
+            ],
+            earliest=[u["earliest"] for u in data.values()],
+            latest=[u["latest"] for u in data.values()],
+            selected_from=len(collector["received_mail"]),
+        )
+
+        print_time_table(
+            ["received"],
+            [sum_histograms(u["activity-by-hour"] for u in collector["received_mail"].values())]
+        )
+
+    # Print login report
+
+    if collector["logins"]:
+        msg = "User logins per hour"
+        print_header(msg)
+
+        data = OrderedDict(select_rows(collector["logins"].items(),
+                                       lambda u: sum(u["totals_by_protocol"].values())))
+
+        # Get a list of all of the protocols seen in the logs in reverse count order.
+        all_protocols = defaultdict(int)
+        for u in collector["logins"].values():
+            for protocol_name, count in u["totals_by_protocol"].items():
+                all_protocols[protocol_name] += count
+        all_protocols = [k for k, v in sorted(all_protocols.items(), key=lambda kv : -kv[1])]
+
+        print_user_table(
+            data.keys(),
+            data=[
+                (protocol_name, [
+                    round(u["totals_by_protocol"][protocol_name] / (u["latest"]-u["earliest"]).total_seconds() * 60*60, 1)
+                    if (u["latest"]-u["earliest"]).total_seconds() > 0
+                    else 0 # prevent division by zero
+                  for u in data.values()])
+                for protocol_name in all_protocols
+            ],
+            sub_data=[
+                ("Protocol and Source", [[
+                    "{} {}: {} times".format(protocol_name, host, count)
+                    for (protocol_name, host), count
+                    in sorted(u["totals_by_protocol_and_host"].items(), key=lambda kv:-kv[1])
+                  ] for u in data.values()])
+            ],
+            activity=[
+                (protocol_name, [u["activity-by-hour"][protocol_name] for u in data.values()])
+                for protocol_name in all_protocols
+            ],
+            earliest=[u["earliest"] for u in data.values()],
+            latest=[u["latest"] for u in data.values()],
+            numstr=lambda n : str(round(n, 1)),
+            selected_from=len(collector["logins"]),
+        )
+
+        print_time_table(
+            all_protocols,
+            [sum_histograms(u["activity-by-hour"][protocol_name]
+                            for u in collector["logins"].values())
+             for protocol_name in all_protocols]
+        )
+
+    if collector["postgrey"] and APPROXIMATE:
+        print_postgrey_summaries(collector)
+    elif collector["postgrey"]:
+        msg = "Greylisted Email {:%Y-%m-%d %H:%M:%S} and {:%Y-%m-%d %H:%M:%S}"
+        print_header(msg.format(END_DATE, START_DATE))
+
+        print(textwrap.fill(
+            "The following mail was greylisted, meaning the emails were temporarily rejected. "
+            "Legitimate senders must try again after three minutes.",
+            width=80, initial_indent=" ", subsequent_indent=" "
+        ), end='\n\n')
+
+        data = OrderedDict(select_rows(collector["postgrey"].items(), len))
+        users = []
+        received = []
+        senders = []
+        sender_clients = []
+        delivered_dates = []
+
+        for recipient in data:
+            sorted_recipients = sorted(data[recipient].items(), key=lambda kv: kv[1][0] or kv[1][1])
+            for (client_address, sender), (first_date, delivered_date) in sorted_recipients:
+                if first_date:
+                    users.append(recipient)
+                    received.append(first_date)
+                    senders.append(sender)
+                    delivered_dates.append(delivered_date)
+                    sender_clients.append(client_address)
+
+        print_user_table(
+            users,
+            data=[
+                ("received", received),
+                ("sender", senders),
+                ("delivered", [str(d) or "no retry yet" for d in delivered_dates]),
+                ("sending host", sender_clients)
+            ],
+            delimit=True,
+            selected_from=len(collector["postgrey"]),
+        )
+
+    if collector["rejected"] and APPROXIMATE:
+        print_rejected_summaries(collector)
+    elif collector["rejected"]:
+        msg = "Blocked Email {:%Y-%m-%d %H:%M:%S} and {:%Y-%m-%d %H:%M:%S}"
+        print_header(msg.format(END_DATE, START_DATE))
+
+        data = OrderedDict(select_rows(collector["rejected"].items(), lambda u: len(u["blocked"])))
+
+        rejects = []
+
+        if VERBOSE:
+            for user_data in data.values():
+                user_rejects = []
+                for date, sender, message in user_data["blocked"]:
+                    if len(sender) > 64:
+                        sender = sender[:32] + "…" + sender[-32:]
+                    user_rejects.append("%s - %s " % (date, sender))
+                    user_rejects.append("  %s" % message)
+                rejects.append(user_rejects)
+
+        print_user_table(
+            data.keys(),
+            data=[
+                ("blocked", [len(u["blocked"]) for u in data.values()]),
+            ],
+            sub_data=[
+                ("blocked emails", rejects),
+            ],
+            earliest=[u["earliest"] for u in data.values()],
+            latest=[u["latest"] for u in data.values()],
+            selected_from=len(collector["rejected"]),
+        )
+
+    if collector["delays"]:
+        msg = "Delivery delays in seconds"
+        print_header(msg)
+
+        print(textwrap.fill(
+            "The time from receiving an email until it was delivered, of email sent or received by "
+            "the users. The delay is split into the mean time before the queue manager, in the "
+            "queue manager, setting up the connection and transmitting the email.",
+            width=80, initial_indent=" ", subsequent_indent=" "
+        ), end='\n\n')
+
+        data = OrderedDict(select_rows(collector["delays"].items(), lambda u: len(u["delays"])))
+
+        percentiles = [delay_percentiles(u["delays"]) for u in data.values()]
+        hourly = [hourly_delay_percentiles(u["delays"], u["hours"]) for u in data.values()]
+
+        print_user_table(
+            data.keys(),
+            data=[
+                ("delivered", [len(u["delays"]) for u in data.values()]),
+            ] + [
+                (label, [p[i] for p in percentiles]) for i, label in enumerate(DELAY_PERCENTILES)
+            ] + [
+                (label, [round(u["parts"][i] / len(u["delays"]), 2) for u in data.values()])
+                for i, label in enumerate(("before queue", "in queue", "connection", "transmission"))
+            ],
+            activity=[
+                (label, [[numstr_delay(p[h][i]) for h in range(24)] for p in hourly])
+                for i, label in enumerate(DELAY_PERCENTILES)
+            ],
+            earliest=[u["earliest"] for u in data.values()],
+            latest=[u["latest"] for u in data.values()],
+            totals=False,
+            selected_from=len(collector["delays"]),
+        )
+
+        all_delays = array.array(DELAY_TYPE)
+        all_hours = array.array('B')
+        for u in collector["delays"].values():
+            all_delays.extend(u["delays"])
+            all_hours.extend(u["hours"])
+        hourly = hourly_delay_percentiles(all_delays, all_hours)
+
+        print_time_table(
+            list(DELAY_PERCENTILES),
+            [[numstr_delay(hourly[h][i]) for h in range(24)] for i in range(len(DELAY_PERCENTILES))]
+        )
+
+    if collector["outbound"]:
+        msg = "Outbound deliveries by destination domain"
+        print_header(msg)
+
+        print(textwrap.fill(
+            "Deferred deliveries are counted for every attempt. The delay percentiles are the time "
+            "in seconds from receiving an email until it was sent, or 0 when nothing was sent. "
+            "Reuse is the percentage of attempts made over a connection that was already open.",
+            width=80, initial_indent=" ", subsequent_indent=" "
+        ), end='\n\n')
+
+        # The busiest domains first
+        data = OrderedDict(select_rows(collector["outbound"].items(),
+                                       key=lambda kv: (-(kv[1]["sent"] + kv[1]["deferred"] +
+                                                         kv[1]["bounced"]), kv[0])))
+
+        percentiles = [delay_percentiles(d["delays"]) for d in data.values()]
+        attempts = [d["sent"] + d["deferred"] + d["bounced"] for d in data.values()]
+
+        print_user_table(
+            data.keys(),
+            data=[
+                ("sent", [d["sent"] for d in data.values()]),
+                ("deferred", [d["deferred"] for d in data.values()]),
+                ("bounced", [d["bounced"] for d in data.values()]),
+            ] + [
+                (label, [p[i] or 0 for p in percentiles])
+                for i, label in enumerate(DELAY_PERCENTILES) if label != "p99"
+            ] + [
+                ("reuse %", [round(100 * d["conn_use"] / n) for d, n in zip(data.values(), attempts)]),
+            ],
+            sub_data=[
+                ("relays", [sorted(d["relays"]) for d in data.values()]),
+                ("status codes of failed attempts", [[
+                    "{}: {} times".format(dsn, count)
+                    for dsn, count in sorted(d["status_codes"].items(), key=lambda kv: -kv[1])
+                  ] for d in data.values()]),
+            ],
+            earliest=[d["earliest"] for d in data.values()],
+            latest=[d["latest"] for d in data.values()],
+            totals=False,
+            selected_from=len(collector["outbound"]),
+        )
+
+    if collector["auth_failures"]["count"]:
+        print_auth_failures(collector["auth_failures"])
+
+    if collector["other-services"] and VERBOSE and False:
+        print_header("Other services")
+        print("The following unkown services were found in the log file.")
+        print(" ", *sorted(list(collector["other-services"])), sep='\n│ ')
+
+
+def new_collector():
+    """ Create an empty collector to gather the data found in the log files in """
+
+    return {
+        "scan_count": 0,  # Number of lines scanned
+        "parse_count": 0,  # Number of lines parsed (i.e. that had their contents examined)
+        "scan_time": time.time(),  # The time in seconds the scan took
+        "sent_mail": OrderedDict(),  # Data about email sent by users
+        "received_mail": OrderedDict(),  # Data about email received by users
+        "logins": OrderedDict(),  # Data about login activity
+        "postgrey": {},  # Data about greylisting of email addresses
+        "rejected": OrderedDict(),  # Emails that were blocked
+        "delays": OrderedDict(),  # Delivery delays of email sent or received by users
+        "outbound": OrderedDict(),  # Deliveries to remote domains
+        "auth_failures": new_auth_failures(),  # Failed logins by IP address and account
+        "messages": OrderedDict(),  # Messages being delivered by queue ID, only used while scanning
+        "detector": None,  # AnomalyDetector to pass the sent email and logins to, when following
+        "journal_cursor": None,  # Where the scan of the systemd journal stopped, to follow it from
+        "known_addresses": None,  # Addresses handled by the Miab installation
+        "other-services": set(),
+    }
+
+
+def scan_mail_log_line(line, collector):
+    """ Scan a log line and extract interesting data """
+
+    m = LOG_LINE.match(line)
+
+    if not m:
+        return True
+
+    date, _, service, log = m.groups()
+    collector["scan_count"] += 1
+
+    # The date is checked for every line, including those of ignored services, so that a backward
+    # scan stops as soon as it leaves the time span
+    date = parse_log_date(date)
+
+    # Check if the found date is within the time span we are scanning
+    if date > START_DATE:
+        # Don't process, but continue
+        return True
+    elif date < END_DATE:
+        # Don't process, and halt
+        return False
+
+    return scan_mail_log_entry(date, service, log, collector)
+
+
+def parse_mail_log_line(line):
+    """ Split a log line into its date, service and log message, or return None if it can't be """
+
+    m = LOG_LINE.match(line)
+
+    if not m:
+        return None
+
+    date, system, service, log = m.groups()
+
+    # print()
+    # print("date:", date)
+    # print("host:", system)
+    # print("service:", service)
+    # print("log:", log)
+
+    return parse_log_date(date), service, log
+
+
+def parse_log_date(date):
+    """ Parse the date of a log line into a local time, with a resolution of seconds
+
+    Dates are looked up in a cache first. Traditional syslog dates have no year, so they get the
+    year that puts them in the year up until now. RFC 3339 dates are converted to local time.
+
+    """
+
+    if date[4:5] == "-":
+        # RFC 3339, cached without the fraction of a second
+        key = date[:19] + date[19:].lstrip(".0123456789")
+    else:
+        key = date
+
+    parsed = DATE_CACHE.get(key)
+
+    if parsed is None:
+        if len(DATE_CACHE) >= DATE_CACHE_SIZE:
+            DATE_CACHE.clear()
+        parsed = DATE_CACHE[key] = parse_log_date_uncached(key)
+
+    return parsed
+
+
+def parse_log_date_uncached(date):
+    """ Parse the date of a log line, without the fraction of a second for RFC 3339 dates """
+
+    if date[4:5] == "-":
+        parsed = datetime.datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                                   int(date[11:13]), int(date[14:16]), int(date[17:19]))
+        if len(date) > 19:
+            # Convert to local time
+            offset = datetime.timedelta(0) if date[19] == "Z" else \
+                (-1 if date[19] == "-" else 1) * datetime.timedelta(hours=int(date[20:22]),
+                                                                   minutes=int(date[23:25]))
+            parsed = parsed.replace(tzinfo=datetime.timezone(offset)).astimezone()
+            parsed = parsed.replace(tzinfo=None)
+        return parsed
+
+    if len(date) == 15 and date[:3] in MONTHS:
+        # "Feb 15 12:34:56" or "Feb  5 12:34:56"
+        month, day = MONTHS[date[:3]], int(date[4:6])
+        time_of_day = int(date[7:9]), int(date[10:12]), int(date[13:15])
+    else:
+        # Replaced the dateutil parser for a less clever way of parser that is roughly 4 times
+        # faster.
+        # date = dateutil.parser.parse(date)
+        parsed = datetime.datetime.strptime(date, '%b %d %H:%M:%S')
+        month, day = parsed.month, parsed.day
+        time_of_day = parsed.hour, parsed.minute, parsed.second
+
+    # Log files don't go back further than a year, so dates after now (allowing for some clock
+    # differences) were logged last year. A scan over January 1st gets both years right this way.
+    now = datetime.datetime.now()
+
+    try:
+        parsed = datetime.datetime(now.year, month, day, *time_of_day)
+    except ValueError:
+        # February 29th, which must have been in the last leap year
+        year = now.year - 1
+        while not calendar.isleap(year):
+            year -= 1
+        return datetime.datetime(year, month, day, *time_of_day)
+
+    if parsed > now + datetime.timedelta(days=1):
+        parsed = parsed.replace(year=now.year - 1)
+
+    return parsed
+
+
+def scan_mail_log_entry(date, service, log, collector):
+    """ Extract interesting data from the log message of a service """
+
+    scanners = SERVICE_SCANNERS.get(service)
+
+    if scanners is not None:
+        for setting, scan in scanners:
+            if globals()[setting]:
+                scan(date, log, collector)
+    elif service.endswith("-login"):
+        if SCAN_DOVECOT_LOGIN:
+            scan_dovecot_login_line(date, log, collector, service[:4])
+        if SCAN_AUTH_FAILURES:
+            scan_dovecot_auth_failure_line(date, log, collector, service[:4])
+    elif service in IGNORED_SERVICES:
+        # nothing to look at
+        return True
+    else:
+        collector["other-services"].add(service)
+        return True
+
+    collector["parse_count"] += 1
+    return True
+
+
+def scan_postgrey_line(date, log, collector):
+    """ Scan a postgrey log line and extract interesting data """
+
+    m = POSTGREY_LINE.match(log)
+
+    if m:
+
+        action, reason, client_name, client_address, sender, user = m.groups()
+
+        if user_match(user):
+
+            # Might be useful to group services that use a lot of mail different servers on sub
+            # domains like <sub>1.domein.com
+
+            # if '.' in client_name:
+            #     addr = client_name.split('.')
+            #     if len(addr) > 2:
+            #         client_name = '.'.join(addr[1:])
+
+            key = (client_address if client_name == 'unknown' else client_name, sender)
+
+            if APPROXIMATE:
+                add_postgrey_summary(user, date, action, reason, key, collector)
+                return
+
+            rep = collector["postgrey"].setdefault(sys.intern(user), {})
+
+            first_date, delivered_date = rep.get(key, (None, None))
+
+            # Keep the first dates, whichever direction the log is scanned in
+            if action == "greylist" and reason == "new":
+                rep[key] = (min_date(first_date, date), delivered_date)
+            elif action == "pass":
+                rep[key] = (first_date, min_date(delivered_date, date))
+
+
+def add_postgrey_summary(user, date, action, reason, key, collector):
+    """ Count a greylisted or passed email, in the approximate mode """
+
+    data = collector["postgrey"].get(user)
+
+    if data is None:
+        data = collector["postgrey"][sys.intern(user)] = new_postgrey_summary()
+
+    client, sender = key
+
+    if action == "greylist" and reason == "new":
+        data["greylisted"] += 1
+        data["senders"].add(sender)
+        data["clients"].add(client)
+        update_timespan(data, date)
+    elif action == "pass":
+        data["delivered"] += 1
+
+
+def new_postgrey_summary():
+    return {
+        "greylisted": 0,
+        "delivered": 0,  # Passed after greylisting
+        "senders": SpaceSaving(),
+        "clients": HyperLogLog(),
+        "earliest": None,
+        "latest": None,
+    }
+
+
+def scan_postfix_smtpd_line(date, log, collector):
+    """ Scan a postfix smtpd log line and extract interesting data """
+
+    # Check if the incoming mail was rejected
+
+    m = SMTPD_REJECT_LINE.match(log)
+
+    if m:
+        message, sender, user = m.groups()
+
+        # skip this, if reported in the greylisting report
+        if "Recipient address rejected: Greylisted" in message:
+            return
+
+        # only log mail to known recipients
+        if user_match(user):
+            if collector["known_addresses"] is None or user in collector["known_addresses"]:
+                data = collector["rejected"].get(user)
+
+                if data is None:
+                    # The user is new
+                    data = collector["rejected"][sys.intern(user)] = new_rejected()
+
+                # simplify this one
+                m = SMTPD_REJECT_IP_BLOCKED.search(message)
+                if m:
+                    message = "ip blocked: " + m.group(2)
+                else:
+                    # simplify this one too
+                    m = SMTPD_REJECT_DOMAIN_BLOCKED.search(message)
+                    if m:
+                        message = "domain blocked: " + m.group(2)
+
+                update_timespan(data, date)
+
+                if APPROXIMATE:
+                    data["blocked_count"] += 1
+                    data["senders"].add(sender)
+                else:
+                    data["blocked"].append((date, sender, message))
+
+
+def new_rejected():
+    """ Create the data of a user's blocked email, only keeping counts in the approximate mode """
+
+    if APPROXIMATE:
+        return {
+            "blocked_count": 0,
+            "senders": SpaceSaving(),
+            "earliest": None,
+            "latest": None,
+        }
+
+    return {
+        "blocked": [],
+        "earliest": None,
+        "latest": None,
+    }
+
+
+def scan_dovecot_login_line(date, log, collector, protocol_name):
+    """ Scan a dovecot login log line and extract interesting data """
+
+    m = DOVECOT_LOGIN_LINE.match(log)
+
+    if m:
+        # TODO: CHECK DIT
+        user, host = m.groups()
+
+        if user_match(user):
+            add_login(user, date, protocol_name, host, collector)
+
+
+def add_login(user, date, protocol_name, host, collector):
+            if collector["detector"] is not None:
+                collector["detector"].add_login(user, date, host)
+
+            # Get the user data, or create it if the user is new
+            data = collector["logins"].get(user)
+
+            if data is None:
+                data = collector["logins"][sys.intern(user)] = {
+                    "earliest": None,
+                    "latest": None,
+                    "totals_by_protocol": defaultdict(int),
+                    "totals_by_protocol_and_host": defaultdict(int),
+                    "activity-by-hour": defaultdict(new_histogram),
+                }
+
+            update_timespan(data, date)
+
+            data["totals_by_protocol"][protocol_name] += 1
+            data["totals_by_protocol_and_host"][(protocol_name, host)] += 1
+
+            if host not in ("127.0.0.1", "::1") or True:
+                data["activity-by-hour"][protocol_name][date.hour] += 1
+
+
+def scan_dovecot_auth_failure_line(date, log, collector, protocol_name):
+    """ Scan a dovecot login log line for failed IMAP or POP3 logins
+
+    A line is logged when the connection is closed, with the number of failed attempts made over
+    the connection.
+
+    """
+
+    m = DOVECOT_AUTH_FAILED_LINE.match(log)
+
+    if m:
+        attempts, user, ip = m.groups()
+        add_auth_failure(date, ip, user or "", protocol_name, int(attempts), collector)
+
+
+def scan_postfix_sasl_failure_line(date, log, collector):
+    """ Scan a postfix submission log line for a failed SMTP login
+
+    Postfix doesn't log the account of the failed login, unless the SASL implementation does.
+
+    """
+
+    m = SASL_FAILED_LINE.match(log)
+
+    if m:
+        ip, user = m.groups()
+        add_auth_failure(date, ip, user or "", "smtp", 1, collector)
+
+
+def add_auth_failure(date, ip, account, protocol_name, attempts, collector):
+    """ Count failed logins per IP address and per account
+
+    For every IP address, the most failed logins within AUTH_FAILURE_WINDOW seconds are kept. The
+    windows are aligned to the clock like fail2ban's findtime isn't, so this is a lower bound.
+
+    In the approximate mode only the most frequent IP addresses and accounts are counted, and the
+    numbers of distinct ones estimated.
+
+    """
+
+    if not user_match(account):
+        return
+
+    failures = collector["auth_failures"]
+    failures["count"] += attempts
+    update_timespan(failures, date)
+    failures["activity-by-hour"][protocol_name][date.hour] += attempts
+
+    if APPROXIMATE:
+        failures["ips"].add(ip, attempts)
+        failures["distinct_ips"].add(ip)
+        if account:
+            failures["accounts"].add(account, attempts)
+            failures["distinct_accounts"].add(account)
+        return
+
+    data = failures["ips"].get(ip)
+
+    if data is None:
+        data = failures["ips"][sys.intern(ip)] = new_auth_failure_ip()
+
+    data["count"] += attempts
+    update_timespan(data, date)
+
+    window = (date.toordinal() * 86400 + date.hour * 3600 + date.minute * 60 + date.second) // \
+        AUTH_FAILURE_WINDOW
+
+    if window != data["window"]:
+        data["window"] = window
+        data["window_count"] = 0
+
+    data["window_count"] += attempts
+    data["max_window"] = max(data["max_window"], data["window_count"])
+
+    if account:
+        data["accounts"].add(account)
+
+        data = failures["accounts"].get(account)
+
+        if data is None:
+            data = failures["accounts"][sys.intern(account)] = new_auth_failure_account()
+
+        data["count"] += attempts
+        data["ips"].add(ip)
+        update_timespan(data, date)
+
+
+def new_auth_failures():
+    """ Create the data of failed logins, only keeping the most frequent IP addresses and accounts
+    in the approximate mode """
+
+    failures = {
+        "count": 0,
+        "earliest": None,
+        "latest": None,
+        "activity-by-hour": defaultdict(new_histogram),  # By protocol
+    }
+
+    if APPROXIMATE:
+        failures.update({
+            "ips": SpaceSaving(),
+            "accounts": SpaceSaving(),
+            "distinct_ips": HyperLogLog(),
+            "distinct_accounts": HyperLogLog(),
+        })
+    else:
+        failures.update({
+            "ips": OrderedDict(),
+            "accounts": OrderedDict(),
+        })
+
+    return failures
+
+
+def new_auth_failure_ip():
+    return {
+        "count": 0,
+        "accounts": set(),
+        "max_window": 0,  # Most failed logins within a window
+        "window": None,  # The current window while scanning, and its failed logins
+        "window_count": 0,
+        "earliest": None,
+        "latest": None,
+    }
+
+
+def new_auth_failure_account():
+    return {
+        "count": 0,
+        "ips": set(),
+        "earliest": None,
+        "latest": None,
+    }
+
+
+def scan_postfix_lmtp_line(date, log, collector):
+    """ Scan a postfix lmtp log line and extract interesting data
+
+    It is assumed that every log of postfix/lmtp indicates an email that was successfully
+    received by Postfix.
+
+    """
+
+    m = LMTP_LINE.match(log)
+
+    if m:
+        _, user = m.groups()
+
+        if user_match(user):
+            # Get the user data, or create it if the user is new
+            data = collector["received_mail"].get(user)
+
+            if data is None:
+                data = collector["received_mail"][sys.intern(user)] = {
+                    "received_count": 0,
+                    "earliest": None,
+                    "latest": None,
+                    "activity-by-hour": new_histogram(),
+                }
+
+            data["received_count"] += 1
+            data["activity-by-hour"][date.hour] += 1
+
+            update_timespan(data, date)
+
+
+def scan_postfix_submission_line(date, log, collector):
+    """ Scan a postfix submission log line and extract interesting data
+
+    Lines containing a sasl_method with the values PLAIN or LOGIN are assumed to indicate a sent
+    email.
+
+    """
+
+    # Match both the 'plain' and 'login' sasl methods, since both authentication methods are
+    # allowed by Dovecot
+    m = SUBMISSION_LINE.match(log)
+
+    if m:
+        _, client, method, user = m.groups()
+
+        if user_match(user):
+            # Get the user data, or create it if the user is new
+            data = collector["sent_mail"].get(user)
+
+            if data is None:
+                data = collector["sent_mail"][sys.intern(user)] = {
+                    "sent_count": 0,
+                    "hosts": new_hosts(),
+                    "earliest": None,
+                    "latest": None,
+                    "activity-by-hour": new_histogram(),
+                }
+
+            data["sent_count"] += 1
+            data["hosts"].add(client)
+            data["activity-by-hour"][date.hour] += 1
+
+            update_timespan(data, date)
+
+            if collector["detector"] is not None:
+                collector["detector"].add_sent(user, date)
+
+            # Also log this as a login.
+            add_login(user, date, "smtp", client, collector)
+
+
+def scan_postfix_submission_queue_line(date, log, collector):
+    """ Scan a postfix submission log line for the queue ID of an email sent by a user
+
+    The delivery delays of the email are added to the sender's delays by
+    scan_postfix_delivery_line, whether its delivery lines are scanned before or after this one.
+
+    """
+
+    m = SUBMISSION_LINE.match(log)
+
+    if m:
+        queue_id, _, _, user = m.groups()
+
+        message = get_message(queue_id, collector)
+        message["sender"] = user
+
+        for delivery in message["deliveries"]:
+            add_delay(user, *delivery, collector)
+
+        message["deliveries"].clear()
+
+
+def scan_postfix_delivery_line(date, log, collector):
+    """ Scan a postfix lmtp or smtp log line for the delay of a delivered email
+
+    The delay is added to the recipient's delays when the recipient is local, and to the sender's
+    when the email was sent by a user.
+
+    """
+
+    delivery = parse_delivery(log)
+
+    if delivery is None or delivery[-1] != "sent":
+        return
+
+    queue_id, recipient, delay, parts, _, _ = delivery
+
+    if collector["known_addresses"] is None or recipient in collector["known_addresses"]:
+        add_delay(recipient, date, delay, parts, collector)
+
+    message = get_message(queue_id, collector)
+
+    if message["sender"] is None:
+        # The submission line hasn't been scanned yet, as when reading backwards
+        message["deliveries"].append((date, delay, parts))
+    elif message["sender"] != recipient:
+        add_delay(message["sender"], date, delay, parts, collector)
+
+
+def parse_delivery(log):
+    """ Parse the delivery of an email in a postfix lmtp or smtp log line
+
+    Args:
+        log (str): The log message
+
+    Returns:
+        tuple: The queue ID, recipient, total delay in seconds, the delays before the queue
+        manager, in the queue manager, setting up the connection and transmitting the email, the
+        delivery status code and the delivery status. Or None, when the line isn't about a
+        delivery.
+
+    """
+
+    m = DELIVERY_LINE.match(log)
+
+    if m is None:
+        return None
+
+    queue_id, recipient, delay, before_queue, in_queue, connection, transmission, dsn, status = \
+        m.groups()
+
+    return (queue_id, recipient, float(delay),
+            (float(before_queue), float(in_queue), float(connection), float(transmission)),
+            dsn, status)
+
+
+def scan_postfix_smtp_line(date, log, collector):
+    """ Scan a postfix smtp log line for the outcome of a delivery attempt to a remote domain
+
+    Deferred deliveries are counted for every attempt, sent and bounced deliveries once. The time
+    spent in the queue is kept for the sent ones.
+
+    """
+
+    delivery = parse_delivery(log)
+
+    if delivery is None:
+        return
+
+    _, recipient, delay, _, dsn, status = delivery
+    domain = recipient.rpartition("@")[2].lower()
+
+    data = collector["outbound"].get(domain)
+
+    if data is None:
+        data = collector["outbound"][sys.intern(domain)] = {
+            "sent": 0,
+            "deferred": 0,
+            "bounced": 0,
+            "conn_use": 0,  # Attempts over a connection that was used before
+            "delays": array.array(DELAY_TYPE),
+            "status_codes": defaultdict(int),  # Of the attempts that didn't succeed
+            "relays": set(),
+            "earliest": None,
+            "latest": None,
+        }
+
+    if status == "sent":
+        data["sent"] += 1
+        data["delays"].append(delay)
+    elif status == "deferred":
+        data["deferred"] += 1
+    else:
+        # Bounced or expired
+        data["bounced"] += 1
+
+    if status != "sent":
+        data["status_codes"][dsn] += 1
+
+    if SMTP_CONN_USE.search(log):
+        data["conn_use"] += 1
+
+    m = SMTP_RELAY.search(log)
+    if m and m.group(1) != "none":
+        data["relays"].add(m.group(1))
+
+    update_timespan(data, date)
+
+
+def get_message(queue_id, collector):
+    """ Get the tracked message with the queue ID, or start tracking it
+
+    Only the MESSAGE_TRACKING_SIZE most recently seen messages are kept.
+
+    """
+
+    messages = collector["messages"]
+    message = messages.get(queue_id)
+
+    if message is None:
+        message = messages[queue_id] = {
+            "sender": None,
+            "deliveries": [],  # Deliveries scanned before the sender was known
+        }
+        if len(messages) > MESSAGE_TRACKING_SIZE:
+            messages.popitem(last=False)
+    else:
+        messages.move_to_end(queue_id)
+
+    return message
+
+
+def add_delay(user, date, delay, parts, collector):
+    """ Add the delivery delay of an email to the delays of a user """
+
+    if not user_match(user):
+        return
+
+    data = collector["delays"].get(user)
+
+    if data is None:
+        data = collector["delays"][sys.intern(user)] = {
+            "delays": array.array(DELAY_TYPE),
+            "hours": array.array('B'),
+            "parts": array.array('d', [0]) * 4,
+            "earliest": None,
+            "latest": None,
+        }
+
+    data["delays"].append(delay)
+    data["hours"].append(date.hour)
+    for i, part in enumerate(parts):
+        data["parts"][i] += part
+
+    update_timespan(data, date)
+
+
+def new_hosts():
+    """ Create a set of hosts, or a sketch of the number of hosts in the approximate mode """
+    return HyperLogLog() if APPROXIMATE else set()
+
+
+# The scanners of the services of interest, with the setting that enables each of them
+SERVICE_SCANNERS = {
+    "postfix/submission/smtpd": (("SCAN_OUT", scan_postfix_submission_line),
+                                 ("SCAN_DELAYS", scan_postfix_submission_queue_line),
+                                 ("SCAN_AUTH_FAILURES", scan_postfix_sasl_failure_line)),
+    "postfix/lmtp": (("SCAN_IN", scan_postfix_lmtp_line),
+                     ("SCAN_DELAYS", scan_postfix_delivery_line)),
+    "postfix/smtp": (("SCAN_OUTBOUND", scan_postfix_smtp_line),
+                     ("SCAN_DELAYS", scan_postfix_delivery_line)),
+    "postgrey": (("SCAN_GREY", scan_postgrey_line),),
+    "postfix/smtpd": (("SCAN_BLOCKED", scan_postfix_smtpd_line),),
+}
+
+# The regular expression each scanner starts with, for the profile
+SCANNER_PATTERNS = {
+    scan_postfix_submission_line: SUBMISSION_LINE,
+    scan_postfix_submission_queue_line: SUBMISSION_LINE,
+    scan_postfix_lmtp_line: LMTP_LINE,
+    scan_postfix_delivery_line: DELIVERY_LINE,
+    scan_postfix_smtp_line: DELIVERY_LINE,
+    scan_postgrey_line: POSTGREY_LINE,
+    scan_postfix_smtpd_line: SMTPD_REJECT_LINE,
+    scan_postfix_sasl_failure_line: SASL_FAILED_LINE,
+}
+
+
+def update_timespan(data, date):
+    """ Widen the earliest and latest dates of the given data to include the given date """
+
+    if data["earliest"] is None or date < data["earliest"]:
+        data["earliest"] = date
+    if data["latest"] is None or date > data["latest"]:
+        data["latest"] = date
+
+
+# Collector functions
+
+def merge_collectors(collector, other):
+    """ Merge the data in the other collector into the collector """
+
+    collector["scan_count"] += other["scan_count"]
+    collector["parse_count"] += other["parse_count"]
+    collector["other-services"] |= other["other-services"]
+
+    for user, data in other["sent_mail"].items():
+        into = collector["sent_mail"].setdefault(user, {
+            "sent_count": 0,
+            "hosts": new_hosts(),
+            "earliest": None,
+            "latest": None,
+            "activity-by-hour": new_histogram(),
+        })
+        into["sent_count"] += data["sent_count"]
+        into["hosts"] |= data["hosts"]
+        merge_timespan(into, data)
+        add_histogram(into["activity-by-hour"], data["activity-by-hour"])
+
+    for user, data in other["received_mail"].items():
+        into = collector["received_mail"].setdefault(user, {
+            "received_count": 0,
+            "earliest": None,
+            "latest": None,
+            "activity-by-hour": new_histogram(),
+        })
+        into["received_count"] += data["received_count"]
+        merge_timespan(into, data)
+        add_histogram(into["activity-by-hour"], data["activity-by-hour"])
+
+    for user, data in other["logins"].items():
+        into = collector["logins"].setdefault(user, {
+            "earliest": None,
+            "latest": None,
+            "totals_by_protocol": defaultdict(int),
+            "totals_by_protocol_and_host": defaultdict(int),
+            "activity-by-hour": defaultdict(new_histogram),
+        })
+        merge_timespan(into, data)
+        merge_counts(into["totals_by_protocol"], data["totals_by_protocol"])
+        merge_counts(into["totals_by_protocol_and_host"], data["totals_by_protocol_and_host"])
+        for protocol_name, activity in data["activity-by-hour"].items():
+            add_histogram(into["activity-by-hour"][protocol_name], activity)
+
+    for user, data in other["postgrey"].items():
+        if APPROXIMATE:
+            into = collector["postgrey"].setdefault(user, new_postgrey_summary())
+            into["greylisted"] += data["greylisted"]
+            into["delivered"] += data["delivered"]
+            into["senders"].merge(data["senders"])
+            into["clients"] |= data["clients"]
+            merge_timespan(into, data)
+            continue
+
+        into = collector["postgrey"].setdefault(user, {})
+        for key, (first_date, delivered_date) in data.items():
+            into_first, into_delivered = into.get(key, (None, None))
+            into[key] = (min_date(into_first, first_date), min_date(into_delivered, delivered_date))
+
+    for user, data in other["rejected"].items():
+        into = collector["rejected"].setdefault(user, new_rejected())
+        if APPROXIMATE:
+            into["blocked_count"] += data["blocked_count"]
+            into["senders"].merge(data["senders"])
+        else:
+            into["blocked"].extend(data["blocked"])
+            into["blocked"].sort(key=lambda blocked: blocked[0], reverse=True)
+        merge_timespan(into, data)
+
+    for user, data in other["delays"].items():
+        into = collector["delays"].setdefault(user, {
+            "delays": array.array(DELAY_TYPE),
+            "hours": array.array('B'),
+            "parts": array.array('d', [0]) * 4,
+            "earliest": None,
+            "latest": None,
+        })
+        into["delays"].extend(data["delays"])
+        into["hours"].extend(data["hours"])
+        into["parts"][:] = array.array('d', map(operator.add, into["parts"], data["parts"]))
+        merge_timespan(into, data)
+
+    for domain, data in other["outbound"].items():
+        into = collector["outbound"].setdefault(domain, {
+            "sent": 0,
+            "deferred": 0,
+            "bounced": 0,
+            "conn_use": 0,
+            "delays": array.array(DELAY_TYPE),
+            "status_codes": defaultdict(int),
+            "relays": set(),
+            "earliest": None,
+            "latest": None,
+        })
+        for key in ("sent", "deferred", "bounced", "conn_use"):
+            into[key] += data[key]
+        into["delays"].extend(data["delays"])
+        merge_counts(into["status_codes"], data["status_codes"])
+        into["relays"] |= data["relays"]
+        merge_timespan(into, data)
+
+    into, data = collector["auth_failures"], other["auth_failures"]
+    into["count"] += data["count"]
+    merge_timespan(into, data)
+    for protocol_name, activity in data["activity-by-hour"].items():
+        add_histogram(into["activity-by-hour"][protocol_name], activity)
+
+    if APPROXIMATE:
+        into["ips"].merge(data["ips"])
+        into["accounts"].merge(data["accounts"])
+        into["distinct_ips"] |= data["distinct_ips"]
+        into["distinct_accounts"] |= data["distinct_accounts"]
+    else:
+        for ip, ip_data in data["ips"].items():
+            ip_into = into["ips"].setdefault(ip, new_auth_failure_ip())
+            ip_into["count"] += ip_data["count"]
+            ip_into["accounts"] |= ip_data["accounts"]
+            # A window split between the collectors is counted in parts
+            ip_into["max_window"] = max(ip_into["max_window"], ip_data["max_window"])
+            merge_timespan(ip_into, ip_data)
+
+        for account, account_data in data["accounts"].items():
+            account_into = into["accounts"].setdefault(account, new_auth_failure_account())
+            account_into["count"] += account_data["count"]
+            account_into["ips"] |= account_data["ips"]
+            merge_timespan(account_into, account_data)
+
+
+def new_histogram():
+    """ Create an array of counts for every hour of the day """
+    return EMPTY_HISTOGRAM[:]
+
+
+def add_histogram(histogram, other):
+    """ Add the counts per hour of the other histogram to the histogram """
+    histogram[:] = array.array(HISTOGRAM_TYPE, map(operator.add, histogram, other))
+
+
+def sum_histograms(histograms):
+    """ Add up the counts per hour of all histograms at once """
+    return array.array(HISTOGRAM_TYPE, map(sum, zip(EMPTY_HISTOGRAM, *histograms)))
+
+
+def merge_timespan(data, other):
+    """ Widen the earliest and latest dates of the given data to include those of the other """
+
+    for date in (other["earliest"], other["latest"]):
+        if date is not None:
+            update_timespan(data, date)
+
+
+def merge_counts(counts, other):
+    """ Add the counts in the other dictionary to the counts """
+
+    for key, count in other.items():
+        counts[key] += count
+
+
+def prune_collector(collector):
+    """ Remove the data that was not asked for from a collector filled with all scanners enabled """
+
+    for section, enabled in (("sent_mail", SCAN_OUT), ("received_mail", SCAN_IN),
+                             ("logins", SCAN_DOVECOT_LOGIN), ("postgrey", SCAN_GREY),
+                             ("rejected", SCAN_BLOCKED), ("delays", SCAN_DELAYS)):
+        if not enabled:
+            collector[section].clear()
+        else:
+            for user in [user for user in collector[section] if not user_match(user)]:
+                del collector[section][user]
+
+    # Outbound deliveries are by domain, not by user
+    if not SCAN_OUTBOUND:
+        collector["outbound"].clear()
+
+    # Failed logins are mostly for accounts that don't exist, so they are not filtered
+    if not SCAN_AUTH_FAILURES:
+        collector["auth_failures"] = new_auth_failures()
+
+
+def serialize_collector(collector):
+    """ Convert the data in a collector into plain JSON types """
+
+    def timespan(data):
+        return {
+            "earliest": str(data["earliest"]) if data["earliest"] else None,
+            "latest": str(data["latest"]) if data["latest"] else None,
+        }
+
+    def hours(activity):
+        return activity.tolist()
+
+    return {
+        "scan_count": collector["scan_count"],
+        "parse_count": collector["parse_count"],
+        "sent_mail": {
+            user: dict(timespan(data), **{
+                "sent_count": data["sent_count"],
+                "hosts": data["hosts"].to_json() if APPROXIMATE else sorted(data["hosts"]),
+                "activity-by-hour": hours(data["activity-by-hour"]),
+            }) for user, data in collector["sent_mail"].items()
+        },
+        "received_mail": {
+            user: dict(timespan(data), **{
+                "received_count": data["received_count"],
+                "activity-by-hour": hours(data["activity-by-hour"]),
+            }) for user, data in collector["received_mail"].items()
+        },
+        "logins": {
+            user: dict(timespan(data), **{
+                "totals_by_protocol": dict(data["totals_by_protocol"]),
+                "totals_by_protocol_and_host": [
+                    [protocol_name, host, count]
+                    for (protocol_name, host), count in data["totals_by_protocol_and_host"].items()
+                ],
+                "activity-by-hour": {
+                    protocol_name: hours(activity)
+                    for protocol_name, activity in data["activity-by-hour"].items()
+                },
+            }) for user, data in collector["logins"].items()
+        },
+        "postgrey": {
+            user: dict(timespan(data), **{
+                "greylisted": data["greylisted"],
+                "delivered": data["delivered"],
+                "senders": data["senders"].to_json(),
+                "clients": data["clients"].to_json(),
+            }) if APPROXIMATE else [
+                [client_address, sender, str(first_date) if first_date else None,
+                 str(delivered_date) if delivered_date else None]
+                for (client_address, sender), (first_date, delivered_date) in data.items()
+            ] for user, data in collector["postgrey"].items()
+        },
+        "rejected": {
+            user: dict(timespan(data), **({
+                "blocked_count": data["blocked_count"],
+                "senders": data["senders"].to_json(),
+            } if APPROXIMATE else {
+                "blocked": [[str(date), sender, message] for date, sender, message in data["blocked"]],
+            })) for user, data in collector["rejected"].items()
+        },
+        "delays": {
+            user: dict(timespan(data), **{
+                "delays": [round(delay, 3) for delay in data["delays"]],
+                "hours": data["hours"].tolist(),
+                "parts": [round(part, 3) for part in data["parts"]],
+            }) for user, data in collector["delays"].items()
+        },
+        "outbound": {
+            domain: dict(timespan(data), **{
+                "sent": data["sent"],
+                "deferred": data["deferred"],
+                "bounced": data["bounced"],
+                "conn_use": data["conn_use"],
+                "delays": [round(delay, 3) for delay in data["delays"]],
+                "status_codes": dict(data["status_codes"]),
+                "relays": sorted(data["relays"]),
+            }) for domain, data in collector["outbound"].items()
+        },
+        "auth_failures": serialize_auth_failures(collector["auth_failures"], timespan, hours),
+        "other-services": sorted(collector["other-services"]),
+    }
+
+
+def serialize_auth_failures(failures, timespan, hours):
+    """ Convert the data of failed logins into plain JSON types, see serialize_collector """
+
+    data = dict(timespan(failures), **{
+        "count": failures["count"],
+        "activity-by-hour": {
+            protocol_name: hours(activity)
+            for protocol_name, activity in failures["activity-by-hour"].items()
+        },
+    })
+
+    if APPROXIMATE:
+        data.update({key: failures[key].to_json()
+                     for key in ("ips", "accounts", "distinct_ips", "distinct_accounts")})
+        return data
+
+    data["ips"] = {
+        ip: dict(timespan(ip_data), **{
+            "count": ip_data["count"],
+            "accounts": sorted(ip_data["accounts"]),
+            "max_window": ip_data["max_window"],
+        }) for ip, ip_data in failures["ips"].items()
+    }
+    data["accounts"] = {
+        account: dict(timespan(account_data), **{
+            "count": account_data["count"],
+            "ips": sorted(account_data["ips"]),
+        }) for account, account_data in failures["accounts"].items()
+    }
+    return data
+
+
+def deserialize_collector(data):
+    """ Create a collector from data converted to plain JSON types by serialize_collector """
+
+    def timespan(user_data):
+        return {
+            "earliest": parse_timestamp(user_data["earliest"]),
+            "latest": parse_timestamp(user_data["latest"]),
+        }
+
+    def hours(activity):
+        return array.array(HISTOGRAM_TYPE, activity)
+
+    collector = new_collector()
+    collector["scan_count"] = data["scan_count"]
+    collector["parse_count"] = data["parse_count"]
+    collector["other-services"] = set(data["other-services"])
+
+    for user, user_data in data["sent_mail"].items():
+        collector["sent_mail"][user] = dict(timespan(user_data), **{
+            "sent_count": user_data["sent_count"],
+            "hosts": (HyperLogLog.from_json(user_data["hosts"]) if APPROXIMATE
+                      else set(user_data["hosts"])),
+            "activity-by-hour": hours(user_data["activity-by-hour"]),
+        })
+
+    for user, user_data in data["received_mail"].items():
+        collector["received_mail"][user] = dict(timespan(user_data), **{
+            "received_count": user_data["received_count"],
+            "activity-by-hour": hours(user_data["activity-by-hour"]),
+        })
+
+    for user, user_data in data["logins"].items():
+        activity = defaultdict(new_histogram)
+        for protocol_name, protocol_activity in user_data["activity-by-hour"].items():
+            activity[protocol_name] = hours(protocol_activity)
+
+        collector["logins"][user] = dict(timespan(user_data), **{
+            "totals_by_protocol": defaultdict(int, user_data["totals_by_protocol"]),
+            "totals_by_protocol_and_host": defaultdict(int, {
+                (protocol_name, host): count
+                for protocol_name, host, count in user_data["totals_by_protocol_and_host"]
+            }),
+            "activity-by-hour": activity,
+        })
+
+    for user, user_data in data["postgrey"].items():
+        if APPROXIMATE:
+            collector["postgrey"][user] = dict(timespan(user_data), **{
+                "greylisted": user_data["greylisted"],
+                "delivered": user_data["delivered"],
+                "senders": SpaceSaving.from_json(user_data["senders"]),
+                "clients": HyperLogLog.from_json(user_data["clients"]),
+            })
+            continue
+
+        collector["postgrey"][user] = {
+            (client_address, sender): (parse_timestamp(first_date), parse_timestamp(delivered_date))
+            for client_address, sender, first_date, delivered_date in user_data
+        }
+
+    for user, user_data in data["rejected"].items():
+        if APPROXIMATE:
+            collector["rejected"][user] = dict(timespan(user_data), **{
+                "blocked_count": user_data["blocked_count"],
+                "senders": SpaceSaving.from_json(user_data["senders"]),
+            })
+            continue
+
+        collector["rejected"][user] = dict(timespan(user_data), **{
+            "blocked": [(parse_timestamp(date), sender, message)
+                        for date, sender, message in user_data["blocked"]],
+        })
+
+    # Older checkpoints don't have delays and outbound deliveries
+    for user, user_data in data.get("delays", {}).items():
+        collector["delays"][user] = dict(timespan(user_data), **{
+            "delays": array.array(DELAY_TYPE, user_data["delays"]),
+            "hours": array.array('B', user_data["hours"]),
+            "parts": array.array('d', user_data["parts"]),
+        })
+
+    for domain, domain_data in data.get("outbound", {}).items():
+        collector["outbound"][domain] = dict(timespan(domain_data), **{
+            "sent": domain_data["sent"],
+            "deferred": domain_data["deferred"],
+            "bounced": domain_data["bounced"],
+            "conn_use": domain_data["conn_use"],
+            "delays": array.array(DELAY_TYPE, domain_data["delays"]),
+            "status_codes": defaultdict(int, domain_data["status_codes"]),
+            "relays": set(domain_data["relays"]),
+        })
+
+    if "auth_failures" in data:
+        collector["auth_failures"] = deserialize_auth_failures(data["auth_failures"], timespan,
+                                                               hours)
+
+    return collector
+
+
+def deserialize_auth_failures(data, timespan, hours):
+    """ Create the data of failed logins from plain JSON types, see deserialize_collector """
+
+    activity = defaultdict(new_histogram)
+    for protocol_name, protocol_activity in data["activity-by-hour"].items():
+        activity[protocol_name] = hours(protocol_activity)
+
+    failures = dict(timespan(data), **{
+        "count": data["count"],
+        "activity-by-hour": activity,
+    })
+
+    if APPROXIMATE:
+        failures.update({
+            "ips": SpaceSaving.from_json(data["ips"]),
+            "accounts": SpaceSaving.from_json(data["accounts"]),
+            "distinct_ips": HyperLogLog.from_json(data["distinct_ips"]),
+            "distinct_accounts": HyperLogLog.from_json(data["distinct_accounts"]),
+        })
+        return failures
+
+    failures["ips"] = OrderedDict()
+    for ip, ip_data in data["ips"].items():
+        failures["ips"][ip] = dict(new_auth_failure_ip(), **timespan(ip_data), **{
+            "count": ip_data["count"],
+            "accounts": set(ip_data["accounts"]),
+            "max_window": ip_data["max_window"],
+        })
+
+    failures["accounts"] = OrderedDict()
+    for account, account_data in data["accounts"].items():
+        failures["accounts"][account] = dict(timespan(account_data), **{
+            "count": account_data["count"],
+            "ips": set(account_data["ips"]),
+        })
+
+    return failures
+
+
+# Checkpoint functions
+
+def open_checkpoint_database(filename):
+    """ Open the checkpoint database of incremental scans, creating it when needed """
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    conn = sqlite3.connect(filename)
+    conn.execute("CREATE TABLE IF NOT EXISTS hours (hour TEXT NOT NULL PRIMARY KEY, "
+                 "data BLOB NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS files (filename TEXT NOT NULL PRIMARY KEY, "
+                 "inode INTEGER, fingerprint TEXT, offset INTEGER, last_date TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS messages (queue_id TEXT NOT NULL PRIMARY KEY, "
+                 "sender TEXT NOT NULL)")
+    return conn
+
+
+def serialize_hour(collector):
+    """ Convert the data in the collector of an hour into compressed JSON for the checkpoint
+
+    The collector is serialized in the approximate mode, see serialize_collector, and made more
+    compact: every histogram by hour of the day only has a count for the hour itself, so only that
+    count is kept, and the delivery delays are rounded to DELAY_DIGITS significant digits and kept
+    as how often each rounded delay occurs.
+
+    """
+
+    def compact_activity(data):
+        if "activity-by-hour" in data:
+            activity = data["activity-by-hour"]
+            data["activity-by-hour"] = sum(activity) if isinstance(activity, list) else {
+                protocol_name: sum(counts) for protocol_name, counts in activity.items()}
+
+    def compact_delays(delays):
+        counts = defaultdict(int)
+        for delay in delays:
+            counts[float("{:.{}g}".format(delay, DELAY_DIGITS))] += 1
+        return sorted(counts.items())
+
+    data = serialize_collector(collector)
+
+    for section in ("sent_mail", "received_mail", "logins"):
+        for user_data in data[section].values():
+            compact_activity(user_data)
+    compact_activity(data["auth_failures"])
+
+    for user_data in data["delays"].values():
+        user_data["delays"] = compact_delays(user_data["delays"])
+        del user_data["hours"]
+
+    for domain_data in data["outbound"].values():
+        domain_data["delays"] = compact_delays(domain_data["delays"])
+
+    return zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+
+
+def deserialize_hour(hour, blob):
+    """ Create the collector of an hour from compressed JSON made by serialize_hour """
+
+    hour_of_day = int(hour[11:13])
+
+    def expand_activity(data):
+        def histogram(count):
+            activity = [0] * 24
+            activity[hour_of_day] = count
+            return activity
+
+        if "activity-by-hour" in data:
+            activity = data["activity-by-hour"]
+            data["activity-by-hour"] = histogram(activity) if isinstance(activity, int) else {
+                protocol_name: histogram(count) for protocol_name, count in activity.items()}
+
+    def expand_delays(counts):
+        return [delay for delay, count in counts for _ in range(count)]
+
+    data = json.loads(zlib.decompress(blob).decode("utf-8"))
+
+    for section in ("sent_mail", "received_mail", "logins"):
+        for user_data in data[section].values():
+            expand_activity(user_data)
+    expand_activity(data["auth_failures"])
+
+    for user_data in data["delays"].values():
+        user_data["delays"] = expand_delays(user_data["delays"])
+        user_data["hours"] = [hour_of_day] * len(user_data["delays"])
+
+    for domain_data in data["outbound"].values():
+        domain_data["delays"] = expand_delays(domain_data["delays"])
+
+    return deserialize_collector(data)
+
+
+# Archive index functions
+
+def load_archive_index():
+    """ Load the index of first and last timestamps of compressed log files """
+
+    try:
+        with open(ARCHIVE_INDEX_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_archive_index(index):
+    """ Write the index of first and last timestamps of compressed log files, if possible """
+
+    try:
+        os.makedirs(os.path.dirname(ARCHIVE_INDEX_FILE), exist_ok=True)
+        with open(ARCHIVE_INDEX_FILE + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(ARCHIVE_INDEX_FILE + ".tmp", ARCHIVE_INDEX_FILE)
+    except OSError:
+        # The index only saves time, so don't fail the scan over it
+        pass
+
+
+def get_archive_dates(fn, index):
+    """ Return the first and last timestamps of a compressed log file from the index
+
+    Either timestamp is None when it is not known, or when the file has changed since it was
+    indexed.
+
+    """
+
+    if fn[-3:] != '.gz':
+        return None, None
+
+    entry = index.get(archive_key(fn))
+
+    if entry is None:
+        return None, None
+
+    return parse_timestamp(entry["first"]), parse_timestamp(entry["last"])
+
+
+def set_archive_dates(fn, index, archive_dates):
+    """ Store the first and last timestamps of a compressed log file in the index """
+
+    if fn[-3:] != '.gz' or not archive_dates:
+        return
+
+    key = archive_key(fn)
+    last = archive_dates["last"]
+
+    if last is None and key in index:
+        # Don't forget the last timestamp found by a previous scan that read the whole file
+        last = index[key]["last"]
+
+    index[key] = {"first": archive_dates["first"], "last": last}
+
+
+def prune_archive_index(index):
+    """ Remove the compressed log files that are gone from the index """
+
+    keys = set(archive_key(fn) for fn in LOG_FILES if fn[-3:] == '.gz' and os.path.exists(fn))
+
+    for key in [key for key in index if key not in keys]:
+        del index[key]
+
+
+def archive_key(fn):
+    """ Return the inode, size and modification time of a file as its key in the index
+
+    logrotate renames the compressed files at every rotation, which keeps these, while a file that
+    has been replaced or has changed gets a new key.
+
+    """
+
+    stat = os.stat(fn)
+    return "{}:{}:{}".format(stat.st_ino, stat.st_size, int(stat.st_mtime))
+
+
+@contextlib.contextmanager
+def all_scanners_enabled():
+    """ Temporarily enable all scanners and disable the user filters """
+
+    settings = {name: globals()[name] for name in ("FILTERS",) + SCANNER_SETTINGS}
+    globals().update(dict.fromkeys(SCANNER_SETTINGS, True), FILTERS=None)
+    try:
+        yield
+    finally:
+        globals().update(settings)
+
+
+# Profiling functions
+
+def enable_profiling():
+    """ Count and time the scan of every line in PROFILE, by wrapping the scanning functions
+
+    For every service, the lines and the lines parsed are counted and the time its scanners take is
+    added up. For every scanner, the time its regular expression takes to match is told apart from
+    the rest, which is taken as the time spent aggregating the data. For every file, the time spent
+    reading and decompressing it is told apart from the time spent scanning its lines.
+
+    The wrappers only record anything in this process, so profiling needs a single job.
+
+    """
+
+    global PROFILE
 
-    # print()
-    # print("date:", date)
-    # print("host:", system)
-    # print("service:", service)
-    # print("log:", log)
+    PROFILE = {
+        "parse": {"lines": 0, "time": 0.0},  # Splitting lines into date, service and log message
+        "services": defaultdict(lambda: {"lines": 0, "parsed": 0, "time": 0.0}),
+        "scanners": defaultdict(lambda: {"calls": 0, "matched": 0, "regex_time": 0.0,
+                                         "aggregation_time": 0.0}),
+        "files": defaultdict(lambda: {"lines": 0, "bytes": 0, "read_time": 0.0, "time": 0.0}),
+        "entry_time": 0.0,  # Time in scan_mail_log_entry, to tell it apart from the parsing time
+    }
 
-    # Replaced the dateutil parser for a less clever way of parser that is roughly 4 times faster.
-    # date = dateutil.parser.parse(date)
-    date = datetime.datetime.strptime(date, '%b %d %H:%M:%S')
-    date = date.replace(START_DATE.year)
+    module = globals()
 
-    # Check if the found date is within the time span we are scanning
-    if date > START_DATE:
-        # Don't process, but continue
-        return True
-    elif date < END_DATE:
-        # Don't process, and halt
-        return False
+    for service, scanners in SERVICE_SCANNERS.items():
+        SERVICE_SCANNERS[service] = tuple(
+            (setting, profile_scanner(scan, SCANNER_PATTERNS[scan])) for setting, scan in scanners
+        )
 
-    if service == "postfix/submission/smtpd":
-        if SCAN_OUT:
-            scan_postfix_submission_line(date, log, collector)
-    elif service == "postfix/lmtp":
-        if SCAN_IN:
-            scan_postfix_lmtp_line(date, log, collector)
-    elif service.endswith("-login"):
-        if SCAN_DOVECOT_LOGIN:
-            scan_dovecot_login_line(date, log, collector, service[:4])
-    elif service == "postgrey":
-        if SCAN_GREY:
-            scan_postgrey_line(date, log, collector)
-    elif service == "postfix/smtpd":
-        if SCAN_BLOCKED:
-            scan_postfix_smtpd_line(date, log, collector)
-    elif service in ("postfix/qmgr", "postfix/pickup", "postfix/cleanup", "postfix/scache",
-                     "spampd", "postfix/anvil", "postfix/master", "opendkim", "postfix/lmtp",
-                     "postfix/tlsmgr", "anvil"):
-        # nothing to look at
-        return True
-    else:
-        collector["other-services"].add(service)
-        return True
+    module["scan_dovecot_login_line"] = profile_scanner(scan_dovecot_login_line, DOVECOT_LOGIN_LINE)
+    module["scan_dovecot_auth_failure_line"] = profile_scanner(scan_dovecot_auth_failure_line,
+                                                               DOVECOT_AUTH_FAILED_LINE)
+    module["scan_mail_log_entry"] = profile_entry(scan_mail_log_entry)
+    module["scan_mail_log_line"] = profile_parse(scan_mail_log_line)
+    module["parse_mail_log_line"] = profile_parse(parse_mail_log_line)
+    module["reverse_readline"] = profile_reads(reverse_readline)
+    module["forward_readline"] = profile_reads(forward_readline)
+    module["range_readline"] = profile_reads(range_readline)
+    module["scan_file"] = profile_file(scan_file)
 
-    collector["parse_count"] += 1
-    return True
 
+def profile_scanner(scan, pattern):
+    """ Wrap a scanner to count its calls and time its regular expression and the rest apart
 
-def scan_postgrey_line(date, log, collector):
-    """ Scan a postgrey log line and extract interesting data """
+    The pattern is matched once more before the scanner runs to time it, and that time is taken
+    off the time of the scanner for the aggregation time.
 
-    m = re.match("action=(greylist|pass), reason=(.*?), (?:delay=\d+, )?client_name=(.*), "
-                 "client_address=(.*), sender=(.*), recipient=(.*)",
-                 log)
+    """
 
-    if m:
+    name = scan.__name__
 
-        action, reason, client_name, client_address, sender, user = m.groups()
+    def profiled(date, log, collector, *args):
+        data = PROFILE["scanners"][name]
+        start = time.perf_counter()
+        matched = pattern.match(log) is not None
+        matched_time = time.perf_counter()
+        scan(date, log, collector, *args)
+        end = time.perf_counter()
 
-        if user_match(user):
+        regex_time = matched_time - start
+        data["calls"] += 1
+        data["matched"] += matched
+        data["regex_time"] += regex_time
+        data["aggregation_time"] += max(end - matched_time - regex_time, 0.0)
 
-            # Might be useful to group services that use a lot of mail different servers on sub
-            # domains like <sub>1.domein.com
+    return profiled
 
-            # if '.' in client_name:
-            #     addr = client_name.split('.')
-            #     if len(addr) > 2:
-            #         client_name = '.'.join(addr[1:])
 
-            key = (client_address if client_name == 'unknown' else client_name, sender)
+def profile_entry(scan_entry):
+    """ Wrap scan_mail_log_entry to count and time the lines of every service """
 
-            rep = collector["postgrey"].setdefault(user, {})
+    def profiled(date, service, log, collector):
+        data = PROFILE["services"][service]
+        parse_count = collector["parse_count"]
+        start = time.perf_counter()
+        result = scan_entry(date, service, log, collector)
+        elapsed = time.perf_counter() - start
 
-            if action == "greylist" and reason == "new":
-                rep[key] = (date, rep[key][1] if key in rep else None)
-            elif action == "pass":
-                rep[key] = (rep[key][0] if key in rep else None, date)
+        data["lines"] += 1
+        data["parsed"] += collector["parse_count"] - parse_count
+        data["time"] += elapsed
+        PROFILE["entry_time"] += elapsed
+        return result
 
+    return profiled
 
-def scan_postfix_smtpd_line(date, log, collector):
-    """ Scan a postfix smtpd log line and extract interesting data """
 
-    # Check if the incoming mail was rejected
+def profile_parse(parse):
+    """ Wrap a function that splits log lines to time it, without the time of the scanners it may
+    call """
 
-    m = re.match("NOQUEUE: reject: RCPT from .*?: (.*?); from=<(.*?)> to=<(.*?)>", log)
+    def profiled(line, *args):
+        entry_time = PROFILE["entry_time"]
+        start = time.perf_counter()
+        result = parse(line, *args)
+        elapsed = time.perf_counter() - start
 
-    if m:
-        message, sender, user = m.groups()
+        PROFILE["parse"]["lines"] += 1
+        PROFILE["parse"]["time"] += elapsed - (PROFILE["entry_time"] - entry_time)
+        return result
 
-        # skip this, if reported in the greylisting report
-        if "Recipient address rejected: Greylisted" in message:
-            return
+    return profiled
 
-        # only log mail to known recipients
-        if user_match(user):
-            if collector["known_addresses"] is None or user in collector["known_addresses"]:
-                data = collector["rejected"].get(
-                    user,
-                    {
-                        "blocked": [],
-                        "earliest": None,
-                        "latest": None,
-                    }
-                )
-                # simplify this one
-                m = re.search(
-                    r"Client host \[(.*?)\] blocked using zen.spamhaus.org; (.*)", message
-                )
-                if m:
-                    message = "ip blocked: " + m.group(2)
-                else:
-                    # simplify this one too
-                    m = re.search(
-                        r"Sender address \[.*@(.*)\] blocked using dbl.spamhaus.org; (.*)", message
-                    )
-                    if m:
-                        message = "domain blocked: " + m.group(2)
 
-                if data["latest"] is None:
-                    data["latest"] = date
-                data["earliest"] = date
-                data["blocked"].append((date, sender, message))
+def profile_reads(readline):
+    """ Wrap a line reading generator to count the lines of a file and time reading them """
 
-                collector["rejected"][user] = data
+    def profiled(filename, *args):
+        data = PROFILE["files"][filename]
+        lines = readline(filename, *args)
 
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(lines)
+            except StopIteration:
+                return
+            finally:
+                data["read_time"] += time.perf_counter() - start
 
-def scan_dovecot_login_line(date, log, collector, protocol_name):
-    """ Scan a dovecot login log line and extract interesting data """
+            data["lines"] += 1
+            yield item
 
-    m = re.match("Info: Login: user=<(.*?)>, method=PLAIN, rip=(.*?),", log)
+    return profiled
 
-    if m:
-        # TODO: CHECK DIT
-        user, host = m.groups()
 
-        if user_match(user):
-            add_login(user, date, protocol_name, host, collector)
+def profile_file(scan):
+    """ Wrap scan_file to time the scan of a whole file """
 
+    def profiled(fn, *args):
+        data = PROFILE["files"][fn]
+        data["bytes"] = os.path.getsize(fn)
+        start = time.perf_counter()
+        try:
+            return scan(fn, *args)
+        finally:
+            data["time"] += time.perf_counter() - start
 
-def add_login(user, date, protocol_name, host, collector):
-            # Get the user data, or create it if the user is new
-            data = collector["logins"].get(
-                user,
-                {
-                    "earliest": None,
-                    "latest": None,
-                    "totals_by_protocol": defaultdict(int),
-                    "totals_by_protocol_and_host": defaultdict(int),
-                    "activity-by-hour": defaultdict(lambda : defaultdict(int)),
-                }
-            )
+    return profiled
 
-            if data["latest"] is None:
-                data["latest"] = date
-            data["earliest"] = date
 
-            data["totals_by_protocol"][protocol_name] += 1
-            data["totals_by_protocol_and_host"][(protocol_name, host)] += 1
+def get_profile():
+    """ Return the profile in plain JSON types, with the times in seconds """
 
-            if host not in ("127.0.0.1", "::1") or True:
-                data["activity-by-hour"][protocol_name][date.hour] += 1
+    return {
+        "parse": PROFILE["parse"],
+        "services": dict(PROFILE["services"]),
+        "scanners": dict(PROFILE["scanners"]),
+        "files": dict(PROFILE["files"]),
+    }
 
-            collector["logins"][user] = data
 
+# Utility functions
 
-def scan_postfix_lmtp_line(date, log, collector):
-    """ Scan a postfix lmtp log line and extract interesting data
+def forward_readline(filename, offset=0, end=None):
+    """ A generator that returns the complete lines of a file from the given byte offset onwards,
+    up to the end offset if given
 
-    It is assumed that every log of postfix/lmtp indicates an email that was successfully
-    received by Postfix.
+    Every line is returned together with the byte offset following it, i.e. where to continue
+    reading the file later on. Compressed files are decompressed on the fly, their offsets only
+    count the decompressed bytes.
 
     """
 
-    m = re.match("([A-Z0-9]+): to=<(\S+)>, .* Saved", log)
+    with (gzip.open if filename[-3:] == '.gz' else open)(filename, 'rb') as fh:
+        fh.seek(offset)
+        for line in fh:
+            # A line without a line break is still being written
+            if line[-1:] != b'\n' or (end is not None and offset + len(line) > end):
+                break
+            offset += len(line)
+            yield line.decode('utf8', 'replace'), offset
 
-    if m:
-        _, user = m.groups()
 
-        if user_match(user):
-            # Get the user data, or create it if the user is new
-            data = collector["received_mail"].get(
-                user,
-                {
-                    "received_count": 0,
-                    "earliest": None,
-                    "latest": None,
-                    "activity-by-hour": defaultdict(int),
-                }
-            )
+def file_entries(filename, offset=0, end=None):
+    """ A generator that returns the log entries in a file from the given byte offset onwards, up
+    to the end offset if given
 
-            data["received_count"] += 1
-            data["activity-by-hour"][date.hour] += 1
+    Every entry is returned as (date, service, log message) together with the byte offset
+    following it, like journal_entries does with the journal cursor.
 
-            if data["latest"] is None:
-                data["latest"] = date
-            data["earliest"] = date
+    """
 
-            collector["received_mail"][user] = data
+    for line, offset in forward_readline(filename, offset, end):
+        entry = parse_mail_log_line(line.strip())
+        if entry is not None:
+            yield entry, offset
 
 
-def scan_postfix_submission_line(date, log, collector):
-    """ Scan a postfix submission log line and extract interesting data
+def journal_entries(since=None, until=None, after_cursor=None, follow=False):
+    """ A generator that returns the mail log entries in the systemd journal
 
-    Lines containing a sasl_method with the values PLAIN or LOGIN are assumed to indicate a sent
-    email.
+    Every entry is returned as (date, service, log message) together with its cursor, i.e. where to
+    continue reading the journal later on.
+
+    Args:
+        since (datetime): Only return the entries from this date and time on
+        until (datetime): Only return the entries up to this date and time
+        after_cursor (str): Only return the entries after the one with this cursor
+        follow (bool): Keep waiting for new entries
 
     """
 
-    # Match both the 'plain' and 'login' sasl methods, since both authentication methods are
-    # allowed by Dovecot
-    m = re.match("([A-Z0-9]+): client=(\S+), sasl_method=(PLAIN|LOGIN), sasl_username=(\S+)", log)
+    args = list(JOURNALCTL)
+    if since is not None:
+        args.append("--since={:%Y-%m-%d %H:%M:%S}".format(since))
+    if until is not None:
+        args.append("--until={:%Y-%m-%d %H:%M:%S}".format(until))
+    if after_cursor is not None:
+        args.append("--after-cursor=" + after_cursor)
+    if follow:
+        args.append("--follow")
+
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+    try:
+        for line in proc.stdout:
+            record = json.loads(line)
+            entry = parse_journal_entry(record)
+            if entry is not None:
+                yield entry, record["__CURSOR"]
+    finally:
+        proc.terminate()
+        proc.wait()
 
-    if m:
-        _, client, method, user = m.groups()
 
-        if user_match(user):
-            # Get the user data, or create it if the user is new
-            data = collector["sent_mail"].get(
-                user,
-                {
-                    "sent_count": 0,
-                    "hosts": set(),
-                    "earliest": None,
-                    "latest": None,
-                    "activity-by-hour": defaultdict(int),
-                }
-            )
+def parse_journal_entry(record):
+    """ Get the date, service and log message of a journal entry in JSON, or None if it has no
+    log message """
 
-            data["sent_count"] += 1
-            data["hosts"].add(client)
-            data["activity-by-hour"][date.hour] += 1
+    identifier = record.get("SYSLOG_IDENTIFIER")
+    message = record.get("MESSAGE")
 
-            if data["latest"] is None:
-                data["latest"] = date
-            data["earliest"] = date
+    if identifier is None or message is None:
+        return None
 
-            collector["sent_mail"][user] = data
+    # Messages that aren't valid UTF-8 are given as arrays of bytes
+    if isinstance(message, list):
+        message = bytes(message).decode('utf8', 'replace')
 
-            # Also log this as a login.
-            add_login(user, date, "smtp", client, collector)
+    m = LOG_MESSAGE.match("{}: {}".format(identifier, message))
 
-# Utility functions
+    if not m:
+        return None
+
+    service, log = m.groups()
+    date = datetime.datetime.fromtimestamp(int(record["__REALTIME_TIMESTAMP"]) // 1000000)
 
-def reverse_readline(filename, buf_size=8192):
-    """ A generator that returns the lines of a file in reverse order
+    return date, service, log
+
+
+def reverse_readline(filename, end=None, buf_size=8192):
+    """ A generator that returns the lines of a file in reverse order, from the end offset if given
 
     http://stackoverflow.com/a/23646049/801870
 
@@ -589,7 +3375,7 @@ def reverse_readline(filename, buf_size=8192):
         segment = None
         offset = 0
         fh.seek(0, os.SEEK_END)
-        file_size = remaining_size = fh.tell()
+        file_size = remaining_size = fh.tell() if end is None else min(end, fh.tell())
         while remaining_size > 0:
             offset = min(file_size, offset + buf_size)
             fh.seek(file_size - offset)
@@ -616,11 +3402,100 @@ def reverse_readline(filename, buf_size=8192):
             yield segment
 
 
+def follow_offset(fn):
+    """ Return the byte offset to stop reading a log file at, when following it starts there """
+
+    if FOLLOW_POSITION is None or os.stat(fn).st_ino != FOLLOW_POSITION[0]:
+        return None
+
+    return FOLLOW_POSITION[1]
+
+
+def file_fingerprint(filename):
+    """ Return a hash of the first line of a file, to tell files apart that had the same inode
+
+    The first line of compressed files is decompressed, so that a file has the same fingerprint
+    before and after logrotate compressed it.
+
+    """
+    with (gzip.open if filename[-3:] == '.gz' else open)(filename, 'rb') as fh:
+        return hashlib.sha1(fh.readline(4096)).hexdigest()
+
+
+def delay_percentiles(delays):
+    """ Get the DELAY_PERCENTILES of the delays, or Nones when there are no delays """
+
+    if not delays:
+        return len(DELAY_PERCENTILES) * [None]
+
+    delays = sorted(delays)
+    return [round(delays[min(len(delays) - 1, int(len(delays) * p / 100))], 2)
+            for p in DELAY_PERCENTILES.values()]
+
+
+def hourly_delay_percentiles(delays, hours):
+    """ Get the DELAY_PERCENTILES of the delays for every hour of the day """
+
+    by_hour = [[] for _ in range(24)]
+    for delay, hour in zip(delays, hours):
+        by_hour[hour].append(delay)
+    return [delay_percentiles(hour_delays) for hour_delays in by_hour]
+
+
+def numstr_delay(delay):
+    return "-" if delay is None else str(delay)
+
+
+def min_date(date, other):
+    """ Return the earliest of two dates, either of which may be None """
+    if date is None or other is None:
+        return date or other
+    return min(date, other)
+
+
+def parse_timestamp(string):
+    """ Parse a date stored by str(), or return None if there is no date """
+    return datetime.datetime.fromisoformat(string) if string else None
+
+
 def user_match(user):
     """ Check if the given user matches any of the filters """
     return FILTERS is None or any(u in user for u in FILTERS)
 
 
+def select_rows(items, count=None, key=None, limit=None):
+    """ Select the rows of a report table, sorted by user or by count and paged
+
+    Only the rows of the page are sorted: they are picked with a heap, which takes a lot less time
+    than sorting all the rows when there are many users and few rows are shown.
+
+    Args:
+        items (iterable): The (user, data) pairs of the table
+        count (function): Get the count of the data of a user, for sorting by count
+        key (function): Sort the (user, data) pairs by this key instead, for tables that have an
+            order of their own
+        limit (int): Number of rows to show when no LIMIT is set, all when None
+
+    Returns:
+        list: The (user, data) pairs of the rows to show
+
+    """
+
+    if key is None:
+        if SORT == "count" and count is not None:
+            key = lambda item: (-count(item[1]), email_sort(item))
+        else:
+            key = email_sort
+
+    if LIMIT is not None:
+        limit = LIMIT
+
+    if limit is None:
+        return sorted(items, key=key)[OFFSET:]
+
+    return heapq.nsmallest(OFFSET + limit, items, key=key)[OFFSET:]
+
+
 def email_sort(email):
     """ Split the given email address into a reverse order tuple, for sorting i.e (domain, name) """
     return tuple(reversed(email[0].split('@')))
@@ -635,8 +3510,109 @@ def valid_date(string):
     return date
 
 
+def non_negative_int(string):
+    """ Validate the given number fetched from the --limit and --offset arguments """
+    try:
+        number = int(string)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Not a number: '%s'" % string)
+    if number < 0:
+        raise argparse.ArgumentTypeError("Must not be negative: '%s'" % string)
+    return number
+
+
+def positive_int(string):
+    """ Validate the given number fetched from the --interval, --max-sent and --max-login-ips
+    arguments """
+    number = non_negative_int(string)
+    if number == 0:
+        raise argparse.ArgumentTypeError("Must be more than 0: '%s'" % string)
+    return number
+
+
 # Print functions
 
+def print_postgrey_summaries(collector):
+    """ Print the greylisting counts and most frequent senders of the approximate mode """
+
+    msg = "Greylisted Email {:%Y-%m-%d %H:%M:%S} and {:%Y-%m-%d %H:%M:%S}"
+    print_header(msg.format(END_DATE, START_DATE))
+
+    print(textwrap.fill(
+        "The following mail was greylisted, meaning the emails were temporarily rejected. "
+        "Legitimate senders must try again after three minutes. The number of sending hosts "
+        "is estimated once there are more than {} per user, with a standard error of {:.1%}. "
+        "The counts of the top senders are at most the given error too high.".format(
+            sketches.HLL_SPARSE_LIMIT, 1.04 / (2 ** sketches.HLL_PRECISION) ** 0.5),
+        width=80, initial_indent=" ", subsequent_indent=" "
+    ), end='\n\n')
+
+    data = OrderedDict(select_rows(collector["postgrey"].items(), lambda u: u["greylisted"]))
+
+    print_user_table(
+        data.keys(),
+        data=[
+            ("greylisted", [u["greylisted"] for u in data.values()]),
+            ("delivered", [u["delivered"] for u in data.values()]),
+            ("sending hosts", [len(u["clients"]) for u in data.values()]),
+        ],
+        sub_data=[
+            ("top senders", [format_top(u["senders"]) for u in data.values()]),
+        ],
+        earliest=[u["earliest"] or START_DATE for u in data.values()],
+        latest=[u["latest"] or START_DATE for u in data.values()],
+        selected_from=len(collector["postgrey"]),
+    )
+
+
+def print_rejected_summaries(collector):
+    """ Print the blocked email counts and most frequent senders of the approximate mode """
+
+    msg = "Blocked Email {:%Y-%m-%d %H:%M:%S} and {:%Y-%m-%d %H:%M:%S}"
+    print_header(msg.format(END_DATE, START_DATE))
+
+    data = OrderedDict(select_rows(collector["rejected"].items(), lambda u: u["blocked_count"]))
+
+    print_user_table(
+        data.keys(),
+        data=[
+            ("blocked", [u["blocked_count"] for u in data.values()]),
+        ],
+        sub_data=[
+            ("top senders, counts at most the error too high",
+             [format_top(u["senders"]) for u in data.values()]),
+        ],
+        earliest=[u["earliest"] for u in data.values()],
+        latest=[u["latest"] for u in data.values()],
+        selected_from=len(collector["rejected"]),
+    )
+
+
+def format_top(summary, n=10):
+    """ Format the n most frequent items of a SpaceSaving summary """
+
+    return ["{}: {} times{}".format(item[:64], count, " (error {})".format(error) if error else "")
+            for item, count, error in summary.top(n)]
+
+
+def print_follow_report(collector):
+    """ Print the report of the data followed so far, replacing the previous one on a terminal """
+
+    if OUTPUT_FORMAT != "text":
+        print_mail_stats(get_collector_stats(collector), OUTPUT_FORMAT)
+        sys.stdout.flush()
+        return
+
+    if sys.stdout.isatty():
+        print("\033[H\033[2J", end='')
+
+    print("Following logs from {:%Y-%m-%d %H:%M:%S}, {scan_count} log lines scanned, "
+          "{parse_count} lines parsed at {:%H:%M:%S}\n".format(END_DATE, START_DATE, **collector))
+
+    print_mail_log_report(collector)
+    sys.stdout.flush()
+
+
 def print_time_table(labels, data, do_print=True):
     labels.insert(0, "hour")
     data.insert(0, [str(h) for h in range(24)])
@@ -664,16 +3640,26 @@ def print_time_table(labels, data, do_print=True):
 
 
 def print_user_table(users, data=None, sub_data=None, activity=None, latest=None, earliest=None,
-                     delimit=False, numstr=str):
+                     delimit=False, numstr=str, totals=True, selected_from=None):
     str_temp = "{:<32} "
     lines = []
     data = data or []
 
+    # Tell when select_rows left out rows, whose totals are then not known
+    if selected_from is not None:
+        shown = len(set(users)) if delimit else len(users)
+        if shown < selected_from:
+            if not shown:
+                print(" None of the {} rows are after the first {}.".format(selected_from, OFFSET))
+                return
+            print(" Rows {} to {} of {}.\n".format(OFFSET + 1, OFFSET + shown, selected_from))
+            totals = False
+
     col_widths = len(data) * [0]
     col_left = len(data) * [False]
     vert_pos = 0
 
-    do_accum = all(isinstance(n, (int, float)) for _, d in data for n in d)
+    do_accum = totals and all(isinstance(n, (int, float)) for _, d in data for n in d)
     data_accum = len(data) * ([0] if do_accum else [" "])
 
     last_user = None
@@ -778,7 +3764,7 @@ def print_user_table(users, data=None, sub_data=None, activity=None, latest=None
 
     # Print totals
 
-    data_accum = [numstr(a) for a in data_accum]
+    data_accum = [numstr(a) if do_accum else a for a in data_accum]
     footer = str_temp.format("Totals:" if do_accum else " ")
     for row, (l, _) in enumerate(data):
         temp = "{:>%d}" % max(5, len(l) + 1)
@@ -807,6 +3793,222 @@ def print_user_table(users, data=None, sub_data=None, activity=None, latest=None
     print("\n".join(lines))
 
 
+def print_mail_stats(stats, output_format):
+    """ Print the collected data as JSON or CSV """
+
+    if output_format == "json":
+        print(json.dumps(stats, indent=2, sort_keys=True))
+    else:
+        print(format_mail_stats_csv(stats), end='')
+
+
+def format_mail_stats_csv(stats):
+    """ Format the collected data as CSV, with a row per user and section of the report
+
+    Logins get a row per protocol, with the protocol in the detail column. Greylisted and blocked
+    email only have counts. Delivery delays get a row per percentile instead of counts.
+
+    """
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["section", "user", "detail", "count", "hosts", "earliest", "latest"] +
+                    ["hour %d" % h for h in range(24)])
+
+    no_activity = 24 * [""]
+
+    for user, data in stats["sent_mail"].items():
+        writer.writerow(["sent", user, "", data["sent_count"], len(data["hosts"]),
+                         data["earliest"], data["latest"]] + data["activity-by-hour"])
+
+    for user, data in stats["received_mail"].items():
+        writer.writerow(["received", user, "", data["received_count"], "",
+                         data["earliest"], data["latest"]] + data["activity-by-hour"])
+
+    for user, data in stats["logins"].items():
+        hosts = defaultdict(int)
+        for protocol_name, host, count in data["totals_by_protocol_and_host"]:
+            hosts[protocol_name] += 1
+        for protocol_name, count in data["totals_by_protocol"].items():
+            writer.writerow(["logins", user, protocol_name, count, hosts[protocol_name],
+                             data["earliest"], data["latest"]] +
+                            data["activity-by-hour"][protocol_name])
+
+    for user, data in stats["postgrey"].items():
+        if isinstance(data, dict):
+            # Approximate mode
+            writer.writerow(["greylisted", user, "", data["greylisted"],
+                             len(HyperLogLog.from_json(data["clients"])), data["earliest"],
+                             data["latest"]] + no_activity)
+            continue
+
+        first_dates = [first_date for _, _, first_date, _ in data if first_date]
+        writer.writerow(["greylisted", user, "", len(first_dates),
+                         len(set(client_address for client_address, *_ in data)),
+                         min(first_dates, default=None), max(first_dates, default=None)] +
+                        no_activity)
+
+    for user, data in stats["rejected"].items():
+        count = data["blocked_count"] if "blocked_count" in data else len(data["blocked"])
+        writer.writerow(["blocked", user, "", count, "",
+                         data["earliest"], data["latest"]] + no_activity)
+
+    # Outbound deliveries get a row per domain and outcome, with the domain in the user column
+    for domain, data in stats["outbound"].items():
+        for outcome in ("sent", "deferred", "bounced"):
+            writer.writerow(["outbound", domain, outcome, data[outcome], len(data["relays"]),
+                             data["earliest"], data["latest"]] + no_activity)
+
+    # Failed logins get a row per IP address and per account, in the user column. The hosts column
+    # has the number of accounts of an IP address and the number of IP addresses of an account.
+    failures = stats.get("auth_failures")
+    if failures and "distinct_ips" in failures:
+        # Approximate mode, only the most frequent IP addresses and accounts
+        for detail in ("ips", "accounts"):
+            for item, count, _ in SpaceSaving.from_json(failures[detail]).top():
+                writer.writerow(["auth_failures", item, detail, count, "", "", ""] + no_activity)
+    elif failures:
+        for ip, data in failures["ips"].items():
+            writer.writerow(["auth_failures", ip, "ips", data["count"], len(data["accounts"]),
+                             data["earliest"], data["latest"]] + no_activity)
+        for account, data in failures["accounts"].items():
+            writer.writerow(["auth_failures", account, "accounts", data["count"], len(data["ips"]),
+                             data["earliest"], data["latest"]] + no_activity)
+
+    # Delays get a row per percentile, with the percentile in the detail column
+    for user, data in stats["delays"].items():
+        hourly = hourly_delay_percentiles(data["delays"], data["hours"])
+        for i, (label, value) in enumerate(zip(DELAY_PERCENTILES, delay_percentiles(data["delays"]))):
+            writer.writerow(["delay", user, label, value, "", data["earliest"], data["latest"]] +
+                            [hourly[h][i] for h in range(24)])
+
+    return out.getvalue()
+
+
+def print_auth_failures(failures):
+    """ Print the failed logins by IP address and account, and the IP addresses fail2ban would
+    ban """
+
+    msg = "Failed logins {:%Y-%m-%d %H:%M:%S} and {:%Y-%m-%d %H:%M:%S}"
+    print_header(msg.format(END_DATE, START_DATE))
+
+    if APPROXIMATE:
+        ips, accounts = len(failures["distinct_ips"]), len(failures["distinct_accounts"])
+    else:
+        ips, accounts = len(failures["ips"]), len(failures["accounts"])
+
+    print(textwrap.fill(
+        "{} failed logins to IMAP, POP3 and SMTP from {} IP addresses, for {} accounts. The IP "
+        "addresses and accounts with the most failed logins:".format(
+            failures["count"], ips, accounts),
+        width=80, initial_indent=" ", subsequent_indent=" "
+    ), end='\n\n')
+
+    if APPROXIMATE:
+        for top in (failures["ips"].top(AUTH_FAILURE_TOP), failures["accounts"].top(AUTH_FAILURE_TOP)):
+            if top:
+                print_user_table(
+                    [item for item, _, _ in top],
+                    data=[
+                        ("failed", [count for _, count, _ in top]),
+                        ("error", [error for _, _, error in top]),
+                    ],
+                    totals=False,
+                )
+                print()
+    else:
+        # The most failed logins first
+        def most_failed(kv):
+            return -kv[1]["count"], kv[0]
+
+        top = select_rows(failures["ips"].items(), key=most_failed, limit=AUTH_FAILURE_TOP)
+        print_user_table(
+            [ip for ip, _ in top],
+            data=[
+                ("failed", [d["count"] for _, d in top]),
+                ("accounts", [len(d["accounts"]) for _, d in top]),
+                ("max in {}s".format(AUTH_FAILURE_WINDOW), [d["max_window"] for _, d in top]),
+            ],
+            earliest=[d["earliest"] for _, d in top],
+            latest=[d["latest"] for _, d in top],
+            totals=False,
+            selected_from=len(failures["ips"]),
+        )
+        print()
+
+        top = select_rows(failures["accounts"].items(), key=most_failed, limit=AUTH_FAILURE_TOP)
+        if top:
+            print_user_table(
+                [account for account, _ in top],
+                data=[
+                    ("failed", [d["count"] for _, d in top]),
+                    ("IPs", [len(d["ips"]) for _, d in top]),
+                ],
+                earliest=[d["earliest"] for _, d in top],
+                latest=[d["latest"] for _, d in top],
+                totals=False,
+                selected_from=len(failures["accounts"]),
+            )
+            print()
+
+        print(textwrap.fill(
+            "The IP addresses that failed to log in at least maxretry times within {} seconds, "
+            "the findtime of the dovecot and miab-postfix587 fail2ban jails, and their failed "
+            "logins:".format(AUTH_FAILURE_WINDOW),
+            width=80, initial_indent=" ", subsequent_indent=" "
+        ), end='\n\n')
+
+        banned = [[d for d in failures["ips"].values() if d["max_window"] >= maxretry]
+                  for maxretry in AUTH_FAILURE_MAXRETRY]
+
+        print_user_table(
+            ["maxretry {}".format(maxretry) for maxretry in AUTH_FAILURE_MAXRETRY],
+            data=[
+                ("IPs", [len(b) for b in banned]),
+                ("failed", [sum(d["count"] for d in b) for b in banned]),
+            ],
+            totals=False,
+        )
+
+    protocols = sorted(failures["activity-by-hour"])
+    print_time_table(protocols, [failures["activity-by-hour"][p] for p in protocols])
+
+
+def print_profile(profile):
+    """ Print the tables of a profile made by get_profile, with the times in milliseconds """
+
+    def ms(seconds):
+        return int(round(seconds * 1000))
+
+    print_header("Profile")
+    print("{} lines split into date, service and log message in {} ms".format(
+        profile["parse"]["lines"], ms(profile["parse"]["time"])))
+
+    for title, section, columns in (
+            ("Services", "services", (("lines", "lines"), ("parsed", "parsed"), ("ms", "time"))),
+            ("Scanners", "scanners", (("calls", "calls"), ("matched", "matched"),
+                                      ("regex ms", "regex_time"),
+                                      ("aggregation ms", "aggregation_time"))),
+            ("Files", "files", (("lines", "lines"), ("KiB", "bytes"), ("read ms", "read_time"),
+                                ("ms", "time")))):
+        if not profile[section]:
+            continue
+
+        print_header(title)
+
+        # Slowest first
+        data = sorted(profile[section].items(), key=lambda item: -item[1][columns[-1][1]])
+
+        print_user_table(
+            [name for name, _ in data],
+            data=[
+                (label, [ms(d[key]) if key.endswith("time") else
+                         d[key] // 1024 if key == "bytes" else d[key] for _, d in data])
+                for label, key in columns
+            ],
+        )
+
+
 def print_header(msg):
     print('\n' + msg)
     print("═" * len(msg), '\n')
@@ -838,6 +4040,12 @@ if __name__ == "__main__":
                         action="store_true")
     parser.add_argument("-b", "--blocked", help="Scan for blocked emails.",
                         action="store_true")
+    parser.add_argument("-D", "--delays", help="Scan for the delivery delays of emails, tracking "
+                        "messages by queue ID.", action="store_true")
+    parser.add_argument("-o", "--outbound", help="Scan for deliveries to remote domains.",
+                        action="store_true")
+    parser.add_argument("-A", "--auth-failures", help="Scan for failed IMAP, POP3 and SMTP logins "
+                        "by IP address and account.", action="store_true")
 
     parser.add_argument("-t", "--timespan", choices=TIME_DELTAS.keys(), default='today',
                         metavar='<time span>',
@@ -852,44 +4060,191 @@ if __name__ == "__main__":
                         help="Comma separated list of (partial) email addresses to filter the "
                              "output with.")
 
+    parser.add_argument("--seek", help="Find the time span in the uncompressed log files by binary "
+                        "search on the timestamps instead of reading them backwards line by "
+                        "line.", action="store_true")
+    parser.add_argument("--sort", choices=("user", "count"), default=SORT,
+                        help="Sort the report tables by user, or by count with the highest counts "
+                             "first. Defaults to 'user'.")
+    parser.add_argument("--limit", action="store", dest="limit", type=non_negative_int, metavar='<number>',
+                        help="Only show this number of rows of the report tables.")
+    parser.add_argument("--offset", action="store", dest="offset", type=non_negative_int, default=0,
+                        metavar='<number>',
+                        help="Skip this number of rows of the report tables, to page through "
+                             "them with --limit.")
+
+    parser.add_argument("-j", "--jobs", action="store", dest="jobs", type=int, default=1,
+                        metavar='<number>',
+                        help="Scan the log files in parallel, each in its own process, using up "
+                             "to this number of processes. Defaults to 1.")
+    parser.add_argument("-i", "--incremental", help="Only scan the log lines added since the "
+                        "previous incremental scan and take the rest from a checkpoint file. "
+                        "Time spans are extended to whole hours, and the data is approximate as "
+                        "with --approximate.", action="store_true")
+    parser.add_argument("--checkpoint-file", action="store", dest="checkpoint_file",
+                        default=DEFAULT_CHECKPOINT_FILE, metavar='<file>',
+                        help="Checkpoint file for incremental scans. Defaults to "
+                             "'{}'.".format(DEFAULT_CHECKPOINT_FILE))
+
+    parser.add_argument("--ingest", help="Add the counts per user and hour of the log lines "
+                        "added since the previous ingest to the database in STORAGE_ROOT, and "
+                        "don't report.", action="store_true")
+    parser.add_argument("--database", help="Report the counts per user and hour from the database "
+                        "instead of scanning the log files. Time spans are extended to whole "
+                        "hours.", action="store_true")
+
+    parser.add_argument("-F", "--follow", help="Keep following the log file for new lines after "
+                        "scanning the time span, and print the report periodically.",
+                        action="store_true")
+    parser.add_argument("--interval", action="store", dest="interval", type=positive_int,
+                        default=FOLLOW_INTERVAL, metavar='<seconds>',
+                        help="Seconds between the reports when following the log file. Defaults "
+                             "to {}.".format(FOLLOW_INTERVAL))
+
+    parser.add_argument("-a", "--approximate", help="Only keep counts, estimates of the number "
+                        "of sending hosts and the most frequent senders of greylisted and blocked "
+                        "email, in a fixed amount of memory per user.", action="store_true")
+
+    parser.add_argument("--detect", help="Follow the log file like --follow does, and alert the "
+                        "administrator by email about users that send more email or log in from "
+                        "more IP addresses than the limits within {} minutes. Only prints the "
+                        "report with --follow.".format(DETECT_WINDOW // 60), action="store_true")
+    parser.add_argument("--max-sent", action="store", dest="max_sent", type=positive_int,
+                        default=DETECT_MAX_SENT, metavar='<number>',
+                        help="Limit of sent emails per user for --detect. Defaults to "
+                             "{}.".format(DETECT_MAX_SENT))
+    parser.add_argument("--max-login-ips", action="store", dest="max_login_ips", type=positive_int,
+                        default=DETECT_MAX_LOGIN_IPS, metavar='<number>',
+                        help="Limit of IP addresses a user logs in from for --detect. Defaults to "
+                             "{}.".format(DETECT_MAX_LOGIN_IPS))
+
+    parser.add_argument("--merge", nargs="+", metavar="<file or URL>",
+                        help="Report over the data collected on several boxes instead of scanning "
+                             "the log files. Give the files output with --format json, or the URLs "
+                             "of /admin/system/mail-stats on the boxes, with an API key as user "
+                             "name.")
+
+    parser.add_argument("--source", choices=("files", "journal"), default="files",
+                        help="Read the mail log files in /var/log, or the mail log entries in the "
+                             "systemd journal. Defaults to 'files'.")
+
+    parser.add_argument("--profile", help="Print how many lines of each service, scanner and file "
+                        "were scanned and the time they took, after the report.",
+                        action="store_true")
+    parser.add_argument("--profile-json", action="store", dest="profile_json", metavar='<file>',
+                        help="Write the profile as JSON to the file.")
+
+    parser.add_argument("-f", "--format", choices=("text", "json", "csv"), default="text",
+                        help="Output the report as text tables, or output the collected data as "
+                             "JSON or CSV. Defaults to 'text'.")
+
     parser.add_argument('-h', '--help', action='help', help="Print this message and exit.")
     parser.add_argument("-v", "--verbose", help="Output extra data where available.",
                         action="store_true")
 
     args = parser.parse_args()
 
+    if args.approximate and (args.ingest or args.database):
+        parser.error("--approximate can't be combined with --ingest or --database")
+    if args.merge and (args.incremental or args.ingest or args.database or args.follow or
+                       args.detect):
+        parser.error("--merge can't be combined with --incremental, --ingest, --database, "
+                     "--follow or --detect")
+
+    if (args.profile or args.profile_json) and args.jobs > 1:
+        parser.error("--profile can't be combined with --jobs")
+
+    OUTPUT_FORMAT = args.format
+    APPROXIMATE = args.approximate or args.incremental  # The checkpoint keeps approximate data
+    LOG_SOURCE = args.source
+
+    # Keep stdout clean for the collected data
+    info = sys.stdout if OUTPUT_FORMAT == "text" else sys.stderr
+
     if args.startdate is not None:
         START_DATE = args.startdate
         if args.timespan == 'today':
             args.timespan = 'day'
-        print("Setting start date to {}".format(START_DATE))
+        print("Setting start date to {}".format(START_DATE), file=info)
 
     END_DATE = START_DATE - TIME_DELTAS[args.timespan]
 
     VERBOSE = args.verbose
-
-    if args.received or args.sent or args.logins or args.grey or args.blocked:
+    SEEK = args.seek
+    SORT = args.sort
+    LIMIT = args.limit
+    OFFSET = args.offset
+    JOBS = args.jobs
+
+    if args.received or args.sent or args.logins or args.grey or args.blocked or args.delays or \
+            args.outbound or args.auth_failures:
         SCAN_IN = args.received
         if not SCAN_IN:
-            print("Ignoring received emails")
+            print("Ignoring received emails", file=info)
 
         SCAN_OUT = args.sent
         if not SCAN_OUT:
-            print("Ignoring sent emails")
+            print("Ignoring sent emails", file=info)
 
         SCAN_DOVECOT_LOGIN = args.logins
         if not SCAN_DOVECOT_LOGIN:
-            print("Ignoring logins")
+            print("Ignoring logins", file=info)
 
         SCAN_GREY = args.grey
         if SCAN_GREY:
-            print("Showing greylisted emails")
+            print("Showing greylisted emails", file=info)
 
         SCAN_BLOCKED = args.blocked
         if SCAN_BLOCKED:
-            print("Showing blocked emails")
+            print("Showing blocked emails", file=info)
+
+        SCAN_DELAYS = args.delays
+        if SCAN_DELAYS:
+            print("Showing delivery delays", file=info)
+
+        SCAN_OUTBOUND = args.outbound
+        if SCAN_OUTBOUND:
+            print("Showing outbound deliveries", file=info)
+
+        SCAN_AUTH_FAILURES = args.auth_failures
+        if SCAN_AUTH_FAILURES:
+            print("Showing failed logins", file=info)
 
     if args.users is not None:
         FILTERS = args.users.strip().split(',')
 
-    scan_mail_log(env_vars)
+    if args.incremental:
+        CHECKPOINT_FILE = args.checkpoint_file
+
+    FROM_DATABASE = args.database
+    FOLLOW_INTERVAL = args.interval
+
+    if args.profile or args.profile_json:
+        enable_profiling()
+
+    if args.merge:
+        try:
+            report_snapshots(args.merge)
+        except (OSError, ValueError) as e:
+            print("Can't merge the snapshots: {}".format(e), file=sys.stderr)
+            sys.exit(1)
+    elif args.ingest:
+        print("{} Log lines ingested".format(ingest_mail_log(env_vars)))
+    elif args.detect:
+        # The detector needs the sent email and logins
+        SCAN_OUT = SCAN_DOVECOT_LOGIN = True
+        follow_mail_log(env_vars, report=args.follow,
+                        detector=AnomalyDetector(args.max_sent, args.max_login_ips))
+    elif args.follow:
+        follow_mail_log(env_vars)
+    else:
+        scan_mail_log(env_vars)
+
+    if args.profile:
+        # Keep stdout clean for the collected data
+        with contextlib.redirect_stdout(sys.stdout if OUTPUT_FORMAT == "text" else sys.stderr):
+            print_profile(get_profile())
+
+    if args.profile_json:
+        with open(args.profile_json, "w") as f:
+            json.dump(get_profile(), f, indent=2, sort_keys=True)
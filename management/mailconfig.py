@@ -9,8 +9,8 @@
 # Python 3 in setup/questions.sh to validate the email
 # address entered by the user.
 
-import subprocess, shutil, os, sqlite3, re
-import utils
+import subprocess, shutil, os, sqlite3, re, threading, contextlib
+import utils, passwords
 from email_validator import validate_email as validate_email_, EmailNotValidError
 import idna
 
@@ -91,13 +91,69 @@ def is_dcv_address(email):
 			return True
 	return False
 
+# Each thread keeps its connections to users.sqlite open, by database path,
+# until close_database() is called. The management daemon calls it at the
+# end of every request, so a request opens the database once however many
+# queries it makes.
+_connections = threading.local()
+
+# How long to wait for a lock held by Postfix, Dovecot, Roundcube or another
+# request before giving up, in seconds.
+DATABASE_BUSY_TIMEOUT = 15
+
+def get_database_connection(env):
+	path = env["STORAGE_ROOT"] + "/mail/users.sqlite"
+	pool = _connections.__dict__.setdefault("pool", {})
+	if path not in pool:
+		# The connection is in autocommit mode: changes are made in explicit
+		# transactions by database_transaction(). The database keeps its
+		# rollback journal rather than using WAL mode: Postfix and Dovecot
+		# read it as users who can't write to the mail directory, so they
+		# could not create the -wal and -shm files WAL mode needs.
+		conn = sqlite3.connect(path, timeout=DATABASE_BUSY_TIMEOUT, isolation_level=None)
+		pool[path] = conn
+	return pool[path]
+
 def open_database(env, with_connection=False):
-	conn = sqlite3.connect(env["STORAGE_ROOT"] + "/mail/users.sqlite")
+	conn = get_database_connection(env)
 	if not with_connection:
 		return conn.cursor()
 	else:
 		return conn, conn.cursor()
 
+@contextlib.contextmanager
+def database_transaction(env):
+	# Yields a cursor for making changes, which are committed when the block
+	# ends and rolled back if it raises. BEGIN IMMEDIATE takes the write lock
+	# up front, so that two writers wait for each other rather than one of
+	# them failing partway through.
+	conn = get_database_connection(env)
+	conn.execute("BEGIN IMMEDIATE")
+	try:
+		yield conn.cursor()
+	except:
+		conn.execute("ROLLBACK")
+		raise
+	else:
+		conn.execute("COMMIT")
+
+def close_database():
+	# Closes the connections of the current thread.
+	pool = _connections.__dict__.pop("pool", {})
+	for conn in pool.values():
+		conn.close()
+
+def get_database_version(env):
+	# Returns a value that changes whenever users.sqlite is written to, by us
+	# or by anything else such as Roundcube's password plugin, without
+	# querying it: the modification time and size of the database.
+	path = env["STORAGE_ROOT"] + "/mail/users.sqlite"
+	try:
+		st = os.stat(path)
+	except FileNotFoundError:
+		return None
+	return (st.st_mtime_ns, st.st_size)
+
 def get_mail_users(env):
 	# Returns a flat, sorted list of all user accounts.
 	c = open_database(env)
@@ -266,19 +322,22 @@ def get_mail_domains(env, filter_aliases=lambda alias : True):
 		 + [get_domain(address, as_unicode=False) for address, *_ in get_mail_aliases(env) if filter_aliases(address) ]
 		 )
 
-def add_mail_user(email, pw, privs, env):
+def validate_new_mail_user(email, pw, privs, is_first_user):
+	# Validates a new user account. Returns its list of privileges, or raises
+	# a ValueError with an error message.
+
 	# validate email
 	if email.strip() == "":
-		return ("No email address provided.", 400)
+		raise ValueError("No email address provided.")
 	elif not validate_email(email):
-		return ("Invalid email address.", 400)
+		raise ValueError("Invalid email address.")
 	elif not validate_email(email, mode='user'):
-		return ("User account email addresses may only use the lowercase ASCII letters a-z, the digits 0-9, underscore (_), hyphen (-), and period (.).", 400)
-	elif is_dcv_address(email) and len(get_mail_users(env)) > 0:
+		raise ValueError("User account email addresses may only use the lowercase ASCII letters a-z, the digits 0-9, underscore (_), hyphen (-), and period (.).")
+	elif is_dcv_address(email) and not is_first_user:
 		# Make domain control validation hijacking a little harder to mess up by preventing the usual
 		# addresses used for DCV from being user accounts. Except let it be the first account because
 		# during box setup the user won't know the rules.
-		return ("You may not make a user account for that address because it is frequently used for domain control validation. Use an alias instead if necessary.", 400)
+		raise ValueError("You may not make a user account for that address because it is frequently used for domain control validation. Use an alias instead if necessary.")
 
 	# validate password
 	validate_password(pw)
@@ -290,27 +349,83 @@ def add_mail_user(email, pw, privs, env):
 		privs = privs.split("\n")
 		for p in privs:
 			validation = validate_privilege(p)
-			if validation: return validation
+			if validation: raise ValueError(validation[0])
 
-	# get the database
-	conn, c = open_database(env, with_connection=True)
+	return privs
+
+def add_mail_user(email, pw, privs, env, do_kick=True):
+	# validate
+	try:
+		privs = validate_new_mail_user(email, pw, privs, len(get_mail_users(env)) == 0)
+	except ValueError as e:
+		return (str(e), 400)
 
 	# hash the password
 	pw = hash_password(pw)
 
-	# add the user to the database
+	# add the user to the database, which is written before the next step
 	try:
-		c.execute("INSERT INTO users (email, password, privileges) VALUES (?, ?, ?)",
-			(email, pw, "\n".join(privs)))
+		with database_transaction(env) as c:
+			c.execute("INSERT INTO users (email, password, privileges) VALUES (?, ?, ?)",
+				(email, pw, "\n".join(privs)))
 	except sqlite3.IntegrityError:
 		return ("User already exists.", 400)
 
-	# write databasebefore next step
-	conn.commit()
+	if not do_kick:
+		return "mail user added"
 
 	# Update things in case any new domains are added.
 	return kick(env, "mail user added")
 
+def add_mail_users(users, env, do_kick=True):
+	# Adds many user accounts at once, for instance when a whole organization
+	# moves its mail to the box. Each user is a dict with "email", "password"
+	# and optionally "privileges", like the arguments of add_mail_user or as a
+	# list. Every
+	# account is validated before any is added, then the passwords are hashed
+	# in parallel, the accounts are inserted in a single transaction, and
+	# kick() runs once at the end rather than once per account.
+	existing_users = set(get_mail_users(env))
+	new_users = []
+	errors = []
+	for i, user in enumerate(users, 1):
+		email = str(user.get("email") or "")
+		pw = str(user.get("password") or "")
+		privs = user.get("privileges")
+		if isinstance(privs, list): privs = "\n".join(privs)
+		try:
+			if email in existing_users:
+				raise ValueError("User already exists.")
+			privs = validate_new_mail_user(email, pw, privs, len(existing_users) == 0)
+		except ValueError as e:
+			errors.append("user %d (%s): %s" % (i, email, e))
+			continue
+		existing_users.add(email)
+		new_users.append((email, pw, "\n".join(privs)))
+
+	if errors:
+		return ("No users were added.\n" + "".join(e + "\n" for e in errors), 400)
+	if len(new_users) == 0:
+		return ("No users provided.", 400)
+
+	# hash the passwords
+	hashes = passwords.hash_passwords([pw for email, pw, privs in new_users])
+
+	# add the users to the database, all or none of them
+	try:
+		with database_transaction(env) as c:
+			c.executemany("INSERT INTO users (email, password, privileges) VALUES (?, ?, ?)",
+				[(email, pw_hash, privs) for (email, pw, privs), pw_hash in zip(new_users, hashes)])
+	except sqlite3.IntegrityError:
+		return ("No users were added because a user was added at the same time.", 400)
+
+	return_status = "%d mail users added" % len(new_users)
+	if not do_kick:
+		return return_status
+
+	# Update things in case any new domains are added.
+	return kick(env, return_status)
+
 def set_mail_password(email, pw, env):
 	# validate that password is acceptable
 	validate_password(pw)
@@ -319,18 +434,17 @@ def set_mail_password(email, pw, env):
 	pw = hash_password(pw)
 
 	# update the database
-	conn, c = open_database(env, with_connection=True)
-	c.execute("UPDATE users SET password=? WHERE email=?", (pw, email))
-	if c.rowcount != 1:
-		return ("That's not a user (%s)." % email, 400)
-	conn.commit()
+	with database_transaction(env) as c:
+		c.execute("UPDATE users SET password=? WHERE email=?", (pw, email))
+		if c.rowcount != 1:
+			return ("That's not a user (%s)." % email, 400)
 	return "OK"
 
 def hash_password(pw):
 	# Turn the plain password into a Dovecot-format hashed password, meaning
 	# something like "{SCHEME}hashedpassworddata".
 	# http://wiki2.dovecot.org/Authentication/PasswordSchemes
-	return utils.shell('check_output', ["/usr/bin/doveadm", "pw", "-s", "SHA512-CRYPT", "-p", pw]).strip()
+	return passwords.hash_password(pw)
 
 def get_mail_password(email, env):
 	# Gets the hashed password for a user. Passwords are stored in Dovecot's
@@ -344,13 +458,15 @@ def get_mail_password(email, env):
 		raise ValueError("That's not a user (%s)." % email)
 	return rows[0][0]
 
-def remove_mail_user(email, env):
+def remove_mail_user(email, env, do_kick=True):
 	# remove
-	conn, c = open_database(env, with_connection=True)
-	c.execute("DELETE FROM users WHERE email=?", (email,))
-	if c.rowcount != 1:
-		return ("That's not a user (%s)." % email, 400)
-	conn.commit()
+	with database_transaction(env) as c:
+		c.execute("DELETE FROM users WHERE email=?", (email,))
+		if c.rowcount != 1:
+			return ("That's not a user (%s)." % email, 400)
+
+	if not do_kick:
+		return "mail user removed"
 
 	# Update things in case any domains are removed.
 	return kick(env, "mail user removed")
@@ -392,15 +508,19 @@ def add_remove_mail_user_privilege(email, priv, action, env):
 		return ("Invalid action.", 400)
 
 	# commit to database
-	conn, c = open_database(env, with_connection=True)
-	c.execute("UPDATE users SET privileges=? WHERE email=?", ("\n".join(privs), email))
-	if c.rowcount != 1:
-		return ("Something went wrong.", 400)
-	conn.commit()
+	with database_transaction(env) as c:
+		c.execute("UPDATE users SET privileges=? WHERE email=?", ("\n".join(privs), email))
+		if c.rowcount != 1:
+			return ("Something went wrong.", 400)
 
 	return "OK"
 
-def add_mail_alias(address, forwards_to, permitted_senders, env, update_if_exists=False, do_kick=True):
+def validate_mail_alias(address, forwards_to, permitted_senders, env, valid_logins=None):
+	# Validates an alias. Returns its address, forwarding addresses and
+	# permitted senders as they are stored in the database, or raises a
+	# ValueError with an error message. valid_logins is the set of user
+	# accounts, which is queried if not given.
+
 	# convert Unicode domain to IDNA
 	address = sanitize_idn_email_address(address)
 
@@ -411,9 +531,9 @@ def add_mail_alias(address, forwards_to, permitted_senders, env, update_if_exist
 	# validate address
 	address = address.strip()
 	if address == "":
-		return ("No email address provided.", 400)
+		raise ValueError("No email address provided.")
 	if not validate_email(address, mode='alias'):
-		return ("Invalid email address (%s)." % address, 400)
+		raise ValueError("Invalid email address (%s)." % address)
 
 	# validate forwards_to
 	validated_forwards_to = []
@@ -442,16 +562,17 @@ def add_mail_alias(address, forwards_to, permitted_senders, env, update_if_exist
 				# Strip any +tag from email alias and check privileges
 				privileged_email = re.sub(r"(?=\+)[^@]*(?=@)",'',email)
 				if not validate_email(email):
-					return ("Invalid receiver email address (%s)." % email, 400)
+					raise ValueError("Invalid receiver email address (%s)." % email)
 				if is_dcv_source and not is_dcv_address(email) and "admin" not in get_mail_user_privileges(privileged_email, env, empty_on_error=True):
 					# Make domain control validation hijacking a little harder to mess up by
 					# requiring aliases for email addresses typically used in DCV to forward
 					# only to accounts that are administrators on this system.
-					return ("This alias can only have administrators of this system as destinations because the address is frequently used for domain control validation.", 400)
+					raise ValueError("This alias can only have administrators of this system as destinations because the address is frequently used for domain control validation.")
 				validated_forwards_to.append(email)
 
 	# validate permitted_senders
-	valid_logins = get_mail_users(env)
+	if valid_logins is None:
+		valid_logins = set(get_mail_users(env))
 	validated_permitted_senders = []
 	permitted_senders = permitted_senders.strip()
 
@@ -462,14 +583,14 @@ def add_mail_alias(address, forwards_to, permitted_senders, env, update_if_exist
 			login = login.strip()
 			if login == "": continue
 			if login not in valid_logins:
-				return ("Invalid permitted sender: %s is not a user on this system." % login, 400)
+				raise ValueError("Invalid permitted sender: %s is not a user on this system." % login)
 			validated_permitted_senders.append(login)
 
 	# Make sure the alias has either a forwards_to or a permitted_sender.
 	if len(validated_forwards_to) + len(validated_permitted_senders) == 0:
-		return ("The alias must either forward to an address or have a permitted sender.", 400)
+		raise ValueError("The alias must either forward to an address or have a permitted sender.")
 
-	# save to db
+	# the values to save to db
 
 	forwards_to = ",".join(validated_forwards_to)
 
@@ -478,37 +599,99 @@ def add_mail_alias(address, forwards_to, permitted_senders, env, update_if_exist
 	else:
 		permitted_senders = ",".join(validated_permitted_senders)
 
-	conn, c = open_database(env, with_connection=True)
+	return address, forwards_to, permitted_senders
+
+def add_mail_alias(address, forwards_to, permitted_senders, env, update_if_exists=False, do_kick=True):
+	# validate
 	try:
-		c.execute("INSERT INTO aliases (source, destination, permitted_senders) VALUES (?, ?, ?)", (address, forwards_to, permitted_senders))
-		return_status = "alias added"
-	except sqlite3.IntegrityError:
-		if not update_if_exists:
-			return ("Alias already exists (%s)." % address, 400)
+		address, forwards_to, permitted_senders = validate_mail_alias(address, forwards_to, permitted_senders, env)
+	except ValueError as e:
+		return (str(e), 400)
+
+	# save to db
+	with database_transaction(env) as c:
+		try:
+			c.execute("INSERT INTO aliases (source, destination, permitted_senders) VALUES (?, ?, ?)", (address, forwards_to, permitted_senders))
+			return_status = "alias added"
+		except sqlite3.IntegrityError:
+			if not update_if_exists:
+				return ("Alias already exists (%s)." % address, 400)
+			else:
+				c.execute("UPDATE aliases SET destination = ?, permitted_senders = ? WHERE source = ?", (forwards_to, permitted_senders, address))
+				return_status = "alias updated"
+
+	if not do_kick:
+		return return_status
+
+	# Update things in case any new domains are added.
+	return kick(env, return_status)
+
+def add_mail_aliases(aliases, env, update_if_exists=False, do_kick=True):
+	# Adds many aliases at once. Each alias is a dict with "address",
+	# "forwards_to" and optionally "permitted_senders", like the arguments of
+	# add_mail_alias. As with add_mail_users, every alias is validated before
+	# any is added, they are saved in a single transaction, and kick() runs
+	# once at the end.
+	valid_logins = set(get_mail_users(env))
+	existing_aliases = set(address for address, *_ in get_mail_aliases(env))
+	seen = set()
+	new_aliases = []
+	updated_aliases = []
+	errors = []
+	for i, alias in enumerate(aliases, 1):
+		address = str(alias.get("address") or "")
+		try:
+			address, forwards_to, permitted_senders = validate_mail_alias(address,
+				str(alias.get("forwards_to") or ""), str(alias.get("permitted_senders") or ""),
+				env, valid_logins=valid_logins)
+			if address in seen:
+				raise ValueError("The alias is listed more than once.")
+			if address in existing_aliases and not update_if_exists:
+				raise ValueError("Alias already exists (%s)." % address)
+		except ValueError as e:
+			errors.append("alias %d (%s): %s" % (i, address, e))
+			continue
+		seen.add(address)
+		if address in existing_aliases:
+			updated_aliases.append((forwards_to, permitted_senders, address))
 		else:
-			c.execute("UPDATE aliases SET destination = ?, permitted_senders = ? WHERE source = ?", (forwards_to, permitted_senders, address))
-			return_status = "alias updated"
+			new_aliases.append((address, forwards_to, permitted_senders))
+
+	if errors:
+		return ("No aliases were added.\n" + "".join(e + "\n" for e in errors), 400)
+	if len(new_aliases) + len(updated_aliases) == 0:
+		return ("No aliases provided.", 400)
+
+	# save to db, all or none of them
+	try:
+		with database_transaction(env) as c:
+			c.executemany("INSERT INTO aliases (source, destination, permitted_senders) VALUES (?, ?, ?)", new_aliases)
+			c.executemany("UPDATE aliases SET destination = ?, permitted_senders = ? WHERE source = ?", updated_aliases)
+	except sqlite3.IntegrityError:
+		return ("No aliases were added because an alias was added at the same time.", 400)
 
-	conn.commit()
+	return_status = "%d aliases added, %d updated" % (len(new_aliases), len(updated_aliases))
+	if not do_kick:
+		return return_status
 
-	if do_kick:
-		# Update things in case any new domains are added.
-		return kick(env, return_status)
+	# Update things in case any new domains are added.
+	return kick(env, return_status)
 
 def remove_mail_alias(address, env, do_kick=True):
 	# convert Unicode domain to IDNA
 	address = sanitize_idn_email_address(address)
 
 	# remove
-	conn, c = open_database(env, with_connection=True)
-	c.execute("DELETE FROM aliases WHERE source=?", (address,))
-	if c.rowcount != 1:
-		return ("That's not an alias (%s)." % address, 400)
-	conn.commit()
-
-	if do_kick:
-		# Update things in case any domains are removed.
-		return kick(env, "alias removed")
+	with database_transaction(env) as c:
+		c.execute("DELETE FROM aliases WHERE source=?", (address,))
+		if c.rowcount != 1:
+			return ("That's not an alias (%s)." % address, 400)
+
+	if not do_kick:
+		return "alias removed"
+
+	# Update things in case any domains are removed.
+	return kick(env, "alias removed")
 
 def get_system_administrator(env):
 	return "administrator@" + env['PRIMARY_HOSTNAME']
@@ -0,0 +1,179 @@
+# Hashes and checks passwords in Dovecot's format, a scheme prefix followed by
+# the hash, like "{SHA512-CRYPT}$6$salt$hash", without running doveadm for
+# every password. Schemes that can't be handled here are passed on to
+# 'doveadm pw', so any hash Dovecot accepts is accepted here too.
+# http://wiki2.dovecot.org/Authentication/PasswordSchemes
+
+import hashlib, hmac, json, os, re, subprocess, sys, multiprocessing.pool
+
+import utils
+
+# The scheme of the passwords set by the control panel.
+DEFAULT_SCHEME = "SHA512-CRYPT"
+
+# The characters of the crypt(3) variant of base64.
+ITOA64 = "./0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+# Dovecot's SHA512-CRYPT hashes have a 16 character salt and the default
+# 5000 rounds, which then aren't written out in the hash.
+SHA512_SALT_LENGTH = 16
+SHA512_DEFAULT_ROUNDS = 5000
+
+# Below this many passwords, hash_passwords() doesn't bother starting worker
+# processes.
+PARALLEL_HASHING_THRESHOLD = 16
+
+# The order in which the bytes of the final SHA-512 digest are encoded, three
+# at a time, as given by the SHA-crypt specification. The last byte, 63, is
+# encoded on its own.
+SHA512_BYTE_ORDER = (
+	(0, 21, 42), (22, 43, 1), (44, 2, 23), (3, 24, 45), (25, 46, 4), (47, 5, 26),
+	(6, 27, 48), (28, 49, 7), (50, 8, 29), (9, 30, 51), (31, 52, 10), (53, 11, 32),
+	(12, 33, 54), (34, 55, 13), (56, 14, 35), (15, 36, 57), (37, 58, 16), (59, 17, 38),
+	(18, 39, 60), (40, 61, 19), (62, 20, 41),
+)
+
+SCHEME_PREFIX = re.compile(r"^\{([A-Z0-9.-]+)\}(.*)$", re.S)
+SHA512_CRYPT_HASH = re.compile(r"^\$6\$(?:rounds=(\d+)\$)?([^$]{0,16})(?:\$([./0-9A-Za-z]{86}))?$")
+
+def hash_password(pw, scheme=DEFAULT_SCHEME):
+	# Turn the plain password into a Dovecot-format hashed password, meaning
+	# something like "{SCHEME}hashedpassworddata".
+	if scheme == "SHA512-CRYPT":
+		salt = "".join(ITOA64[b % 64] for b in os.urandom(SHA512_SALT_LENGTH))
+		return "{SHA512-CRYPT}" + sha512_crypt(pw, salt)
+
+	elif scheme == "BLF-CRYPT":
+		bcrypt = optional_import("bcrypt")
+		if bcrypt:
+			# Dovecot writes the $2y$ prefix, which is the same algorithm as
+			# $2b$ for every correct implementation.
+			pw_hash = bcrypt.hashpw(pw.encode("utf8"), bcrypt.gensalt(rounds=5)).decode("ascii")
+			return "{BLF-CRYPT}$2y$" + pw_hash[4:]
+
+	elif scheme == "ARGON2ID":
+		argon2 = optional_import("argon2")
+		if argon2:
+			# Dovecot's parameters for ARGON2ID, in the same encoding.
+			hasher = argon2.PasswordHasher(time_cost=3, memory_cost=65536, parallelism=1,
+				type=argon2.Type.ID)
+			return "{ARGON2ID}" + hasher.hash(pw)
+
+	return utils.shell('check_output', ["/usr/bin/doveadm", "pw", "-s", scheme, "-p", pw]).strip()
+
+def hash_passwords(pws, scheme=DEFAULT_SCHEME):
+	# Hashes a list of passwords, for adding many users at once. Hashing is
+	# CPU-bound, so it is spread over worker processes, one per CPU. They
+	# aren't started from the management daemon: a forked copy of it could
+	# inherit locks held by its other threads, and a spawned worker would run
+	# the daemon's module code again. Instead this module is run on its own,
+	# and forks the workers itself. The passwords go over stdin and stdout.
+	if len(pws) < PARALLEL_HASHING_THRESHOLD:
+		return [hash_password(pw, scheme) for pw in pws]
+	proc = subprocess.run([sys.executable, os.path.abspath(__file__), scheme],
+		input=json.dumps(pws), stdout=subprocess.PIPE, universal_newlines=True, check=True)
+	return json.loads(proc.stdout)
+
+def verify_password(pw, pw_hash):
+	# Returns whether the plain password matches the Dovecot-format hashed
+	# password.
+	m = SCHEME_PREFIX.match(pw_hash)
+	scheme, hashed = (m.group(1), m.group(2)) if m else (None, pw_hash)
+
+	if scheme == "SHA512-CRYPT":
+		m = SHA512_CRYPT_HASH.match(hashed)
+		if m and m.group(3):
+			rounds = int(m.group(1)) if m.group(1) else None
+			return hmac.compare_digest(sha512_crypt(pw, m.group(2), rounds), hashed)
+
+	elif scheme == "BLF-CRYPT" and hashed.startswith("$2"):
+		bcrypt = optional_import("bcrypt")
+		if bcrypt:
+			# bcrypt doesn't know the $2y$ prefix, which is the same as $2b$.
+			hashed = "$2b$" + hashed[4:] if hashed.startswith("$2y$") else hashed
+			try:
+				return bcrypt.checkpw(pw.encode("utf8"), hashed.encode("ascii"))
+			except ValueError:
+				return False
+
+	elif scheme in ("ARGON2I", "ARGON2ID") and hashed.startswith("$argon2"):
+		argon2 = optional_import("argon2")
+		if argon2:
+			try:
+				return argon2.PasswordHasher().verify(hashed, pw)
+			except argon2.exceptions.VerifyMismatchError:
+				return False
+			except argon2.exceptions.InvalidHash:
+				pass
+
+	# Let doveadm check any other hash. It exits with a non-zero status if the
+	# password doesn't match, and check_call raises an exception in that case.
+	try:
+		utils.shell('check_call', ["/usr/bin/doveadm", "pw", "-p", pw, "-t", pw_hash])
+		return True
+	except:
+		return False
+
+def sha512_crypt(pw, salt, rounds=None):
+	# Computes the SHA-512 crypt(3) hash of the password, "$6$salt$hash", as
+	# specified at https://www.akkadia.org/drepper/SHA-crypt.txt. The system's
+	# crypt(3) gives the same result but can't be relied on: Python's crypt
+	# module is gone as of Python 3.13.
+	p = pw.encode("utf8")
+	s = salt.encode("utf8")[:SHA512_SALT_LENGTH]
+	if rounds is not None:
+		rounds = min(max(rounds, 1000), 999999999)
+
+	b = hashlib.sha512(p + s + p).digest()
+	a = hashlib.sha512(p + s)
+	a.update(b * (len(p) // 64) + b[:len(p) % 64])
+	n = len(p)
+	while n:
+		a.update(b if n & 1 else p)
+		n >>= 1
+	a = a.digest()
+
+	dp = hashlib.sha512(p * len(p)).digest()
+	p_bytes = (dp * (len(p) // 64 + 1))[:len(p)]
+	ds = hashlib.sha512(s * (16 + a[0])).digest()
+	s_bytes = ds[:len(s)]
+
+	c = a
+	for i in range(rounds or SHA512_DEFAULT_ROUNDS):
+		h = hashlib.sha512(p_bytes if i & 1 else c)
+		if i % 3: h.update(s_bytes)
+		if i % 7: h.update(p_bytes)
+		h.update(c if i & 1 else p_bytes)
+		c = h.digest()
+
+	encoded = []
+	for b2, b1, b0 in SHA512_BYTE_ORDER:
+		encoded.append(encode_24bit(c[b2], c[b1], c[b0], 4))
+	encoded.append(encode_24bit(0, 0, c[63], 2))
+
+	return "$6$" + ("rounds=%d$" % rounds if rounds is not None else "") + s.decode("utf8") \
+		+ "$" + "".join(encoded)
+
+def encode_24bit(b2, b1, b0, n):
+	w = (b2 << 16) | (b1 << 8) | b0
+	chars = []
+	for _ in range(n):
+		chars.append(ITOA64[w & 0x3f])
+		w >>= 6
+	return "".join(chars)
+
+def optional_import(name):
+	# The bcrypt and argon2 (argon2-cffi) packages are used when they are
+	# installed, and doveadm otherwise.
+	import importlib
+	try:
+		return importlib.import_module(name)
+	except ImportError:
+		return None
+
+if __name__ == "__main__":
+	# Hashes the JSON list of passwords on stdin with the scheme given as the
+	# argument, for hash_passwords().
+	pws = json.load(sys.stdin)
+	with multiprocessing.pool.Pool() as pool:
+		json.dump(pool.starmap(hash_password, [(pw, sys.argv[1]) for pw in pws], chunksize=8), sys.stdout)
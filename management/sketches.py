@@ -0,0 +1,211 @@
+""" Summaries of streams of items in a fixed amount of memory, for the approximate mode of
+mail_log.py
+
+Both summaries can be merged, so that the files scanned by parallel workers can be combined, and
+converted to and from plain JSON types.
+
+"""
+
+import hashlib
+import math
+
+
+# Number of items a SpaceSaving summary keeps counts for
+SPACE_SAVING_SIZE = 50
+
+# A HyperLogLog sketch has 2**HLL_PRECISION registers of a byte, for a relative standard error of
+# 1.04 / sqrt(2**HLL_PRECISION), i.e. 2.3%
+HLL_PRECISION = 11
+
+# Up to this number of distinct items, a HyperLogLog sketch keeps the items themselves and counts
+# exactly. Most users only see a few distinct hosts, which takes less memory than the registers.
+HLL_SPARSE_LIMIT = 128
+
+
+class SpaceSaving:
+    """ The most frequent items of a stream, with their counts, kept in memory for k items
+
+    This is the Space-Saving algorithm (Metwally, Agrawal and El Abbadi, 2005). When an item that
+    isn't counted comes in and all k counters are in use, it takes over the counter of the least
+    frequent item, including its count. Every count is therefore at most its error too high, and
+    every error is at most total / k. Any item that occurs more than total / k times is kept.
+
+    """
+
+    def __init__(self, k=SPACE_SAVING_SIZE):
+        self.k = k
+        self.total = 0
+        self.counts = {}
+        self.errors = {}
+
+    def add(self, item, count=1):
+        """ Count an occurrence of the item """
+
+        self.total += count
+
+        if item in self.counts:
+            self.counts[item] += count
+        elif len(self.counts) < self.k:
+            self.counts[item] = count
+            self.errors[item] = 0
+        else:
+            victim = min(self.counts, key=self.counts.get)
+            minimum = self.counts.pop(victim)
+            del self.errors[victim]
+            self.counts[item] = minimum + count
+            self.errors[item] = minimum
+
+    def merge(self, other):
+        """ Add the counts of the other summary
+
+        Items that one of the summaries doesn't count could have occurred up to as often as its
+        smallest count, which is added to their errors (Agarwal et al., Mergeable Summaries, 2012).
+
+        """
+
+        own_minimum = self.minimum()
+        other_minimum = other.minimum()
+
+        counts = {}
+        errors = {}
+        for item in self.counts.keys() | other.counts.keys():
+            counts[item] = (self.counts.get(item, own_minimum) +
+                            other.counts.get(item, other_minimum))
+            errors[item] = (self.errors.get(item, own_minimum) +
+                            other.errors.get(item, other_minimum))
+
+        if len(counts) > self.k:
+            kept = sorted(counts, key=counts.get, reverse=True)[:self.k]
+            counts = {item: counts[item] for item in kept}
+            errors = {item: errors[item] for item in kept}
+        self.counts = counts
+        self.errors = errors
+        self.total += other.total
+
+    def minimum(self):
+        """ The count an item that isn't kept could at most have """
+        return min(self.counts.values()) if len(self.counts) >= self.k else 0
+
+    def top(self, n=None):
+        """ Get the n most frequent items as (item, count, error), the count being at most error too
+        high """
+
+        items = sorted(self.counts, key=lambda item: (-self.counts[item], item))[:n]
+        return [(item, self.counts[item], self.errors[item]) for item in items]
+
+    def to_json(self):
+        return {
+            "k": self.k,
+            "total": self.total,
+            "counts": [[item, count, self.errors[item]] for item, count in self.counts.items()],
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        summary = cls(data["k"])
+        summary.total = data["total"]
+        for item, count, error in data["counts"]:
+            summary.counts[item] = count
+            summary.errors[item] = error
+        return summary
+
+
+class HyperLogLog:
+    """ The number of distinct items in a stream, estimated in memory for 2**precision bytes
+
+    This is HyperLogLog (Flajolet et al., 2007) with the linear counting correction for small
+    cardinalities. Until there are more than HLL_SPARSE_LIMIT distinct items, the items themselves
+    are kept, so small counts are exact. The estimate is available through len(), and sketches are
+    merged with |=, like the sets they replace.
+
+    """
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.items = set()
+        self.registers = None
+
+    def add(self, item):
+        """ Add an item to the sketch """
+
+        if self.registers is None:
+            self.items.add(item)
+            if len(self.items) > HLL_SPARSE_LIMIT:
+                self.densify()
+        else:
+            self.add_hash(item)
+
+    def add_hash(self, item):
+        h = int.from_bytes(hashlib.blake2b(item.encode("utf8"), digest_size=8).digest(), "big")
+
+        # The first bits pick the register, which keeps the highest position of the first set
+        # bit in the rest of the bits
+        bits = 64 - self.precision
+        index = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def densify(self):
+        """ Switch from keeping the items to keeping the registers """
+
+        self.registers = bytearray(1 << self.precision)
+        for item in self.items:
+            self.add_hash(item)
+        self.items = None
+
+    def __len__(self):
+        if self.registers is None:
+            return len(self.items)
+
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -rank for rank in self.registers)
+
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+
+        return int(round(estimate))
+
+    def __iter__(self):
+        """ The items, as long as they are kept """
+        return iter(self.items or ())
+
+    def __ior__(self, other):
+        if other.registers is None and self.registers is None:
+            self.items |= other.items
+            if len(self.items) > HLL_SPARSE_LIMIT:
+                self.densify()
+        else:
+            if self.registers is None:
+                self.densify()
+            if other.registers is None:
+                for item in other.items:
+                    self.add_hash(item)
+            else:
+                self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def is_exact(self):
+        return self.registers is None
+
+    def relative_error(self):
+        """ The relative standard error of the estimate """
+        return 0.0 if self.registers is None else 1.04 / math.sqrt(len(self.registers))
+
+    def to_json(self):
+        if self.registers is None:
+            return {"precision": self.precision, "items": sorted(self.items)}
+        return {"precision": self.precision, "registers": self.registers.hex()}
+
+    @classmethod
+    def from_json(cls, data):
+        sketch = cls(data["precision"])
+        if "registers" in data:
+            sketch.registers = bytearray.fromhex(data["registers"])
+            sketch.items = None
+        else:
+            sketch.items = set(data["items"])
+        return sketch
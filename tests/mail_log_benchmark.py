@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# Measures how fast management/mail_log.py scans and reports, on a
+# synthetic log written by tests/mail_log_generator.py.
+#
+# Usage: tests/mail_log_benchmark.py [options] [number of lines, default 10000000]
+#
+# The stages are timed separately:
+#   scan_mail_log_line  lines cycled through from a pool, in memory
+#   scan_files          the rotated and compressed log files, from disk
+#   print_text, print_json, print_csv
+#                       the report of what scan_files collected
+#   merge_snapshots, merge_approximate
+#                       merging that data with itself, as --merge does,
+#                       in the exact and the approximate mode
+#
+# The synthetic log is the same every time, so to compare before and
+# after a change, run it on both versions of the tree with --output and
+# then pass the earlier result to --compare.
+######################################################################
+
+import sys, os, io, time, json, platform, datetime, tempfile, argparse, contextlib, subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "management"))
+import mail_log
+from mail_log_generator import Generator, generate, add_arguments, generator_options
+
+# The lines scanned in memory are cycled through from a pool, so that
+# generating lines doesn't count towards the time measured.
+POOL_SIZE = 100000
+
+parser = argparse.ArgumentParser(description="Benchmark mail_log.py.")
+parser.add_argument("lines", type=int, nargs="?", default=10000000,
+	help="number of lines to scan in memory (default 10000000)")
+parser.add_argument("--repeat", type=int, default=3,
+	help="run the file and print stages this many times and keep the fastest (default 3)")
+parser.add_argument("--output", metavar="<file>", help="write the results as JSON to the file")
+parser.add_argument("--compare", metavar="<file>", help="compare with the results in the file")
+add_arguments(parser)
+args = parser.parse_args()
+
+def git_commit():
+	try:
+		return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+			cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def best_of(repeat, func):
+	# Returns the fastest time and the result of the last run.
+	times = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		result = func()
+		times.append(time.perf_counter() - start)
+	return min(times), result
+
+# Scan everything in the log, with all scanners on.
+options = generator_options(args)
+end = options["end"] or datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+options["end"] = end
+mail_log.START_DATE = datetime.datetime.now()
+mail_log.END_DATE = end - datetime.timedelta(days=args.days + 1)
+for setting in mail_log.SCANNER_SETTINGS:
+	setattr(mail_log, setting, True)
+
+results = {
+	"commit": git_commit(),
+	"python": platform.python_version(),
+	"date": str(datetime.datetime.now().replace(microsecond=0)),
+	"parameters": {k: str(v) if isinstance(v, datetime.datetime) else v for k, v in vars(args).items()
+		if k not in ("output", "compare")},
+	"stages": {},
+}
+stages = results["stages"]
+
+# scan_mail_log_line
+generator = Generator(**{k: options[k] for k in ("users", "sent", "received", "logins", "spam",
+	"auth_failures", "seed", "rfc3339")})
+pool = []
+hour = end - datetime.timedelta(hours=12)
+while len(pool) < POOL_SIZE:
+	pool.extend(line.rstrip("\n") for line in generator.hour(hour))
+	hour += datetime.timedelta(hours=1)
+del pool[POOL_SIZE:]
+
+collector = mail_log.new_collector()
+scan = mail_log.scan_mail_log_line
+start = time.perf_counter()
+for i in range(args.lines):
+	scan(pool[i % POOL_SIZE], collector)
+elapsed = time.perf_counter() - start
+stages["scan_mail_log_line"] = {"seconds": elapsed, "lines": args.lines,
+	"lines_per_second": args.lines / elapsed}
+
+with tempfile.TemporaryDirectory() as directory:
+	mail_log.LOG_FILES = generate(directory, **options)
+	mail_log.ARCHIVE_INDEX_FILE = os.path.join(directory, "archives.json")
+	size = sum(os.path.getsize(fn) for fn in mail_log.LOG_FILES)
+
+	# scan_files, without the index of the compressed files, like a first run
+	def scan_files():
+		with contextlib.suppress(FileNotFoundError):
+			os.remove(mail_log.ARCHIVE_INDEX_FILE)
+		collector = mail_log.new_collector()
+		mail_log.scan_files(collector)
+		return collector
+	elapsed, collector = best_of(args.repeat, scan_files)
+	stages["scan_files"] = {"seconds": elapsed, "lines": collector["scan_count"], "bytes": size,
+		"lines_per_second": collector["scan_count"] / elapsed}
+
+	# The same in the approximate mode, for merge_snapshots below
+	mail_log.APPROXIMATE = True
+	approximate_collector = scan_files()
+	approximate_collector["scan_time"] = 0
+	approximate_stats = mail_log.get_collector_stats(approximate_collector)
+	mail_log.APPROXIMATE = False
+
+collector["scan_time"] = elapsed
+stats = mail_log.get_collector_stats(collector)
+
+for stage, func in (
+		("print_text", lambda: mail_log.print_mail_log_report(collector)),
+		("print_json", lambda: mail_log.print_mail_stats(stats, "json")),
+		("print_csv", lambda: mail_log.print_mail_stats(stats, "csv"))):
+	out = io.StringIO()
+	with contextlib.redirect_stdout(out):
+		elapsed, _ = best_of(args.repeat, func)
+	stages[stage] = {"seconds": elapsed, "bytes": len(out.getvalue()) // args.repeat}
+
+# merge_snapshots, of what was collected as if by two boxes, in both modes
+with tempfile.TemporaryDirectory() as directory:
+	for stage, snapshot in (("merge_snapshots", stats), ("merge_approximate", approximate_stats)):
+		sources = []
+		for box in ("a", "b"):
+			sources.append(os.path.join(directory, box + ".json"))
+			with open(sources[-1], "w") as f:
+				json.dump(snapshot, f)
+		elapsed, merged = best_of(args.repeat, lambda: mail_log.merge_snapshots(sources))
+		if merged["scan_count"] != 2 * snapshot["scan_count"]:
+			raise AssertionError("%s: merged %d lines scanned, not %d" % (stage,
+				merged["scan_count"], 2 * snapshot["scan_count"]))
+		stages[stage] = {"seconds": elapsed}
+
+compare = None
+if args.compare:
+	with open(args.compare) as f:
+		compare = json.load(f)
+
+print("%-20s %10s %14s" % ("stage", "seconds", "lines/second") + ("   vs %s" % compare["commit"] if compare else ""))
+for stage, result in stages.items():
+	line = "%-20s %10.3f %14s" % (stage, result["seconds"],
+		"%d" % result["lines_per_second"] if "lines_per_second" in result else "")
+	if compare and stage in compare["stages"]:
+		line += "   %+6.1f%%" % (100 * (result["seconds"] / compare["stages"][stage]["seconds"] - 1))
+	print(line)
+
+if args.output:
+	with open(args.output, "w") as f:
+		json.dump(results, f, indent=2)
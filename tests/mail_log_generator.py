@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# Writes a synthetic mail log, rotated and compressed the way logrotate
+# leaves /var/log/mail.log, to test and benchmark management/mail_log.py.
+#
+# Usage: tests/mail_log_generator.py [options] directory
+#
+# The log has postfix, dovecot and postgrey lines for email sent by and
+# delivered to the users of the box, spam that gets greylisted or
+# blocked, logins and failed logins. The same options and seed give the
+# same log every time; with --end the dates are fixed too, otherwise the
+# log ends at the start of the current hour.
+######################################################################
+
+import os, gzip, random, datetime, argparse
+
+# Relative amount of activity in every hour of the day.
+DIURNAL = [
+	0.3, 0.2, 0.2, 0.2, 0.2, 0.3, 0.5, 0.8, 1.2, 1.5, 1.6, 1.6,
+	1.4, 1.5, 1.6, 1.6, 1.5, 1.3, 1.1, 1.0, 0.9, 0.8, 0.6, 0.4,
+]
+
+HOSTNAME = "box"
+SERVER_IP = "10.0.0.1"
+
+# Remote domains, the first ones by far the most popular, like in real life.
+REMOTE_DOMAINS = ["gmail.com", "outlook.com", "yahoo.com", "icloud.com"] + \
+	["example%d.net" % i for i in range(60)]
+REMOTE_WEIGHTS = [30, 20, 10, 8] + [60 / (i + 1) for i in range(60)]
+
+class Generator:
+	def __init__(self, users=200, sent=10, received=30, logins=50, spam=0.5,
+			auth_failures=20, seed=0, rfc3339=False):
+		self.rnd = random.Random(seed)
+		self.users = ["user%d@domain%d.com" % (i, i % 20) for i in range(users)]
+		self.rates = {
+			# Events per hour at an average time of day.
+			"sent": sent * users / 24,
+			"received": received * users / 24,
+			"spam": received * users / 24 * spam / (1 - spam),
+			"login": logins * users / 24,
+			"auth_failure": auth_failures,
+		}
+		self.rfc3339 = rfc3339
+
+	def count(self, rate):
+		# Round the expected number of events up or down at random.
+		n = int(rate)
+		return n + (self.rnd.random() < rate - n)
+
+	def queue_id(self):
+		return "%010X" % self.rnd.randrange(16**10)
+
+	def remote_host(self):
+		n = self.rnd.randrange(4096)
+		return "mail%d.%s" % (n, self.rnd.choices(REMOTE_DOMAINS, REMOTE_WEIGHTS)[0]), \
+			"198.51.%d.%d" % (n // 256, n % 256)
+
+	def spammer(self):
+		# Spam comes from many more addresses than email does.
+		n = self.rnd.randrange(1 << 20)
+		return "unknown", "203.%d.%d.%d" % (n >> 16, (n >> 8) & 255, n & 255)
+
+	def client(self):
+		n = self.rnd.randrange(1024)
+		return "client%d.isp.example" % n, "192.0.%d.%d" % (2 + n // 256, n % 256)
+
+	def delays(self, remote):
+		parts = [
+			round(self.rnd.expovariate(20), 2),
+			round(self.rnd.expovariate(50), 2),
+			round(self.rnd.expovariate(5 if remote else 100), 2),
+			round(self.rnd.expovariate(2 if remote else 10), 2),
+		]
+		return "delay=%.2g, delays=%s" % (sum(parts), "/".join("%.2g" % p for p in parts))
+
+	def sent(self, t):
+		user = self.rnd.choice(self.users)
+		host, ip = self.client()
+		qid = self.queue_id()
+		recipient = "contact%d@%s" % (self.rnd.randrange(500), self.rnd.choices(REMOTE_DOMAINS, REMOTE_WEIGHTS)[0])
+		mx = "mx.%s" % recipient.split("@")[1]
+		yield t, "postfix/submission/smtpd[%d]: connect from %s[%s]" % (self.rnd.randrange(2000, 30000), host, ip)
+		yield t, "postfix/submission/smtpd[2190]: %s: client=%s[%s], sasl_method=PLAIN, sasl_username=%s" % (qid, host, ip, user)
+		yield t + 1, "postfix/cleanup[2201]: %s: message-id=<%s@%s>" % (qid, qid.lower(), host)
+		yield t + 1, "opendkim[1011]: %s: DKIM-Signature field added (s=mail, d=%s)" % (qid, user.split("@")[1])
+		yield t + 1, "postfix/qmgr[1870]: %s: from=<%s>, size=%d, nrcpt=1 (queue active)" % (qid, user, self.rnd.randrange(1000, 200000))
+		outcome = self.rnd.random()
+		relay = "relay=%s[198.18.0.%d]:25" % (mx, self.rnd.randrange(256))
+		conn_use = ", conn_use=%d" % self.rnd.randrange(2, 10) if self.rnd.random() < 0.2 else ""
+		if outcome < 0.05:
+			yield t + 2, "postfix/smtp[2302]: %s: to=<%s>, %s%s, %s, dsn=5.1.1, status=bounced (host %s said: 550 5.1.1 User unknown (in reply to RCPT TO command))" % (qid, recipient, relay, conn_use, self.delays(True), mx)
+		elif outcome < 0.1:
+			yield t + 2, "postfix/smtp[2302]: %s: to=<%s>, %s%s, %s, dsn=4.2.0, status=deferred (host %s said: 450 4.2.0 Greylisted, try again later (in reply to RCPT TO command))" % (qid, recipient, relay, conn_use, self.delays(True), mx)
+			yield t + 30, "postfix/smtp[2302]: %s: to=<%s>, %s, %s, dsn=2.0.0, status=sent (250 2.0.0 OK)" % (qid, recipient, relay, self.delays(True))
+		else:
+			yield t + 2, "postfix/smtp[2302]: %s: to=<%s>, %s%s, %s, dsn=2.0.0, status=sent (250 2.0.0 OK)" % (qid, recipient, relay, conn_use, self.delays(True))
+		yield t + 2, "postfix/qmgr[1870]: %s: removed" % qid
+
+	def received(self, t):
+		user = self.rnd.choice(self.users)
+		host, ip = self.remote_host()
+		qid = self.queue_id()
+		sender = "someone%d@%s" % (self.rnd.randrange(1000), host.split(".", 1)[1])
+		yield t, "postfix/smtpd[3301]: connect from %s[%s]" % (host, ip)
+		yield t, "postgrey[1112]: action=pass, reason=triplet found, delay=%d, client_name=%s, client_address=%s, sender=%s, recipient=%s" % (self.rnd.randrange(300, 900), host, ip, sender, user)
+		yield t, "postfix/smtpd[3301]: %s: client=%s[%s]" % (qid, host, ip)
+		yield t + 1, "postfix/cleanup[2201]: %s: message-id=<%s@%s>" % (qid, qid.lower(), host)
+		yield t + 1, "postfix/qmgr[1870]: %s: from=<%s>, size=%d, nrcpt=1 (queue active)" % (qid, sender, self.rnd.randrange(1000, 200000))
+		yield t + 2, "postfix/lmtp[2204]: %s: to=<%s>, relay=127.0.0.1[127.0.0.1]:10025, %s, dsn=2.0.0, status=sent (250 2.0.0 <%s> Saved)" % (qid, user, self.delays(False), user)
+		yield t + 2, "postfix/qmgr[1870]: %s: removed" % qid
+		yield t + 2, "postfix/smtpd[3301]: disconnect from %s[%s] ehlo=2 starttls=1 mail=1 rcpt=1 data=1 quit=1 commands=7" % (host, ip)
+
+	def spam(self, t):
+		user = self.rnd.choice(self.users)
+		host, ip = self.spammer()
+		sender = "%s@spam%d.example" % (self.rnd.choice(["info", "sales", "offer", "noreply"]), self.rnd.randrange(5000))
+		yield t, "postfix/smtpd[3301]: connect from %s[%s]" % (host, ip)
+		if self.rnd.random() < 0.6:
+			yield t, "postgrey[1112]: action=greylist, reason=new, client_name=%s, client_address=%s, sender=%s, recipient=%s" % (host, ip, sender, user)
+			yield t, "postfix/smtpd[3301]: NOQUEUE: reject: RCPT from %s[%s]: 450 4.2.0 <%s>: Recipient address rejected: Greylisted, see http://postgrey.schweikert.ch/help/%s.html; from=<%s> to=<%s> proto=ESMTP helo=<%s>" % (host, ip, user, user.split("@")[1], sender, user, host)
+		else:
+			yield t, "postfix/smtpd[3301]: NOQUEUE: reject: RCPT from %s[%s]: 554 5.7.1 Service unavailable; Client host [%s] blocked using zen.spamhaus.org; https://www.spamhaus.org/query/ip/%s; from=<%s> to=<%s> proto=ESMTP helo=<%s>" % (host, ip, ip, ip, sender, user, host)
+		yield t + 1, "postfix/smtpd[3301]: disconnect from %s[%s] ehlo=1 mail=1 rcpt=0/1 quit=1 commands=3/4" % (host, ip)
+
+	def login(self, t):
+		user = self.rnd.choice(self.users)
+		_, ip = self.client()
+		protocol = "imap" if self.rnd.random() < 0.9 else "pop3"
+		yield t, "%s-login: Info: Login: user=<%s>, method=PLAIN, rip=%s, lip=%s, mpid=%d, TLS, session=<%s>" % (protocol, user, ip, SERVER_IP, self.rnd.randrange(2000, 30000), self.queue_id())
+
+	def auth_failure(self, t):
+		_, ip = self.spammer()
+		if self.rnd.random() < 0.5:
+			user = self.rnd.choice(self.users + ["admin", "info", "test"])
+			yield t, "imap-login: Info: Disconnected (auth failed, 1 attempts in 2 secs): user=<%s>, method=PLAIN, rip=%s, lip=%s, TLS, session=<%s>" % (user, ip, SERVER_IP, self.queue_id())
+		else:
+			yield t, "postfix/submission/smtpd[2190]: warning: unknown[%s]: SASL LOGIN authentication failed: UGFzc3dvcmQ6" % ip
+
+	def hour(self, start):
+		""" The lines of the hour starting at start, in order """
+		lines = []
+		factor = DIURNAL[start.hour]
+		for kind, rate in self.rates.items():
+			for _ in range(self.count(rate * factor)):
+				# Leave a minute for the later lines of an event, to keep the hours in order.
+				t = self.rnd.randrange(3540)
+				lines.extend(getattr(self, kind)(t))
+		lines.sort(key=lambda line: line[0])
+		for t, message in lines:
+			yield self.format_line(start + datetime.timedelta(seconds=t), message)
+
+	def format_line(self, date, message):
+		if self.rfc3339:
+			stamp = date.strftime("%Y-%m-%dT%H:%M:%S.000000+00:00")
+		else:
+			stamp = "%s %2d %s" % (date.strftime("%b"), date.day, date.strftime("%H:%M:%S"))
+		if message.startswith(("imap-login", "pop3-login")):
+			# Dovecot writes to the log file itself, without the host name.
+			return "%s %s\n" % (stamp, message)
+		return "%s %s %s\n" % (stamp, HOSTNAME, message)
+
+	def lines(self, start, end):
+		""" The lines from start until end, both at the start of an hour """
+		while start < end:
+			yield from self.hour(start)
+			start += datetime.timedelta(hours=1)
+
+def generate(directory, days=7, rotations=6, compress=True, end=None, **options):
+	""" Writes mail.log and its rotations to the directory and returns
+	their paths, the newest first, like mail_log.LOG_FILES. Every file
+	holds an equal part of the days, the oldest first. Like logrotate with
+	delaycompress, mail.log.1 isn't compressed but the older ones are. """
+
+	if end is None:
+		end = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+	hours = int(days * 24)
+	per_file = max(hours // (rotations + 1), 1)
+	generator = Generator(**options)
+
+	files = []
+	for i in range(rotations + 1):
+		name = "mail.log" if i == 0 else "mail.log.%d" % i
+		if compress and i >= 2:
+			name += ".gz"
+		files.append(os.path.join(directory, name))
+
+	# Write the oldest file first, so the log is generated in order.
+	start = end - datetime.timedelta(hours=hours)
+	for i, fn in reversed(list(enumerate(files))):
+		file_end = end - datetime.timedelta(hours=per_file * i) if i else end
+		with (gzip.open(fn, "wt") if fn.endswith(".gz") else open(fn, "w")) as f:
+			f.writelines(generator.lines(start, file_end))
+		start = file_end
+
+	return files
+
+def add_arguments(parser):
+	parser.add_argument("--users", type=int, default=200, help="number of users (default 200)")
+	parser.add_argument("--days", type=float, default=7, help="days of log to write (default 7)")
+	parser.add_argument("--sent", type=float, default=10, help="emails sent per user per day (default 10)")
+	parser.add_argument("--received", type=float, default=30, help="emails received per user per day (default 30)")
+	parser.add_argument("--logins", type=float, default=50, help="logins per user per day (default 50)")
+	parser.add_argument("--spam", type=float, default=0.5, help="share of the incoming email that is spam, below 1 (default 0.5)")
+	parser.add_argument("--auth-failures", type=float, default=20, help="failed logins per hour (default 20)")
+	parser.add_argument("--rotations", type=int, default=6, help="number of rotated log files (default 6)")
+	parser.add_argument("--no-compress", dest="compress", action="store_false", help="don't gzip the older log files")
+	parser.add_argument("--rfc3339", action="store_true", help="write RFC 3339 dates instead of traditional syslog dates")
+	parser.add_argument("--seed", type=int, default=0, help="random seed (default 0)")
+	parser.add_argument("--end", type=lambda s: datetime.datetime.strptime(s, "%Y-%m-%d %H:%M"),
+		help="end of the log, as \"YYYY-MM-DD HH:MM\" (default the start of the current hour)")
+
+def generator_options(args):
+	return dict(users=args.users, days=args.days, sent=args.sent, received=args.received,
+		logins=args.logins, spam=args.spam, auth_failures=args.auth_failures,
+		rotations=args.rotations, compress=args.compress, rfc3339=args.rfc3339,
+		seed=args.seed, end=args.end)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Write a synthetic mail log.")
+	parser.add_argument("directory")
+	add_arguments(parser)
+	args = parser.parse_args()
+
+	os.makedirs(args.directory, exist_ok=True)
+	for fn in generate(args.directory, **generator_options(args)):
+		print(fn, os.path.getsize(fn))
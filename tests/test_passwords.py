@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# Tests hashing and checking passwords in management/passwords.py, without
+# a box: the hashes must be accepted by verify_password(), and hashing many
+# passwords at once must not run the module code of the calling program,
+# like the management daemon, in the worker processes.
+#
+# Usage: tests/test_passwords.py
+
+import sys, os, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "management"))
+import passwords
+
+# This script stands in for the management daemon. A worker that imports it
+# again, as spawned and forkserver processes do, leaves a marker behind.
+if __name__ != "__main__" and "TEST_PASSWORDS_MARKER" in os.environ:
+	open(os.environ["TEST_PASSWORDS_MARKER"], "w").close()
+
+def check(condition, message):
+	if not condition:
+		print("FAIL:", message)
+		sys.exit(1)
+
+if __name__ == "__main__":
+	directory = tempfile.TemporaryDirectory()
+	marker = os.environ["TEST_PASSWORDS_MARKER"] = os.path.join(directory.name, "marker")
+
+	pws = ["password %d ✓" % i for i in range(passwords.PARALLEL_HASHING_THRESHOLD * 2)]
+	for pws in (pws[:2], pws):
+		hashes = passwords.hash_passwords(pws)
+		check(len(hashes) == len(pws), "%d hashes for %d passwords" % (len(hashes), len(pws)))
+		check(all(passwords.verify_password(pw, pw_hash) for pw, pw_hash in zip(pws, hashes)),
+			"a hash doesn't match its password")
+		check(not passwords.verify_password("wrong", hashes[0]), "a wrong password matches")
+		check(len(set(hashes)) == len(hashes), "the salts aren't random")
+
+	# A known SHA512-CRYPT hash, from the test vectors of the specification.
+	check(passwords.sha512_crypt("Hello world!", "saltstring")
+		== "$6$saltstring$svn8UoSVapNtMuq1ukKS4tPQd8iKwSMHWjl/O817G3uBnIFNjnQJuesI68u4OTLiBFdcbYEdFCoEOfaS35inz1",
+		"sha512_crypt doesn't match the specification")
+
+	check(not os.path.exists(marker), "the workers ran this script's module code")
+	print("OK")
@@ -2,13 +2,17 @@
 
 import sys, getpass, urllib.request, urllib.error, json, re
 
-def mgmt(cmd, data=None, is_json=False):
+def mgmt(cmd, data=None, is_json=False, content_type=None):
 	# The base URL for the management daemon. (Listens on IPv4 only.)
 	mgmt_uri = 'http://127.0.0.1:10222'
 
 	setup_key_auth(mgmt_uri)
 
-	req = urllib.request.Request(mgmt_uri + cmd, urllib.parse.urlencode(data).encode("utf8") if data else None)
+	if content_type:
+		# Send the data as the request body as is.
+		req = urllib.request.Request(mgmt_uri + cmd, data, { "Content-Type": content_type })
+	else:
+		req = urllib.request.Request(mgmt_uri + cmd, urllib.parse.urlencode(data).encode("utf8") if data else None)
 	try:
 		response = urllib.request.urlopen(req)
 	except urllib.error.HTTPError as e:
@@ -43,6 +47,17 @@ def read_password():
         break
     return first
 
+def read_import_file(fn):
+	# Reads a file of users or aliases to import, or standard input if the
+	# file name is "-". The data is sent as JSON if the file name ends in
+	# .json and as CSV otherwise.
+	if fn == "-":
+		data = sys.stdin.buffer.read()
+	else:
+		with open(fn, "rb") as f:
+			data = f.read()
+	return data, ("application/json" if fn.endswith(".json") else "text/csv")
+
 def setup_key_auth(mgmt_uri):
 	key = open('/var/lib/mailinabox/api.key').read().strip()
 
@@ -64,10 +79,12 @@ if len(sys.argv) < 2:
 	print("  tools/mail.py user make-admin user@domain.com")
 	print("  tools/mail.py user remove-admin user@domain.com")
 	print("  tools/mail.py user admins (lists admins)")
+	print("  tools/mail.py user import users.csv (lines of email,password,privileges; or a .json list, or - for stdin)")
 	print("  tools/mail.py alias  (lists aliases)")
 	print("  tools/mail.py alias add incoming.name@domain.com sent.to@other.domain.com")
 	print("  tools/mail.py alias add incoming.name@domain.com 'sent.to@other.domain.com, multiple.people@other.domain.com'")
 	print("  tools/mail.py alias remove incoming.name@domain.com")
+	print("  tools/mail.py alias import [--update] aliases.csv (lines of address,forwards_to,permitted_senders; or a .json list, or - for stdin)")
 	print()
 	print("Removing a mail user does not delete their mail folders on disk. It only prevents IMAP/SMTP login.")
 	print()
@@ -116,12 +133,24 @@ elif sys.argv[1] == "user" and sys.argv[2] == "admins":
 			if "admin" in user['privileges']:
 				print(user['email'])
 
+elif sys.argv[1] == "user" and sys.argv[2] == "import" and len(sys.argv) == 4:
+	data, content_type = read_import_file(sys.argv[3])
+	print(mgmt("/mail/users/import", data, content_type=content_type))
+
 elif sys.argv[1] == "alias" and len(sys.argv) == 2:
 	print(mgmt("/mail/aliases"))
 
 elif sys.argv[1] == "alias" and sys.argv[2] == "add" and len(sys.argv) == 5:
 	print(mgmt("/mail/aliases/add", { "address": sys.argv[3], "forwards_to": sys.argv[4] }))
 
+elif sys.argv[1] == "alias" and sys.argv[2] == "import" and len(sys.argv) in (4, 5):
+	update = len(sys.argv) == 5 and sys.argv[3] == "--update"
+	if len(sys.argv) == 5 and not update:
+		print("Invalid command-line arguments.")
+		sys.exit(1)
+	data, content_type = read_import_file(sys.argv[-1])
+	print(mgmt("/mail/aliases/import" + ("?update_if_exists=1" if update else ""), data, content_type=content_type))
+
 elif sys.argv[1] == "alias" and sys.argv[2] == "remove" and len(sys.argv) == 4:
 	print(mgmt("/mail/aliases/remove", { "address": sys.argv[3] }))
 